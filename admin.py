@@ -0,0 +1,356 @@
+"""Bulk balance operations, run by hand.
+
+    python admin.py credit 10 [--where '{"balance": 0}'] [--operation ID] [--dry-run]
+    python admin.py fee 2 [--where ...] [--operation ID] [--dry-run]
+    python admin.py status ID
+
+credit adds the amount to the balance of every user matching --where (every
+user by default), fee takes it from those whose balance covers it. Each
+change is recorded in the ledger like a deposit or a withdrawal, so
+/history and /debug_ledger show it.
+
+The users are read with one cursor, sorted by user_id and fetched
+--batch-size documents at a time, and each batch is applied with one
+unordered bulk_write while the next one is read, so memory does not grow
+with the number of users. Every update is conditional on the balance and
+ledger_seq read: a user whose balance the bot changed meanwhile is read and
+updated again.
+
+An operation is identified by --operation (a new id is printed otherwise).
+Its progress, the last user_id done and the totals, is kept in the settings
+collection after every batch, and every user it changed gets a marker under
+admin_operations.<id>, so running the same operation again resumes it and
+never changes a user twice, whatever other operations ran in between. Users
+given up on because the bot kept changing them are picked up by running it
+again with --rescan, which starts over from the first user but still skips
+the users already changed. Once an operation finished without giving up on
+any user, its markers are removed and it cannot be run again. --dry-run only counts the users and the amount the operation would
+change, without writing anything.
+
+After every batch, the users_version setting is bumped: the bot empties
+its user cache when it sees that (every USER_CACHE_CHECK_INTERVAL seconds,
+see cache.py), so users see their new balance within that delay. Withdrawals
+are checked against the stored balance, not the cached one.
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import ASCENDING, UpdateOne
+
+from cache import USERS_VERSION_KEY
+from ledger import DEFAULT_SNAPSHOT_EVERY, EPOCH, insert_entries, ledger_entry, ledger_now, ledger_snapshots
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 1000
+# Attempts at updating a user whose document changed between the read and the update
+MAX_ATTEMPTS = 3
+CHECKPOINT_PREFIX = 'admin_operation:'
+# Field of the user documents holding the marker of each operation that changed them, by operation id
+MARKERS_FIELD = 'admin_operations'
+# Operation ids are part of a field path
+OPERATION_ID_PATTERN = re.compile(r'[A-Za-z0-9_-]+')
+PROGRESS_INTERVAL = 5
+
+# Sign of the balance change of each kind of operation
+OPERATIONS = {'credit': 1, 'fee': -1}
+PROJECTION = {'_id': False, 'user_id': True, 'balance': True, 'ledger_seq': True, 'ledger_ts': True}
+
+
+class OperationMismatch(Exception):
+    """An operation id is reused with a different kind, amount or filter."""
+
+
+class OperationCompleted(Exception):
+    """An operation is run again after it completed and its markers were removed."""
+
+
+class BalanceOperation:
+    """Applies one balance change to every user matching a filter, resumably."""
+
+    def __init__(self, db, kind, amount, where=None, operation_id=None, batch_size=DEFAULT_BATCH_SIZE,
+                 snapshot_every=DEFAULT_SNAPSHOT_EVERY, dry_run=False, rescan=False):
+        self.users = db['users']
+        self.settings = db['settings']
+        self.transactions = db['transactions']
+        self.snapshots = db['balance_snapshots']
+        self.kind = kind
+        self.amount = amount
+        self.change = OPERATIONS[kind] * amount
+        self.where = where or {}
+        self.operation_id = operation_id or uuid.uuid4().hex[:12]
+        if not OPERATION_ID_PATTERN.fullmatch(self.operation_id):
+            raise ValueError(f"Operation ids are made of letters, digits, '-' and '_', not {self.operation_id!r}")
+        self.batch_size = batch_size
+        self.snapshot_every = snapshot_every
+        self.dry_run = dry_run
+        self.rescan = rescan
+        self.stats = {'users': 0, 'amount': 0, 'conflicts': 0}
+
+    @property
+    def checkpoint_key(self):
+        return CHECKPOINT_PREFIX + self.operation_id
+
+    @property
+    def marker_path(self):
+        return f'{MARKERS_FIELD}.{self.operation_id}'
+
+    def _query(self, after=None):
+        clauses = [self.where, {self.marker_path: {'$exists': False}}]
+        if after is not None:
+            clauses.append({'user_id': {'$gt': after}})
+        if self.change < 0:
+            # A fee is only taken from the balances that cover it
+            clauses.append({'balance': {'$gte': self.amount}})
+        return {'$and': [clause for clause in clauses if clause]}
+
+    # ------------------ Checkpoint ------------------
+
+    def _load_checkpoint(self):
+        """Returns the checkpoint of the operation, creating the one of a new operation."""
+        document = self.settings.find_one({'key': self.checkpoint_key})
+        if document is None:
+            checkpoint = {
+                'kind': self.kind, 'amount': self.amount, 'where': json.dumps(self.where, sort_keys=True),
+                'last_user_id': None, 'batch_end': None, 'users': 0, 'total': 0, 'conflicts': 0,
+                'started_at': ledger_now(), 'finished_at': None,
+            }
+            if not self.dry_run:
+                self.settings.insert_one({'key': self.checkpoint_key, 'value': checkpoint})
+            return checkpoint
+        checkpoint = document['value']
+        if (checkpoint['kind'], checkpoint['amount'], checkpoint['where']) != (
+                self.kind, self.amount, json.dumps(self.where, sort_keys=True)):
+            raise OperationMismatch(
+                f"Operation {self.operation_id} is a {checkpoint['kind']} of {checkpoint['amount']} "
+                f"for {checkpoint['where']}"
+            )
+        return checkpoint
+
+    def _save_checkpoint(self, last_user_id, users, total, conflicts):
+        self.settings.update_one({'key': self.checkpoint_key}, {
+            '$set': {'value.last_user_id': last_user_id, 'value.batch_end': None},
+            '$inc': {'value.users': users, 'value.total': total, 'value.conflicts': conflicts},
+        })
+
+    # ------------------ Applying ------------------
+
+    def _request(self, user, ts):
+        """The conditional update applying the operation to a user document as read."""
+        seq = user.get('ledger_seq', 0) + 1
+        ts = max(ts, user.get('ledger_ts', EPOCH))
+        marker = {'seq': seq, 'ts': ts, 'balance': user['balance'] + self.change}
+        # ledger_seq: None also matches documents without a ledger yet
+        condition = {'user_id': user['user_id'], 'balance': user['balance'], 'ledger_seq': user.get('ledger_seq')}
+        update = {
+            '$inc': {'balance': self.change, 'ledger_seq': 1},
+            '$set': {'ledger_ts': ts, self.marker_path: marker},
+        }
+        return UpdateOne(condition, update), marker
+
+    def _apply_batch(self, users):
+        """Applies the operation to a batch of user documents. Returns the markers of the users changed."""
+        applied = {}
+        for _ in range(MAX_ATTEMPTS):
+            ts = ledger_now()
+            requests, markers = [], {}
+            for user in users:
+                request, markers[user['user_id']] = self._request(user, ts)
+                requests.append(request)
+            result = self.users.bulk_write(requests, ordered=False)
+            if result.matched_count == len(requests):
+                applied.update(markers)
+                return applied
+            # Some documents changed since they were read: find out which updates applied
+            changed = self.users.find(
+                {'user_id': {'$in': list(markers)}, self.marker_path: {'$exists': True}},
+                projection={'_id': False, 'user_id': True, self.marker_path: True}
+            )
+            for document in changed:
+                applied[document['user_id']] = document[MARKERS_FIELD][self.operation_id]
+            missed = [user_id for user_id in markers if user_id not in applied]
+            # Read again those the operation still applies to
+            query = {'$and': [{'user_id': {'$in': missed}}, self._query()]}
+            users = list(self.users.find(query, projection=PROJECTION))
+            if not users:
+                return applied
+        self.stats['conflicts'] += len(users)
+        logger.warning("Gave up on %s users changed during every attempt: %s", len(users),
+                       [user['user_id'] for user in users])
+        return applied
+
+    def _remove_markers(self):
+        """Removes the markers of a completed operation from the user documents."""
+        # Flagged first: interrupted, this leaves markers behind, but never lets the operation run again
+        self.settings.update_one({'key': self.checkpoint_key}, {'$set': {'value.markers_removed': True}})
+        result = self.users.update_many({self.marker_path: {'$exists': True}}, {'$unset': {self.marker_path: ''}})
+        logger.info("Operation %s completed, removed its marker from %s users", self.operation_id,
+                    result.modified_count)
+
+    def _invalidate_caches(self, markers):
+        """Makes the bot drop the cached copies of the user documents, once some were changed."""
+        if markers:
+            self.settings.update_one({'key': USERS_VERSION_KEY}, {'$inc': {'value': 1}}, upsert=True)
+
+    def _record(self, markers):
+        """Stores the ledger entries of the users changed, from their markers."""
+        entries, snapshots = [], []
+        for user_id, marker in markers.items():
+            user = {'user_id': user_id, 'ledger_seq': marker['seq'], 'ledger_ts': marker['ts'],
+                    'balance': marker['balance']}
+            entry = ledger_entry(user, self.kind, self.change)
+            entries.append(entry)
+            snapshots.extend(ledger_snapshots(entry, self.snapshot_every))
+        if entries:
+            insert_entries(self.transactions, entries)
+        if snapshots:
+            insert_entries(self.snapshots, snapshots)
+        self.stats['users'] += len(markers)
+        self.stats['amount'] += self.change * len(markers)
+
+    def _write_batch(self, users):
+        """Applies the operation to a batch, records it in the ledger and moves the checkpoint past it."""
+        conflicts = self.stats['conflicts']
+        batch_end = users[-1]['user_id']
+        # Lets a resumed operation find the users this batch changed if it is interrupted
+        self.settings.update_one({'key': self.checkpoint_key}, {'$set': {'value.batch_end': batch_end}})
+        markers = self._apply_batch(users)
+        self._invalidate_caches(markers)
+        self._record(markers)
+        applied = len(markers)
+        self._save_checkpoint(batch_end, applied, self.change * applied, self.stats['conflicts'] - conflicts)
+
+    def _recover(self, checkpoint):
+        """Records the ledger entries of the users changed by a batch interrupted before its checkpoint.
+
+        Their markers hold what the entries need, and entries already stored are ignored.
+        """
+        if checkpoint.get('batch_end') is None:
+            return
+        user_ids = {'$lte': checkpoint['batch_end']}
+        if checkpoint['last_user_id'] is not None:
+            user_ids['$gt'] = checkpoint['last_user_id']
+        users = self.users.find(
+            {'user_id': user_ids, self.marker_path: {'$exists': True}},
+            projection={'_id': False, 'user_id': True, self.marker_path: True}
+        )
+        markers = {user['user_id']: user[MARKERS_FIELD][self.operation_id] for user in users}
+        self._invalidate_caches(markers)
+        self._record(markers)
+        applied = len(markers)
+        self._save_checkpoint(checkpoint['batch_end'], applied, self.change * applied, 0)
+        if applied:
+            logger.info("Recorded the ledger entries of %s users changed by an interrupted batch", applied)
+
+    def _batches(self, after):
+        cursor = self.users.find(
+            self._query(after), projection=PROJECTION, sort=[('user_id', ASCENDING)], batch_size=self.batch_size
+        )
+        batch = []
+        for user in cursor:
+            batch.append(user)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def run(self):
+        """Applies the operation, or only counts what it would change with dry_run. Returns the stats."""
+        checkpoint = self._load_checkpoint()
+        if checkpoint.get('markers_removed'):
+            raise OperationCompleted(f"Operation {self.operation_id} already completed")
+        if not self.dry_run:
+            self._recover(checkpoint)
+            checkpoint = self._load_checkpoint()
+        after = None if self.rescan else checkpoint['last_user_id']
+        # Users given up on before this run, which only a scan from the first user picks up
+        given_up_before = 0 if after is None else checkpoint['conflicts']
+        if after is not None:
+            logger.info("Resuming operation %s after user %s", self.operation_id, after)
+
+        started = last_report = time.perf_counter()
+        read = 0
+        # One batch is written while the next one is read; a single writer keeps the checkpoints in order
+        with ThreadPoolExecutor(1, thread_name_prefix='admin-write') as writer:
+            pending = None
+            for batch in self._batches(after):
+                read += len(batch)
+                if self.dry_run:
+                    self.stats['users'] += len(batch)
+                    self.stats['amount'] += self.change * len(batch)
+                else:
+                    if pending is not None:
+                        pending.result()
+                    pending = writer.submit(self._write_batch, batch)
+                now = time.perf_counter()
+                if now - last_report >= PROGRESS_INTERVAL:
+                    logger.info("%s users read, %.0f users/s", read, read / (now - started))
+                    last_report = now
+            if pending is not None:
+                pending.result()
+        if not self.dry_run:
+            self.settings.update_one({'key': self.checkpoint_key}, {'$set': {'value.finished_at': ledger_now()}})
+            if given_up_before + self.stats['conflicts'] == 0:
+                self._remove_markers()
+        self.stats['seconds'] = time.perf_counter() - started
+        return self.stats
+
+
+def status(db, operation_id):
+    """Returns the checkpoint of an operation, None if there is no such operation."""
+    document = db['settings'].find_one({'key': CHECKPOINT_PREFIX + operation_id})
+    return document['value'] if document else None
+
+
+def main():
+    import pymongo
+    from dotenv import load_dotenv
+
+    from storage import script_mongo_uri
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    for kind in OPERATIONS:
+        command = commands.add_parser(kind)
+        command.add_argument('amount', type=int)
+        command.add_argument('--where', type=json.loads, default={}, help='MongoDB filter of the users, as JSON')
+        command.add_argument('--operation', help='id of the operation, to resume it')
+        command.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+        command.add_argument('--dry-run', action='store_true', help='count what would change, write nothing')
+        command.add_argument('--rescan', action='store_true', help='resume from the first user instead of the checkpoint')
+    command = commands.add_parser('status')
+    command.add_argument('operation')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    load_dotenv()
+    db = pymongo.MongoClient(script_mongo_uri('admin.py'))['bot_database']
+
+    if args.command == 'status':
+        checkpoint = status(db, args.operation)
+        print(json.dumps(checkpoint, default=str, indent=2) if checkpoint else f"No operation {args.operation}")
+        return
+    if args.amount <= 0:
+        parser.error('the amount must be greater than zero')
+
+    snapshot_every = int(os.getenv('LEDGER_SNAPSHOT_EVERY', DEFAULT_SNAPSHOT_EVERY))
+    operation = BalanceOperation(db, args.command, args.amount, args.where, args.operation, args.batch_size,
+                                 snapshot_every, args.dry_run, args.rescan)
+    print(f"Operation {operation.operation_id}: {args.command} of {args.amount}"
+          + (" (dry run)" if args.dry_run else ""))
+    stats = operation.run()
+    print(f"{'Would change' if args.dry_run else 'Changed'} {stats['users']} users by {stats['amount']:+} in total "
+          f"in {stats['seconds']:.1f}s ({stats['users'] / max(stats['seconds'], 1e-9):.0f} users/s), "
+          f"{stats['conflicts']} users given up on")
+
+
+if __name__ == '__main__':
+    main()
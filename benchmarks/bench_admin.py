@@ -0,0 +1,81 @@
+"""Throughput of a bulk balance operation.
+
+Credits every one of --users users, against collections that block for
+--latency seconds per round trip, twice:
+
+- "per user": what a hand-written script does, one update_one and one
+  ledger insert per user (run on the first --script-users users only);
+- "admin.py": admin.BalanceOperation, one unordered bulk_write and one
+  ledger insert_many per batch, reading the next batch while writing.
+
+Reported: users per second and database round trips per 1000 users. The
+admin.py run is then checked: every balance credited once, one ledger entry
+per user.
+
+Usage: python benchmarks/bench_admin.py [--users 200000] [--latency 0.002] [--batch-size 1000]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from admin import BalanceOperation
+from benchmarks.fakes import FakeCollection
+from ledger import ledger_now
+
+
+def create_db(users, latency):
+    db = {
+        'users': FakeCollection(latency=latency),
+        'settings': FakeCollection(latency=latency, index='key'),
+        'transactions': FakeCollection(latency=latency, index='_id'),
+        'balance_snapshots': FakeCollection(latency=latency, index='_id'),
+    }
+    for user_id in range(users):
+        db['users'].documents.append({'user_id': user_id, 'balance': user_id % 100})
+    return db
+
+
+def round_trips(db):
+    return sum(collection.calls for collection in db.values())
+
+
+def run_per_user(db, users, amount):
+    started = time.perf_counter()
+    for user in db['users'].find({}, projection={'user_id': True, 'balance': True})[:users]:
+        db['users'].update_one({'user_id': user['user_id']}, {'$inc': {'balance': amount, 'ledger_seq': 1}})
+        db['transactions'].insert_one({'_id': f"{user['user_id']}:1", 'user_id': user['user_id'], 'seq': 1,
+                                       'ts': ledger_now(), 'type': 'credit', 'amount': amount})
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200000)
+    parser.add_argument('--script-users', type=int, default=2000, help='users credited by the per-user script')
+    parser.add_argument('--latency', type=float, default=0.002, help='seconds each database round trip blocks')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    db = create_db(args.users, args.latency)
+    elapsed = run_per_user(db, args.script_users, 1)
+    print(f"  per user: {args.script_users / elapsed:>9.0f} users/s  "
+          f"{round_trips(db) * 1000 / args.script_users:7.1f} round trips per 1000 users")
+
+    db = create_db(args.users, args.latency)
+    before = sum(user['balance'] for user in db['users'].documents)
+    operation = BalanceOperation(db, 'credit', 1, operation_id='bench', batch_size=args.batch_size)
+    stats = operation.run()
+    print(f"  admin.py: {stats['users'] / stats['seconds']:>9.0f} users/s  "
+          f"{round_trips(db) * 1000 / args.users:7.1f} round trips per 1000 users")
+
+    after = sum(user['balance'] for user in db['users'].documents)
+    assert stats['users'] == args.users and after - before == args.users, (stats, after - before)
+    assert len(db['transactions'].documents) == args.users
+    assert all(user['ledger_seq'] == 1 for user in db['users'].documents)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Throughput of handler-style database access as concurrent users grow.
+
+Each simulated user performs conversation steps of one read and one write
+against a collection that blocks for --latency seconds per call. The "blocking"
+mode calls the collection directly from the event loop, like the handlers used
+to; the "repository" mode goes through repository.UserRepository.
+
+Usage: python benchmarks/bench_async_db.py [--latency 0.005] [--steps 5]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fakes import FakeCollection
+from mongo_storage import MongoUserStore
+from repository import UserRepository, create_executor
+
+
+async def blocking_step(collection, user_id):
+    collection.find_one({'user_id': user_id})
+    collection.update_one({'user_id': user_id}, {'$set': {'state': 1}})
+
+
+async def repository_step(repository, user_id):
+    await repository.get(user_id)
+    await repository.update(user_id, {'$set': {'state': 1}})
+
+
+async def run(mode, users, steps, latency, workers):
+    collection = FakeCollection(latency=latency)
+    for user_id in range(users):
+        collection.documents.append({'user_id': user_id, 'state': 0})
+
+    if mode == 'blocking':
+        async def user_flow(user_id):
+            for _ in range(steps):
+                await blocking_step(collection, user_id)
+    else:
+        repository = UserRepository(MongoUserStore(collection), create_executor(workers))
+
+        async def user_flow(user_id):
+            for _ in range(steps):
+                await repository_step(repository, user_id)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user_flow(user_id) for user_id in range(users)))
+    elapsed = time.perf_counter() - started
+    return users * steps / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--latency', type=float, default=0.005, help='seconds each database call blocks')
+    parser.add_argument('--steps', type=int, default=5, help='conversation steps per user')
+    parser.add_argument('--workers', type=int, default=16, help='repository executor threads')
+    parser.add_argument('--users', type=int, nargs='+', default=[1, 10, 50, 100, 200])
+    args = parser.parse_args()
+
+    print(f"latency={args.latency * 1000:.1f}ms steps={args.steps} workers={args.workers}")
+    print(f"{'users':>6} {'blocking steps/s':>18} {'repository steps/s':>20} {'speedup':>8}")
+    for users in args.users:
+        blocking = asyncio.run(run('blocking', users, args.steps, args.latency, args.workers))
+        repository = asyncio.run(run('repository', users, args.steps, args.latency, args.workers))
+        print(f"{users:>6} {blocking:>18.1f} {repository:>20.1f} {repository / blocking:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""Per-update dispatch cost of the conversation.
+
+Replays the recorded conversation for one user. Before each update is
+handled, it measures how long the ConversationHandler takes to pick the
+handler for it: the state lookup, then the CallbackQueryHandler patterns or
+message filters of that state. Then the update is processed normally, so the
+next one is measured in the state it really arrives in.
+
+Usage: python benchmarks/bench_dispatch.py [--repeat 2000]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Update
+from telegram.ext import ApplicationBuilder, ConversationHandler
+
+from benchmarks.bench_webhook import load_recorded_updates
+from benchmarks.fakes import FakeBotRequest
+from handlers import setup_handlers
+from memory_storage import MemoryStorage
+
+
+async def run(repeat):
+    application = ApplicationBuilder().token('123:benchmark').request(FakeBotRequest()).updater(None).build()
+    setup_handlers(application, MemoryStorage())
+    conversation = next(
+        handler for handler in application.handlers[0] if isinstance(handler, ConversationHandler)
+    )
+
+    rows = []
+    async with application:
+        for data in load_recorded_updates():
+            update = Update.de_json(data, application.bot)
+            started = time.perf_counter()
+            for _ in range(repeat):
+                check = conversation.check_update(update)
+            elapsed = (time.perf_counter() - started) / repeat
+            handler = check[2].callback if check else None
+            name = getattr(getattr(handler, 'func', handler), '__name__', '-')
+            label = update.callback_query.data if update.callback_query else update.message.text
+            rows.append((label, name, elapsed))
+            await application.process_update(update)
+
+    print(f"{'update':>44} {'handler':>22} {'dispatch':>10}")
+    for label, name, elapsed in rows:
+        print(f"{label[:44]:>44} {name:>22} {elapsed * 1e6:8.2f}us")
+    print(f"{'mean':>44} {'':>22} {sum(row[2] for row in rows) / len(rows) * 1e6:8.2f}us")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=2000, help='dispatch measurements per update')
+    args = parser.parse_args()
+    asyncio.run(run(args.repeat))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""Rows per second and memory of the user export.
+
+The users and payment_methods collections are simulated: their cursors
+generate --users documents, and two deposit and one withdrawal method per
+user, one at a time, so the memory measured is the export's own. The export is run to a temporary
+directory:
+
+- "load all": every document read into a list first, then written, like an
+  ad-hoc script;
+- "streaming": export.export_users, --batch-size documents at a time;
+- "N workers": export.py's user_id ranges, exported by N processes.
+
+Every run happens in processes of its own. Reported: rows per second and
+the peak RSS of each process. Only CSV is written unless pyarrow is
+installed.
+
+Usage: python benchmarks/bench_export.py [--users 200000] [--batch-size 10000] [--workers 4]
+"""
+import argparse
+import importlib.util
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from export import WRITERS, attach_methods, export_users, peak_rss_mb, range_query, user_id_ranges
+from methods import method_document
+
+
+class GeneratedUsers:
+    """Read-only users collection whose documents are generated as the cursor reaches them."""
+
+    def __init__(self, users):
+        self.users = users
+
+    def find(self, query, projection=None, sort=None, batch_size=0):
+        bounds = query.get('user_id', {})
+        low, high = bounds.get('$gte', 0), bounds.get('$lt', self.users)
+        return ({'user_id': user_id, 'balance': user_id % 1000} for user_id in range(low, high))
+
+    def find_one(self, query, projection=None, sort=None):
+        if not self.users:
+            return None
+        return {'user_id': self.users - 1 if sort and sort[0][1] < 0 else 0}
+
+
+class GeneratedMethods:
+    """Read-only payment_methods collection whose documents are generated as the cursor reaches them."""
+
+    @staticmethod
+    def methods(user_id):
+        yield method_document(user_id, 'deposit', 'Bank', f'bank-{user_id}')
+        yield method_document(user_id, 'deposit', 'Pix', f'pix-{user_id}')
+        yield method_document(user_id, 'withdrawal', 'Crypto (BTC)', f'bc1q{user_id:032d}')
+
+    def find(self, query, projection=None, sort=None):
+        bounds = query['user_id']
+        return (method for user_id in range(bounds['$gte'], bounds['$lte'] + 1) for method in self.methods(user_id))
+
+
+def writers_for(directory, formats, name):
+    return [WRITERS[extension](os.path.join(directory, f'{name}.{extension}')) for extension in formats]
+
+
+def export_all(users, formats, batch_size, load_all, directory):
+    collection = GeneratedUsers(users)
+    writers = writers_for(directory, formats, 'users')
+    started = time.perf_counter()
+    if load_all:
+        documents = list(collection.find({}))
+        attach_methods(GeneratedMethods(), documents)
+        for writer in writers:
+            writer.write(documents)
+        rows = len(documents)
+    else:
+        rows = export_users(collection, GeneratedMethods(), {}, writers, batch_size)
+    for writer in writers:
+        writer.close()
+    return rows, time.perf_counter() - started, peak_rss_mb()
+
+
+def export_range(users, low, high, formats, batch_size, path):
+    started = time.perf_counter()
+    writers = writers_for(os.path.dirname(path), formats, os.path.basename(path))
+    rows = export_users(GeneratedUsers(users), GeneratedMethods(), range_query(low, high), writers, batch_size)
+    for writer in writers:
+        writer.close()
+    return rows, time.perf_counter() - started, peak_rss_mb()
+
+
+def run(tasks):
+    """Runs each (function, *args) task in a process of its own. Returns the rows/s and the highest peak RSS."""
+    started = time.perf_counter()
+    with ProcessPoolExecutor(len(tasks), mp_context=multiprocessing.get_context('spawn')) as pool:
+        results = [future.result() for future in [pool.submit(*task) for task in tasks]]
+    elapsed = time.perf_counter() - started
+    return sum(rows for rows, _, _ in results) / elapsed, max(peak for _, _, peak in results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200000)
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+    formats = ['csv'] + (['parquet'] if importlib.util.find_spec('pyarrow') else [])
+    print(f"{args.users} users, formats: {', '.join(formats)}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        for label, load_all in (('load all', True), ('streaming', False)):
+            rate, peak = run([(export_all, args.users, formats, args.batch_size, load_all, directory)])
+            print(f"{label:>12}: {rate:>9.0f} rows/s  peak RSS {peak:7.1f} MB")
+        ranges = user_id_ranges(GeneratedUsers(args.users), args.workers)
+        rate, peak = run([
+            (export_range, args.users, low, high, formats, args.batch_size, os.path.join(directory, f'part-{index}'))
+            for index, (low, high) in enumerate(ranges)
+        ])
+        print(f"{f'{len(ranges)} workers':>12}: {rate:>9.0f} rows/s  peak RSS {peak:7.1f} MB per process")
+
+
+if __name__ == '__main__':
+    main()
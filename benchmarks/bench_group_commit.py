@@ -0,0 +1,116 @@
+"""Throughput of balance changes with and without group commit.
+
+--users users confirm --confirmations transactions each, all at the same
+time, like a peak of confirmations. Every confirmation is the update
+handlers.confirm commits: conditional on the nonce of the transaction, it
+adds to the balance, advances ledger_seq and stores the nonce of the next
+one. It goes through repository.UserRepository with grouped=True, so a
+window of 0 writes each change on its own, as before group commit, and any
+other window goes through group_commit.GroupCommitter.
+
+Two backends are measured: 'mongo', on a fake collection that blocks for
+--latency seconds per round trip, and 'sqlite', a temporary database file.
+Reported: confirmations per second, p50/p99 latency of a confirmation,
+database round trips (mongo) and the average batch size. Every run checks
+that each balance ends where it should.
+
+Usage: python benchmarks/bench_group_commit.py [--users 500] [--confirmations 5] [--latency 0.002]
+                                               [--workers 16] [--windows 0 0.001 0.002 0.005]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.bench_webhook import percentile
+from benchmarks.fakes import FakeCollection
+from group_commit import DEFAULT_GROUP_COMMIT_SIZE, GroupCommitter
+from mongo_storage import MongoUserStore
+from repository import UserRepository, create_executor
+from sqlite_storage import SQLiteStorage
+
+
+def open_store(backend, directory, users, latency):
+    """Returns the user store, seeded with the users, and the fake collection counting round trips, if any."""
+    documents = [{'user_id': user_id, 'balance': 0, 'ledger_seq': 0, 'temp_data': {'nonce': 0}}
+                 for user_id in range(users)]
+    if backend == 'mongo':
+        collection = FakeCollection()
+        collection.documents.extend(documents)
+        collection.latency = latency
+        return MongoUserStore(collection), collection
+    storage = SQLiteStorage(os.path.join(directory, f'bench-{time.monotonic_ns()}.sqlite3'))
+    for document in documents:
+        storage.users.insert(document)
+    return storage.users, None
+
+
+async def run(backend, directory, window, args):
+    store, collection = open_store(backend, directory, args.users, args.latency)
+    executor = create_executor(args.workers)
+    group_commit = GroupCommitter(store, executor, window, args.batch_size) if window > 0 else None
+    users = UserRepository(store, executor, group_commit)
+    if collection is not None:
+        collection.calls = 0
+    timings = []
+
+    async def confirm(user_id):
+        for nonce in range(args.confirmations):
+            update = {'$inc': {'balance': user_id % 100 + 1, 'ledger_seq': 1}, '$set': {'temp_data.nonce': nonce + 1}}
+            started = time.perf_counter()
+            stored = await users.update_and_get(user_id, update, condition={'temp_data.nonce': nonce}, grouped=True)
+            timings.append(time.perf_counter() - started)
+            assert stored is not None and stored['ledger_seq'] == nonce + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(confirm(user_id) for user_id in range(args.users)))
+    elapsed = time.perf_counter() - started
+    executor.shutdown()
+    round_trips = collection.calls if collection is not None else None
+
+    for user_id in range(args.users):
+        assert store.get(user_id)['balance'] == (user_id % 100 + 1) * args.confirmations, f'user {user_id}'
+    confirmations = args.users * args.confirmations
+    return {
+        'rate': confirmations / elapsed,
+        'p50': percentile(timings, 0.5) * 1000,
+        'p99': percentile(timings, 0.99) * 1000,
+        'round_trips': round_trips / confirmations if round_trips is not None else None,
+        'batch_size': group_commit.stats()['batch_size'] if group_commit is not None else 1.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--confirmations', type=int, default=5, help='confirmations per user')
+    parser.add_argument('--latency', type=float, default=0.002, help='seconds each mongo round trip blocks')
+    parser.add_argument('--workers', type=int, default=16, help='repository executor threads')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_GROUP_COMMIT_SIZE, help='most changes per batch')
+    parser.add_argument('--windows', type=float, nargs='+', default=[0, 0.001, 0.002, 0.005],
+                        help='group commit windows in seconds, 0 for none')
+    args = parser.parse_args()
+
+    print(f"users={args.users} confirmations={args.confirmations} latency={args.latency * 1000:.1f}ms "
+          f"workers={args.workers} batch size={args.batch_size}")
+    print(f"{'backend':>8} {'window':>8} {'confirmations/s':>16} {'p50':>9} {'p99':>9} {'round trips':>12} "
+          f"{'batch':>7} {'speedup':>8}")
+    with tempfile.TemporaryDirectory() as directory:
+        for backend in ('mongo', 'sqlite'):
+            baseline = None
+            for window in args.windows:
+                result = asyncio.run(run(backend, directory, window, args))
+                baseline = baseline or result['rate']
+                round_trips = f"{result['round_trips']:.3f}" if result['round_trips'] is not None else '-'
+                label = f'{window * 1000:.0f}ms' if window > 0 else 'off'
+                print(f"{backend:>8} {label:>8} {result['rate']:>16.0f} {result['p50']:>7.2f}ms "
+                      f"{result['p99']:>7.2f}ms {round_trips:>12} {result['batch_size']:>7.1f} "
+                      f"{result['rate'] / baseline:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""Cost of rendering the inline keyboards.
+
+Compares building each keyboard from scratch on every render, as the handlers
+used to, with the shared static menus and the per-user method keyboard cache
+in keyboards.py. The method keyboard used to list every saved method; the
+cached one is the first page of them. Reports the time and the memory
+allocated per render.
+
+Usage: python benchmarks/bench_keyboards.py [--renders 20000] [--methods 1 10 50]
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from keyboards import CONFIRM, MAIN_MENU, METHOD_TYPES, MethodKeyboardCache
+from methods import METHOD_PAGE_SIZE, encode_cursor, method_document
+
+
+def rebuild_main_menu():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("View Balance", callback_data='view_balance')],
+        [InlineKeyboardButton("Deposit", callback_data='deposit')],
+        [InlineKeyboardButton("Withdraw", callback_data='withdraw')],
+        [InlineKeyboardButton("Transaction History", callback_data='history')]
+    ])
+
+
+def rebuild_method_types():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("Bank Transfer", callback_data='type_bank_deposit')],
+        [InlineKeyboardButton("Paypal", callback_data='type_paypal_deposit')],
+        [InlineKeyboardButton("Crypto", callback_data='type_crypto_deposit')],
+        [InlineKeyboardButton("Cancel", callback_data='cancel_add_deposit_method')]
+    ])
+
+
+def rebuild_confirm():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("Confirm", callback_data='confirm_deposit')],
+        [InlineKeyboardButton("Cancel", callback_data='cancel')]
+    ])
+
+
+def rebuild_methods(methods):
+    keyboard = [[InlineKeyboardButton(m['description'], callback_data=f"deposit_method_{idx}")] for idx, m in enumerate(methods)]
+    keyboard.append([InlineKeyboardButton("Add New Method", callback_data='add_deposit_method')])
+    keyboard.append([InlineKeyboardButton("Cancel", callback_data='cancel')])
+    return InlineKeyboardMarkup(keyboard)
+
+
+def make_methods(count, first=0):
+    return [method_document(1, 'deposit', 'Bank', f'bank {index}') for index in range(first, first + count)]
+
+
+def measure(render, renders):
+    """Returns (microseconds, bytes allocated) per render."""
+    started = time.perf_counter()
+    for _ in range(renders):
+        render()
+    elapsed = time.perf_counter() - started
+
+    # Allocations are measured on a separate, shorter run because tracing slows everything down
+    samples = max(1, renders // 20)
+    keep = []
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for _ in range(samples):
+        keep.append(render())
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return elapsed / renders * 1e6, allocated / samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--renders', type=int, default=20000)
+    parser.add_argument('--methods', type=int, nargs='+', default=[1, 10, 50])
+    args = parser.parse_args()
+
+    cases = [
+        ('main menu', rebuild_main_menu, lambda: MAIN_MENU),
+        ('method types', rebuild_method_types, lambda: METHOD_TYPES['deposit']),
+        ('confirm', rebuild_confirm, lambda: CONFIRM['deposit']),
+    ]
+    for count in args.methods:
+        methods = make_methods(count)
+        cache = MethodKeyboardCache()
+        page = methods[:METHOD_PAGE_SIZE]
+        cache.put(1, 'deposit', page, encode_cursor(page[-1]) if count > METHOD_PAGE_SIZE else None)
+        cases.append((f'{count} methods', lambda methods=methods: rebuild_methods(methods),
+                      lambda cache=cache: cache.get(1, 'deposit')))
+
+        # A method was just added: the cached page is updated instead of rebuilt from every method
+        grown = methods + make_methods(1, count)
+        entry = cache.cache.peek((1, 'deposit'))
+
+        def add_method(cache=cache, entry=entry, method=grown[-1]):
+            cache.cache.put((1, 'deposit'), entry)
+            cache.add(1, 'deposit', method)
+            return cache.get(1, 'deposit')
+
+        cases.append((f'{count} methods + 1', lambda grown=grown: rebuild_methods(grown), add_method))
+
+    print(f"{'keyboard':>16} {'rebuild':>22} {'cached':>22}")
+    for name, rebuild, cached in cases:
+        rebuild_us, rebuild_bytes = measure(rebuild, args.renders)
+        cached_us, cached_bytes = measure(cached, args.renders)
+        print(f"{name:>16} {rebuild_us:8.2f}us {rebuild_bytes:8.0f}B/render {cached_us:8.2f}us {cached_bytes:8.0f}B/render")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+"""Offline load test of the whole bot.
+
+Thousands of synthetic users walk through the bot's flows against the real
+handlers, persistence and repositories, on the MongoDB storage backend. The
+Bot API is answered by FakeBotRequest and every collection is an in-memory
+FakeCollection, both with an optional latency per call, so nothing leaves
+the machine.
+
+The flows run one after the other as phases. In each phase every user sends
+the updates of the flow, interleaved with the other users and in order for
+each user, through the same update queue and PerUserUpdateProcessor as in
+production. Between phases the ledger and the persistence are flushed, so the
+database operations and Bot API calls counted in a phase all belong to its
+flow. Reported per flow:
+
+- updates/s while the phase runs;
+- p50/p95/p99 handler latency: from the moment the Application starts
+  processing an update until every handler is done with it;
+- database round trips and Bot API calls per user.
+
+--metrics turns the Prometheus instrumentation on, to measure its overhead.
+
+--save writes the results to a baseline file; --compare checks a run against
+one and exits with status 1 on a regression. Operation and call counts are
+deterministic and must not grow at all. Throughput and latency may move by
+--tolerance; they are only comparable between runs on the same machine.
+
+Usage: python benchmarks/bench_load.py [--users 2000] [--save FILE] [--compare FILE]
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Update
+from telegram.ext import ApplicationBuilder, TypeHandler
+
+from benchmarks.bench_webhook import percentile
+from benchmarks.fakes import FakeBotRequest, FakeCollection, callback_update, message_update
+from flows import DEPOSIT
+from handlers import setup_handlers
+from methods import hash_method
+from metrics import InstrumentedRequest, Metrics
+from mongo_storage import MongoStorage
+from persistence import StoragePersistence
+from update_processor import PerUserUpdateProcessor
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline_load.json')
+FIRST_USER_ID = 100_000
+
+
+def flows(user_id):
+    """Updates sent by one user, per flow, in the order the phases run."""
+    return {
+        'start': [message_update(user_id, '/start')],
+        'deposit': [
+            callback_update(user_id, 'd:go'),
+            message_update(user_id, str(100 + user_id % 900)),
+            callback_update(user_id, 'd:add'),
+            callback_update(user_id, 'd:t:bank'),
+            message_update(user_id, f'Bank {user_id}'),
+            callback_update(user_id, 'd:ok'),
+        ],
+        'withdrawal': [
+            callback_update(user_id, 'w:go'),
+            message_update(user_id, str(1 + user_id % 50)),
+            callback_update(user_id, 'w:add'),
+            callback_update(user_id, 'w:crypto'),
+            callback_update(user_id, 'w:c:BTC'),
+            message_update(user_id, 'bc1qar0srrr7xfkvy5l643lydnw9re59gtzzwf5mdq'),
+            callback_update(user_id, 'w:ok'),
+        ],
+        # A returning user picks the method saved in the first deposit
+        'saved deposit': [
+            callback_update(user_id, 'd:go'),
+            message_update(user_id, '25'),
+            callback_update(user_id, DEPOSIT.callback('m', hash_method(user_id, 'deposit', 'Bank', f'bank {user_id}'))),
+            callback_update(user_id, 'd:ok'),
+        ],
+        'balance': [callback_update(user_id, 'bal')],
+        'history': [message_update(user_id, '/history')],
+    }
+
+
+def build_application(db, bot_request, concurrency, metrics=None):
+    storage = MongoStorage(db)
+    persistence = StoragePersistence(storage.sessions)
+    application = (
+        ApplicationBuilder()
+        .token('123:benchmark')
+        .request(bot_request if metrics is None else InstrumentedRequest(bot_request, metrics))
+        .get_updates_request(FakeBotRequest())
+        .persistence(persistence)
+        .concurrent_updates(PerUserUpdateProcessor(concurrency))
+        .build()
+    )
+    setup_handlers(application, storage, metrics=metrics)
+    return application
+
+
+async def scrape(port):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(b'GET /metrics HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n')
+    response = await reader.read()
+    writer.close()
+    return response.partition(b'\r\n\r\n')[2].decode()
+
+
+async def run(users, concurrency, db_latency, bot_latency, with_metrics=False):
+    db = {name: FakeCollection(latency=db_latency) for name in
+          ('users', 'settings', 'transactions', 'balance_snapshots', 'payment_methods', 'user_data')}
+    db['conversations'] = FakeCollection(latency=db_latency, index='key')
+    bot_request = FakeBotRequest(latency=bot_latency)
+    metrics = Metrics(port=0) if with_metrics else None
+    application = build_application(db, bot_request, concurrency, metrics)
+
+    started_at = {}
+    latencies = []
+
+    async def record_start(update, context):
+        started_at[update.update_id] = time.perf_counter()
+
+    async def record_finish(update, context):
+        latencies.append(time.perf_counter() - started_at.pop(update.update_id))
+
+    # Group -1 runs before the conversation handler in group 0, group 1 after it
+    application.add_handler(TypeHandler(Update, record_start), group=-1)
+    application.add_handler(TypeHandler(Update, record_finish), group=1)
+
+    per_user = [flows(FIRST_USER_ID + index) for index in range(users)]
+    results = {}
+    async with application:
+        await application.start()
+        if metrics is not None:
+            await metrics.start(application)
+        for name in per_user[0]:
+            user_updates = [Update.de_json(update, application.bot)
+                            for user in per_user for update in user[name]]
+            steps = len(per_user[0][name])
+            # Step by step across users, each user's own updates stay in order
+            updates = [user_updates[index * steps + step] for step in range(steps) for index in range(users)]
+            # Keep the collector from rescanning the prepared updates, which makes latencies noisy
+            gc.collect()
+            gc.freeze()
+
+            latencies.clear()
+            db_calls = sum(collection.calls for collection in db.values())
+            bot_calls = len(bot_request.calls)
+            started = time.perf_counter()
+            for update in updates:
+                await application.update_queue.put(update)
+            await application.update_queue.join()
+            while len(latencies) < len(updates):
+                await asyncio.sleep(0.001)
+            elapsed = time.perf_counter() - started
+            await application.bot_data['ledger'].flush()
+            await application.update_persistence()
+            await application.persistence.flush()
+
+            endpoints = {}
+            for endpoint, _ in bot_request.calls[bot_calls:]:
+                endpoints[endpoint] = endpoints.get(endpoint, 0) + 1
+            results[name] = {
+                'updates': len(updates),
+                'updates_per_s': round(len(updates) / elapsed, 1),
+                'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+                'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+                'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+                'db_ops_per_user': round((sum(collection.calls for collection in db.values()) - db_calls) / users, 2),
+                'bot_calls_per_user': round((len(bot_request.calls) - bot_calls) / users, 2),
+                'bot_calls': {endpoint: round(count / users, 2) for endpoint, count in sorted(endpoints.items())},
+            }
+        if metrics is not None:
+            exposition = await scrape(metrics.port)
+            await metrics.stop()
+            samples = [line for line in exposition.splitlines() if not line.startswith('#')]
+            print(f"Scraped {len(samples)} samples ({len(exposition)} bytes) from the metrics endpoint")
+        await application.stop()
+
+    balances = [document['balance'] for document in db['users'].documents]
+    expected = sum(100 + user_id % 900 - (1 + user_id % 50) + 25
+                   for user_id in range(FIRST_USER_ID, FIRST_USER_ID + users))
+    if sum(balances) != expected:
+        raise RuntimeError(f"Final balances add up to {sum(balances)} instead of {expected}")
+    return results
+
+
+def report(results):
+    print(f"{'flow':>14} {'updates':>8} {'updates/s':>10} {'p50':>9} {'p95':>9} {'p99':>9} "
+          f"{'DB ops':>7} {'Bot API':>8}  Bot API calls per user")
+    for name, result in results.items():
+        print(
+            f"{name:>14} {result['updates']:>8} {result['updates_per_s']:>10.0f} {result['p50_ms']:>7.2f}ms "
+            f"{result['p95_ms']:>7.2f}ms {result['p99_ms']:>7.2f}ms {result['db_ops_per_user']:>7.2f} "
+            f"{result['bot_calls_per_user']:>8.2f}  {json.dumps(result['bot_calls'])}"
+        )
+
+
+def compare(results, baseline, tolerance):
+    """Returns the regressions of a run against a baseline."""
+    regressions = []
+    for name, before in baseline['flows'].items():
+        after = results.get(name)
+        if after is None:
+            regressions.append(f"{name}: flow missing")
+            continue
+        for key in ('db_ops_per_user', 'bot_calls_per_user'):
+            if after[key] > before[key]:
+                regressions.append(f"{name}: {key} {before[key]} -> {after[key]}")
+        if after['updates_per_s'] < before['updates_per_s'] * (1 - tolerance):
+            regressions.append(f"{name}: updates_per_s {before['updates_per_s']} -> {after['updates_per_s']}")
+        for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+            if after[key] > before[key] * (1 + tolerance):
+                regressions.append(f"{name}: {key} {before[key]} -> {after[key]}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=64, help='updates processed at the same time')
+    parser.add_argument('--db-latency', type=float, default=0.0, help='seconds each database call blocks')
+    parser.add_argument('--bot-latency', type=float, default=0.02, help='seconds each fake Bot API call takes')
+    parser.add_argument('--metrics', action='store_true', help='turn the Prometheus instrumentation on')
+    parser.add_argument('--save', nargs='?', const=DEFAULT_BASELINE, help='write the results to a baseline file')
+    parser.add_argument('--compare', nargs='?', const=DEFAULT_BASELINE, help='check the results against a baseline')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='relative throughput and latency change allowed by --compare')
+    args = parser.parse_args()
+
+    settings = {'users': args.users, 'concurrency': args.concurrency, 'db_latency': args.db_latency,
+                'bot_latency': args.bot_latency, 'metrics': args.metrics}
+    results = asyncio.run(run(args.users, args.concurrency, args.db_latency, args.bot_latency, args.metrics))
+    report(results)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'settings': settings, 'flows': results}, f, indent=2)
+            f.write('\n')
+        print(f"Baseline written to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline['settings'] != settings:
+            print(f"Warning: the baseline was recorded with {baseline['settings']}")
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regression against {args.compare}")
+
+
+if __name__ == '__main__':
+    main()
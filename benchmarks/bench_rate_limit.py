@@ -0,0 +1,137 @@
+"""A crowd arriving at once against a Bot API that enforces flood limits.
+
+Half of --users users are on the deposit confirmation screen and press
+Confirm, the other half are on the main menu and press View Balance, all at
+the same moment.
+The Bot API is FloodControlBotRequest, which answers 429 like Telegram when
+the overall or per-chat limits are exceeded (and, with --flood-probability,
+at random on top of that).
+
+The crowd is run twice: with no rate limiter, as the bot used to run, and
+with rate_limiter.PriorityRateLimiter. Reported per kind of update: how long
+it took from arrival until its handler was done, and how many replies were
+lost to a 429.
+
+Usage: python benchmarks/bench_rate_limit.py [--users 300] [--rate 30] [--flood-probability 0.01]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Update
+from telegram.error import RetryAfter
+from telegram.ext import ApplicationBuilder, TypeHandler
+
+from benchmarks.bench_webhook import percentile
+from benchmarks.fakes import FakeBotRequest, FakeCollection, FloodControlBotRequest, callback_update
+from flows import CONFIRM, DEPOSIT, MAIN_MENU
+from handlers import setup_handlers
+from methods import method_document, method_fields
+from mongo_storage import MongoStorage
+from persistence import StoragePersistence
+from rate_limiter import PriorityRateLimiter
+from update_processor import PerUserUpdateProcessor
+
+FIRST_USER_ID = 100_000
+
+
+def seed(db, users):
+    """Puts every other user on the deposit confirmation screen, the others on the main menu."""
+    for index, user_id in enumerate(range(FIRST_USER_ID, FIRST_USER_ID + users)):
+        state = DEPOSIT.state(CONFIRM) if index % 2 == 0 else MAIN_MENU
+        method = method_document(user_id, 'deposit', 'Bank', 'bank')
+        db['payment_methods'].documents.append(method)
+        db['users'].documents.append({
+            'user_id': user_id, 'balance': 0,
+            'temp_data': {'transaction_value': 10, 'selected_method': method_fields(method)},
+        })
+        db['conversations'].documents.append({'name': 'main_conversation', 'key': [user_id, user_id], 'state': state})
+        db['user_data'].documents.append({'user_id': user_id, 'data': {'state': state}})
+
+
+async def run(users, limited, rate, chat_rate, chat_burst, flood_probability, latency, concurrency):
+    db = {name: FakeCollection() for name in
+          ('users', 'settings', 'transactions', 'balance_snapshots', 'payment_methods', 'user_data')}
+    db['conversations'] = FakeCollection(index='key')
+    seed(db, users)
+    storage = MongoStorage(db)
+
+    bot_request = FloodControlBotRequest(latency, rate, chat_rate, chat_burst, flood_probability)
+    builder = (
+        ApplicationBuilder()
+        .token('123:benchmark')
+        .request(bot_request)
+        .get_updates_request(FakeBotRequest())
+        .persistence(StoragePersistence(storage.sessions))
+        .concurrent_updates(PerUserUpdateProcessor(concurrency))
+    )
+    if limited:
+        builder = builder.rate_limiter(PriorityRateLimiter(rate, chat_rate, chat_burst))
+    application = builder.build()
+    setup_handlers(application, storage)
+
+    kinds = {}
+    finished = {}
+    lost = {}
+
+    async def record_finish(update, context):
+        finished[update.update_id] = time.perf_counter()
+
+    async def record_error(update, context):
+        if isinstance(context.error, RetryAfter):
+            kind = kinds[update.update_id]
+            lost[kind] = lost.get(kind, 0) + 1
+
+    application.add_handler(TypeHandler(Update, record_finish), group=1)
+    application.add_error_handler(record_error)
+
+    updates = []
+    for index, user_id in enumerate(range(FIRST_USER_ID, FIRST_USER_ID + users)):
+        kind, data = ('confirm', DEPOSIT.callback('ok')) if index % 2 == 0 else ('menu', 'bal')
+        update = Update.de_json(callback_update(user_id, data), application.bot)
+        kinds[update.update_id] = kind
+        updates.append(update)
+
+    async with application:
+        await application.start()
+        started = time.perf_counter()
+        for update in updates:
+            await application.update_queue.put(update)
+        await application.update_queue.join()
+        while len(finished) < len(updates):
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - started
+        await application.stop()
+
+    print(f"{'rate limiter' if limited else 'no rate limiter'}: {len(updates)} updates in {elapsed:.1f}s, "
+          f"{bot_request.refused} requests answered with 429")
+    for kind in ('confirm', 'menu'):
+        durations = [finished[update_id] - started for update_id, value in kinds.items() if value == kind]
+        print(f"  {kind:>8}: done after p50 {percentile(durations, 0.5):6.2f}s  p95 {percentile(durations, 0.95):6.2f}s  "
+              f"max {max(durations):6.2f}s  replies lost {lost.get(kind, 0)}")
+    if limited:
+        limiter = application.bot.rate_limiter
+        print(f"  requests retried after a 429: {limiter.retried}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--rate', type=float, default=30, help='messages per second allowed overall')
+    parser.add_argument('--chat-rate', type=float, default=1, help='messages per second allowed per chat')
+    parser.add_argument('--chat-burst', type=int, default=3, help='messages a chat may receive at once')
+    parser.add_argument('--flood-probability', type=float, default=0.01, help='share of random 429 answers')
+    parser.add_argument('--bot-latency', type=float, default=0.02, help='seconds each fake Bot API call takes')
+    parser.add_argument('--concurrency', type=int, default=256, help='updates processed at the same time')
+    args = parser.parse_args()
+    for limited in (False, True):
+        asyncio.run(run(args.users, limited, args.rate, args.chat_rate, args.chat_burst, args.flood_probability,
+                        args.bot_latency, args.concurrency))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Multi-core throughput of the supervisor mode.
+
+Runs the recorded conversation for --users users through a Supervisor with
+1, 2, 4, ... worker processes. Each worker runs the real handlers against a
+fake Bot API and its own in-memory collections, which is valid because shards
+never share users. Throughput is measured from the first routed update until
+every worker has drained its queue, so worker start-up is not counted.
+
+Usage: python benchmarks/bench_scaleout.py [--users 500] [--workers 1 2 4]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram.ext import ApplicationBuilder
+
+from benchmarks.bench_webhook import load_recorded_updates, readdress
+from benchmarks.fakes import FakeBotRequest
+from handlers import setup_handlers
+from memory_storage import MemoryStorage
+from supervisor import Supervisor, routing_user_id, shard_for
+from update_processor import PerUserUpdateProcessor
+
+
+def build_benchmark_application(index, shards):
+    """Worker application served by in-memory stand-ins (module level so spawned workers can import it)."""
+    application = (
+        ApplicationBuilder()
+        .token('123:benchmark')
+        .request(FakeBotRequest())
+        .updater(None)
+        .concurrent_updates(PerUserUpdateProcessor(64))
+        .build()
+    )
+    setup_handlers(application, MemoryStorage())
+    return application
+
+
+def run(workers, users):
+    recorded = load_recorded_updates()
+    flows = [readdress(recorded, 10_000 + index, index * len(recorded)) for index in range(users)]
+    # Interleave the users step by step, each user's updates stay in order
+    updates = [flow[step] for step in range(len(recorded)) for flow in flows]
+
+    supervisor = Supervisor(build_benchmark_application, workers)
+    supervisor.start()
+    if not supervisor.wait_ready(timeout=60):
+        raise RuntimeError("Workers did not start in time")
+
+    started = time.perf_counter()
+    for update in updates:
+        supervisor.route(update)
+    supervisor.stop(timeout=600)
+    elapsed = time.perf_counter() - started
+    routed = [0] * workers
+    for update in updates:
+        routed[shard_for(routing_user_id(update), workers)] += 1
+    return len(updates) / elapsed, routed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} CPUs, {args.users} users, {len(load_recorded_updates())} updates per user")
+    print(f"{'workers':>8} {'updates/s':>10} {'scaling':>8}  updates per worker")
+    baseline = None
+    for workers in args.workers:
+        throughput, routed = run(workers, args.users)
+        baseline = baseline or throughput
+        print(f"{workers:>8} {throughput:>10.0f} {throughput / baseline:>7.2f}x  {json.dumps(routed)}")
+
+    # Show how few users move when a worker is added
+    moved = sum(shard_for(user_id, 4) != shard_for(user_id, 5) for user_id in range(100_000))
+    print(f"Growing from 4 to 5 workers moves {moved / 1000:.1f}% of users (ideal 20%)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""Latency of each storage operation, on every storage backend.
+
+The same operations, with the same arguments, run against each backend of
+storage.py: 'memory', 'sqlite' (a temporary file) and, with --mongo-uri,
+'mongo' (a bench_storage database, dropped afterwards). --users users are
+created first, with a saved method and a ledger of --entries transactions
+each. Then every operation is called --ops times, one call at a time, on
+users picked at random:
+
+- user get, update (what UserSession.commit sends), update_and_get, a
+  conditional update that does not apply, and the upsert of /start;
+- setting get and set;
+- the persistence's write of 100 conversation states;
+- a ledger batch of 100 entries, a history page, and a balance replay
+  (latest snapshot and the entries after it);
+- a method page and the add of a method the user already has.
+
+Reported: p50 and p99 microseconds per call. Finally, "concurrent step" runs
+a get and an update per step from --threads threads at once, like the
+executor of the repositories, and reports steps per second.
+
+Usage: python benchmarks/bench_storage.py [--users 2000] [--ops 2000] [--entries 30] [--threads 16]
+                                          [--mongo-uri mongodb://localhost:27017]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.bench_webhook import percentile
+from ledger import MILLISECOND, ledger_entry, ledger_now, ledger_snapshots
+from memory_storage import MemoryStorage
+from methods import METHOD_PAGE_SIZE, method_document
+from storage import USER_DEFAULTS
+from sqlite_storage import SQLiteStorage
+
+
+def seed(storage, users, entries):
+    started = ledger_now() - timedelta(days=1)
+    for user_id in range(users):
+        storage.users.update_and_get(user_id, {'$setOnInsert': USER_DEFAULTS}, upsert=True)
+        storage.methods.add(method_document(user_id, 'deposit', 'Bank', f'bank {user_id}'))
+    ledger, snapshots = [], []
+    for seq in range(1, entries + 1):
+        for user_id in range(users):
+            user = {'user_id': user_id, 'ledger_seq': seq, 'ledger_ts': started + seq * MILLISECOND, 'balance': seq}
+            entry = ledger_entry(user, 'deposit', 1)
+            ledger.append(entry)
+            snapshots.extend(ledger_snapshots(entry, snapshot_every=10))
+    for start in range(0, len(ledger), 1000):
+        storage.ledger.insert_entries(ledger[start:start + 1000])
+    storage.ledger.insert_snapshots(snapshots)
+    storage.users.update_and_get(0, {'$set': {'ledger_seq': entries}})
+
+
+def operations(users, entries):
+    """(name, function(storage, rng)) of every operation measured."""
+    step = {'$set': {'temp_data.amount': 100, 'temp_data.selected_method': {'type': 'Bank'}}}
+    counter = iter(range(10 ** 9))
+
+    def ledger_batch(storage, rng):
+        # New seq numbers each time, so every entry is written
+        seq = entries + 1 + next(counter)
+        ts = ledger_now()
+        storage.ledger.insert_entries([
+            ledger_entry({'user_id': user_id, 'ledger_seq': seq, 'ledger_ts': ts, 'balance': seq}, 'deposit', 1)
+            for user_id in rng.sample(range(users), min(100, users))
+        ])
+
+    def replay(storage, rng):
+        user_id = rng.randrange(users)
+        snapshot = storage.ledger.latest_snapshot(user_id)
+        storage.ledger.entries_after(user_id, snapshot['ts'], snapshot['seq'])
+
+    def conversations(storage, rng):
+        now = ledger_now()
+        storage.sessions.write_conversations({
+            ('main_conversation', (user_id, user_id)): (rng.randrange(1, 10), now)
+            for user_id in rng.sample(range(users), min(100, users))
+        })
+
+    return [
+        ('user get', lambda storage, rng: storage.users.get(rng.randrange(users))),
+        ('user update', lambda storage, rng: storage.users.update(rng.randrange(users), step)),
+        ('user update_and_get', lambda storage, rng: storage.users.update_and_get(
+            rng.randrange(users), {'$inc': {'balance': 1}, '$set': {'temp_data': {}}})),
+        ('user update, unmet', lambda storage, rng: storage.users.update(
+            rng.randrange(users), step, {'temp_data.nonce': 'stale'})),
+        ('user upsert', lambda storage, rng: storage.users.update_and_get(
+            users + next(counter), {'$setOnInsert': USER_DEFAULTS}, upsert=True)),
+        ('setting get', lambda storage, rng: storage.settings.get('restart_chat_id')),
+        ('setting set', lambda storage, rng: storage.settings.set('restart_chat_id', rng.randrange(users))),
+        ('100 conversations', conversations),
+        ('100 ledger entries', ledger_batch),
+        ('history page', lambda storage, rng: storage.ledger.history(rng.randrange(users), None, 11)),
+        ('balance replay', replay),
+        ('method page', lambda storage, rng: storage.methods.page(
+            rng.randrange(users), 'deposit', None, METHOD_PAGE_SIZE + 1)),
+        ('method add, known', lambda storage, rng: storage.methods.add(
+            method_document(rng.randrange(users), 'deposit', 'Bank', 'bank 0'))),
+    ]
+
+
+def measure(storage, function, ops, seed_value):
+    rng = random.Random(seed_value)
+    timings = []
+    for _ in range(ops):
+        started = time.perf_counter()
+        function(storage, rng)
+        timings.append(time.perf_counter() - started)
+    return percentile(timings, 0.5) * 1e6, percentile(timings, 0.99) * 1e6
+
+
+def concurrent_steps(storage, users, steps, threads):
+    update = {'$set': {'temp_data.amount': 100}, '$inc': {'balance': 1}}
+
+    def run(index):
+        rng = random.Random(index)
+        for _ in range(steps // threads):
+            user_id = rng.randrange(users)
+            storage.users.get(user_id)
+            storage.users.update(user_id, update)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(run, range(threads)))
+    return steps // threads * threads / (time.perf_counter() - started)
+
+
+def open_backends(directory, mongo_uri):
+    yield 'memory', MemoryStorage()
+    yield 'sqlite', SQLiteStorage(os.path.join(directory, 'bench.sqlite3'))
+    if mongo_uri:
+        # Only imported when asked for, so the benchmark runs without a MongoDB deployment
+        from pymongo import MongoClient
+        from mongo_storage import MongoStorage
+        client = MongoClient(mongo_uri)
+        client.drop_database('bench_storage')
+        storage = MongoStorage(client['bench_storage'], client)
+        storage.bootstrap()
+        yield 'mongo', storage
+        client.drop_database('bench_storage')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--ops', type=int, default=2000, help='calls per operation')
+    parser.add_argument('--entries', type=int, default=30, help='ledger entries per user')
+    parser.add_argument('--threads', type=int, default=16, help='threads of the concurrent step')
+    parser.add_argument('--mongo-uri', help='also measure the MongoDB backend on this deployment')
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, storage in open_backends(directory, args.mongo_uri):
+            seed(storage, args.users, args.entries)
+            results[name] = {
+                operation: measure(storage, function, args.ops, index)
+                for index, (operation, function) in enumerate(operations(args.users, args.entries))
+            }
+            results[name]['concurrent step'] = concurrent_steps(storage, args.users, args.ops * 4, args.threads)
+            storage.close()
+
+    backends = list(results)
+    print(f"{args.users} users, {args.entries} ledger entries each; p50 / p99 microseconds per call")
+    print(f"{'operation':>20}" + ''.join(f"{backend:>22}" for backend in backends))
+    for operation in results[backends[0]]:
+        if operation == 'concurrent step':
+            continue
+        cells = ''.join(f"{results[backend][operation][0]:>10.1f} /{results[backend][operation][1]:>9.1f}"
+                        for backend in backends)
+        print(f"{operation:>20}{cells}")
+    cells = ''.join(f"{results[backend]['concurrent step']:>16.0f} steps/s" for backend in backends)
+    print(f"{'concurrent step':>20}{cells}")
+
+
+if __name__ == '__main__':
+    main()
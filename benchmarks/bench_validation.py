@@ -0,0 +1,122 @@
+"""Cost per detail of the method validators.
+
+For each kind of detail, --count valid ones are generated at random (BTC
+addresses with Base58Check and Bech32/Bech32m checksums, EIP-55 ETH
+addresses, TRC-20 addresses, emails). Each set is validated:
+
+- "first check": with the memo cleared, so every checksum is computed;
+- "memoized": the same details again, answered from the memo;
+- "batch": validation.validate_details() on the whole set, memo cleared,
+  as revalidate_methods() runs it on each batch of stored methods.
+
+Reported: microseconds per detail. Every generated detail must be valid,
+and the same detail with one character changed must not. ETH addresses are
+hashed in pure Python unless pycryptodome is installed.
+
+Usage: python benchmarks/bench_validation.py [--count 20000]
+"""
+import argparse
+import hashlib
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from validation import (
+    BASE58_ALPHABET, BECH32_CHARSET, BECH32_CONSTANT, BECH32M_CONSTANT, BITCOIN_HRP, TRON_VERSION, _bech32_polymod,
+    eip55_checksum, validate_detail, validate_details
+)
+
+
+def base58check(version, payload):
+    raw = bytes([version]) + payload
+    raw += hashlib.sha256(hashlib.sha256(raw).digest()).digest()[:4]
+    number = int.from_bytes(raw, 'big')
+    text = ''
+    while number:
+        number, digit = divmod(number, 58)
+        text = BASE58_ALPHABET[digit] + text
+    return '1' * (len(raw) - len(raw.lstrip(b'\0'))) + text
+
+
+def segwit(version, program):
+    data = [version]
+    accumulator = bits = 0
+    for byte in program:
+        accumulator = accumulator << 8 | byte
+        bits += 8
+        while bits >= 5:
+            bits -= 5
+            data.append(accumulator >> bits & 31)
+    if bits:
+        data.append(accumulator << (5 - bits) & 31)
+    expanded = [ord(char) >> 5 for char in BITCOIN_HRP] + [0] + [ord(char) & 31 for char in BITCOIN_HRP]
+    constant = BECH32_CONSTANT if version == 0 else BECH32M_CONSTANT
+    checksum = _bech32_polymod(expanded + data + [0] * 6) ^ constant
+    data += [checksum >> 5 * (5 - index) & 31 for index in range(6)]
+    return BITCOIN_HRP + '1' + ''.join(BECH32_CHARSET[value] for value in data)
+
+
+def generate(kind, rng):
+    if kind == 'BTC base58':
+        return 'Crypto (BTC)', base58check(rng.choice((0x00, 0x05)), rng.randbytes(20))
+    if kind == 'BTC bech32':
+        if rng.random() < 0.5:
+            return 'Crypto (BTC)', segwit(0, rng.randbytes(rng.choice((20, 32))))
+        return 'Crypto (BTC)', segwit(1, rng.randbytes(32))
+    if kind == 'ETH EIP-55':
+        return 'Crypto (ETH)', eip55_checksum('0x' + rng.randbytes(20).hex())
+    if kind == 'USDT TRC-20':
+        return 'Crypto (USDT)', base58check(TRON_VERSION, rng.randbytes(20))
+    name = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz0123456789') for _ in range(12))
+    return 'Paypal', f"{name[:5]}.{name[5:]}@example{rng.randrange(1000)}.com"
+
+
+def mutate(detail, rng):
+    """The detail with one character replaced, which every checksum catches."""
+    index = rng.randrange(len(detail) - 8, len(detail))
+    alphabet = BECH32_CHARSET if detail.startswith(BITCOIN_HRP + '1') else BASE58_ALPHABET
+    replacement = rng.choice([char for char in alphabet if char != detail[index]])
+    return detail[:index] + replacement + detail[index + 1:]
+
+
+def per_detail(function, details):
+    started = time.perf_counter()
+    function(details)
+    return (time.perf_counter() - started) / len(details) * 1e6
+
+
+def check_each(details):
+    for method_type, detail in details:
+        validate_detail(method_type, detail)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=20000)
+    args = parser.parse_args()
+    rng = random.Random(1)
+
+    print(f"{'detail':>12} {'first check':>14} {'memoized':>12} {'batch':>12}")
+    for kind in ('BTC base58', 'BTC bech32', 'ETH EIP-55', 'USDT TRC-20', 'email'):
+        details = [generate(kind, rng) for _ in range(args.count)]
+        validate_detail.cache_clear()
+        first = per_detail(check_each, details)
+        memoized = per_detail(check_each, details)
+        validate_detail.cache_clear()
+        batch = per_detail(validate_details, details)
+        print(f"{kind:>12} {first:>12.2f}us {memoized:>10.2f}us {batch:>10.2f}us")
+
+        rejected = [(detail, error) for detail, (stored, error) in zip(details, validate_details(details)) if error]
+        assert not rejected, rejected[:3]
+        if kind != 'email':
+            mutated = [(method_type, mutate(detail, rng)) for method_type, detail in details[:1000]]
+            accepted = [detail for (_, detail), (stored, _) in zip(mutated, validate_details(mutated)) if stored]
+            # A changed ETH digit goes unnoticed when the case of every letter happens to match the new checksum
+            assert len(accepted) <= len(mutated) // 100, accepted[:3]
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+"""Replays recorded updates against the webhook server over local HTTP.
+
+The recorded conversation in recorded_updates.jsonl is re-addressed to
+--users different users, and each user POSTs its updates in order over a
+keep-alive connection, like Telegram does. The bot runs the real handlers
+against FakeBotRequest and in-memory collections, so nothing leaves the
+machine. Reported latencies:
+
+- ack: from sending the POST to receiving the HTTP response;
+- end-to-end: from sending the POST until the handlers finished the update.
+
+Usage: python benchmarks/bench_webhook.py [--users 200] [--queue-size 1000]
+"""
+import argparse
+import asyncio
+import copy
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Update
+from telegram.ext import ApplicationBuilder, TypeHandler
+
+from benchmarks.fakes import FakeBotRequest
+from handlers import setup_handlers
+from memory_storage import MemoryStorage
+from update_processor import PerUserUpdateProcessor
+from webhook import WebhookServer
+
+RECORDED_UPDATES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'recorded_updates.jsonl')
+SECRET_TOKEN = 'benchmark-secret'
+
+
+def load_recorded_updates():
+    with open(RECORDED_UPDATES) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def readdress(recorded, user_id, first_update_id):
+    """Copies the recorded updates for another user, with fresh update ids."""
+    updates = []
+    for offset, update in enumerate(recorded):
+        update = copy.deepcopy(update)
+        update['update_id'] = first_update_id + offset
+        for key in ('message', 'callback_query'):
+            if key in update:
+                update[key]['from']['id'] = user_id
+                chat = update[key]['chat'] if key == 'message' else update[key]['message']['chat']
+                chat['id'] = user_id
+        updates.append(update)
+    return updates
+
+
+class KeepAliveClient:
+    """Minimal HTTP/1.1 client that POSTs JSON over one persistent connection."""
+
+    def __init__(self, host, port, path, headers):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.headers = ''.join(f"{name}: {value}\r\n" for name, value in headers.items())
+        self.reader = None
+        self.writer = None
+
+    async def post(self, payload):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        body = json.dumps(payload).encode()
+        self.writer.write(
+            f"POST {self.path} HTTP/1.1\r\nHost: {self.host}\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n{self.headers}\r\n".encode() + body
+        )
+        await self.writer.drain()
+        status = int((await self.reader.readline()).split()[1])
+        keep_alive = True
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            if line.lower().startswith(b'connection:') and b'close' in line.lower():
+                keep_alive = False
+        if not keep_alive:
+            await self.close()
+        return status
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def run(users, queue_size, concurrency, bot_latency):
+    application = (
+        ApplicationBuilder()
+        .token('123:benchmark')
+        .request(FakeBotRequest(latency=bot_latency))
+        .get_updates_request(FakeBotRequest())
+        .concurrent_updates(PerUserUpdateProcessor(concurrency))
+        .update_queue(asyncio.Queue(maxsize=queue_size))
+        .build()
+    )
+    setup_handlers(application, MemoryStorage())
+
+    finished = {}
+
+    async def record_finish(update, context):
+        finished[update.update_id] = time.perf_counter()
+
+    # Group 1 runs after the conversation handler in group 0 is done with the update
+    application.add_handler(TypeHandler(Update, record_finish), group=1)
+
+    recorded = load_recorded_updates()
+    flows = [readdress(recorded, 10_000 + index, index * len(recorded)) for index in range(users)]
+    sent = {}
+    ack_latencies = []
+    statuses = {}
+
+    server = WebhookServer(application, '127.0.0.1', 0, '/webhook', SECRET_TOKEN)
+    async with application:
+        await application.start()
+        await server.start()
+        headers = {'X-Telegram-Bot-Api-Secret-Token': SECRET_TOKEN}
+
+        async def post_flow(updates):
+            client = KeepAliveClient('127.0.0.1', server.port, '/webhook', headers)
+            try:
+                for update in updates:
+                    started = time.perf_counter()
+                    sent[update['update_id']] = started
+                    status = await client.post(update)
+                    ack_latencies.append(time.perf_counter() - started)
+                    statuses[status] = statuses.get(status, 0) + 1
+            finally:
+                await client.close()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(post_flow(flow) for flow in flows))
+        await application.update_queue.join()
+        while len(finished) < statuses.get(200, 0):
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - started
+
+        await server.stop()
+        await application.stop()
+
+    end_to_end = [finished[update_id] - sent[update_id] for update_id in finished]
+    total = sum(statuses.values())
+    print(f"{users} users, {total} updates in {elapsed:.2f}s ({total / elapsed:.0f} updates/s), statuses {statuses}")
+    for name, values in (('ack', ack_latencies), ('end-to-end', end_to_end)):
+        print(
+            f"  {name:>10}: p50 {percentile(values, 0.5) * 1000:7.2f}ms  p95 {percentile(values, 0.95) * 1000:7.2f}ms  "
+            f"p99 {percentile(values, 0.99) * 1000:7.2f}ms  mean {statistics.mean(values) * 1000:7.2f}ms"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--queue-size', type=int, default=1000, help='bounded intake queue size')
+    parser.add_argument('--concurrency', type=int, default=64, help='updates processed at the same time')
+    parser.add_argument('--bot-latency', type=float, default=0.0, help='seconds each fake Bot API call takes')
+    args = parser.parse_args()
+    asyncio.run(run(args.users, args.queue_size, args.concurrency, args.bot_latency))
+
+
+if __name__ == '__main__':
+    main()
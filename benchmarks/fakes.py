@@ -0,0 +1,391 @@
+"""In-memory stand-ins used by the benchmarks.
+
+FakeCollection implements the subset of the pymongo Collection API the bot uses.
+An optional latency makes every call block like a real network round trip.
+Queries fixing the indexed field (user_id by default) only scan the documents
+with that value, so large benchmarks do not measure linear scans of the fake.
+
+FakeBotRequest replaces the HTTP layer of telegram.Bot and answers Bot API
+methods locally, so a real Application can run without network access.
+FloodControlBotRequest also enforces Telegram-like flood limits and answers
+429 Too Many Requests like the real API.
+"""
+import asyncio
+import copy
+import itertools
+import json
+import math
+import random
+import threading
+import time
+
+from pymongo import DeleteOne
+from telegram.request import BaseRequest
+
+from repository import apply_update, resolve_path
+
+
+OPERATORS = {
+    '$lt': lambda value, bound: value is not None and value < bound,
+    '$lte': lambda value, bound: value is not None and value <= bound,
+    '$gt': lambda value, bound: value is not None and value > bound,
+    '$gte': lambda value, bound: value is not None and value >= bound,
+    '$ne': lambda value, bound: value != bound,
+    '$in': lambda value, bound: value in bound,
+    '$exists': lambda value, bound: (value is not None) == bound,
+}
+
+
+def _matches(document, query):
+    for path, expected in query.items():
+        if path == '$or':
+            if not any(_matches(document, clause) for clause in expected):
+                return False
+            continue
+        if path == '$and':
+            if not all(_matches(document, clause) for clause in expected):
+                return False
+            continue
+        parent, key = resolve_path(document, path)
+        value = parent.get(key) if parent is not None else None
+        if isinstance(expected, dict) and expected and all(name.startswith('$') for name in expected):
+            if not all(OPERATORS[name](value, bound) for name, bound in expected.items()):
+                return False
+        elif value != expected:
+            return False
+    return True
+
+
+def _sorted(documents, sort):
+    for path, direction in reversed(sort or []):
+        documents.sort(key=lambda document: resolve_path(document, path)[0].get(path.split('.')[-1]),
+                       reverse=direction < 0)
+    return documents
+
+
+def _project(document, projection):
+    if not projection:
+        return copy.deepcopy(document)
+    projected = {key: copy.deepcopy(value) for key, value in document.items() if key == '_id' or projection.get(key)}
+    for path, included in projection.items():
+        if included and '.' in path:
+            parent, key = resolve_path(document, path)
+            if parent is not None and key in parent:
+                target, leaf = resolve_path(projected, path, create=True)
+                target[leaf] = copy.deepcopy(parent[key])
+    return projected
+
+
+class FakeResult:
+    def __init__(self, matched_count=0, modified_count=0, upserted_id=None, inserted_id=None, deleted_count=0):
+        self.matched_count = matched_count
+        self.modified_count = modified_count
+        self.upserted_id = upserted_id
+        self.inserted_id = inserted_id
+        self.deleted_count = deleted_count
+
+
+def _hashable(value):
+    return tuple(value) if isinstance(value, list) else value
+
+
+class FakeCollection:
+    """Thread-safe in-memory collection with an optional blocking latency per call."""
+
+    def __init__(self, latency=0.0, index='user_id'):
+        self.latency = latency
+        self.index = index
+        self.documents = []
+        self.calls = 0
+        self._lock = threading.Lock()
+        self._indexed = {}
+        self._indexed_count = 0
+
+    def _candidates(self, query):
+        """Documents that can match the query, narrowed by the index when the query fixes its field."""
+        value = query.get(self.index)
+        values = [value]
+        if isinstance(value, dict) and list(value) == ['$in']:
+            values = value['$in']
+        elif value is None or isinstance(value, dict):
+            return self.documents
+        # Benchmarks may fill self.documents directly; the index then catches up here
+        if self._indexed_count != len(self.documents):
+            self._indexed = {}
+            for document in self.documents:
+                self._indexed.setdefault(_hashable(document.get(self.index)), []).append(document)
+            self._indexed_count = len(self.documents)
+        if len(values) == 1:
+            return self._indexed.get(_hashable(values[0]), ())
+        return [document for value in values for document in self._indexed.get(_hashable(value), ())]
+
+    def _add(self, document):
+        if self._indexed_count == len(self.documents):
+            self._indexed.setdefault(_hashable(document.get(self.index)), []).append(document)
+            self._indexed_count += 1
+        self.documents.append(document)
+
+    def _remove(self, document):
+        if self._indexed_count == len(self.documents):
+            self._indexed[_hashable(document.get(self.index))].remove(document)
+            self._indexed_count -= 1
+        self.documents.remove(document)
+
+    def _round_trip(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _find(self, query):
+        for document in self._candidates(query):
+            if _matches(document, query):
+                return document
+        return None
+
+    def find(self, query, projection=None, sort=None, limit=0, batch_size=0):
+        self._round_trip()
+        with self._lock:
+            documents = _sorted([document for document in self._candidates(query) if _matches(document, query)], sort)
+            if limit:
+                documents = documents[:limit]
+            return [_project(document, projection) for document in documents]
+
+    def find_one(self, query, projection=None, sort=None):
+        self._round_trip()
+        with self._lock:
+            if sort:
+                documents = _sorted([document for document in self._candidates(query) if _matches(document, query)], sort)
+                document = documents[0] if documents else None
+            else:
+                document = self._find(query)
+            return _project(document, projection) if document else None
+
+    def insert_one(self, document):
+        self._round_trip()
+        with self._lock:
+            self._add(copy.deepcopy(document))
+        return FakeResult(inserted_id=len(self.documents))
+
+    def insert_many(self, documents, ordered=True):
+        self._round_trip()
+        with self._lock:
+            for document in documents:
+                self._add(copy.deepcopy(document))
+        return FakeResult()
+
+    def create_index(self, keys, **kwargs):
+        self._round_trip()
+        return kwargs.get('name', '_'.join(f'{key}_{direction}' for key, direction in keys))
+
+    def update_one(self, query, update, upsert=False):
+        self._round_trip()
+        with self._lock:
+            document = self._find(query)
+            if document is None:
+                if not upsert:
+                    return FakeResult()
+                document = copy.deepcopy(query)
+                apply_update(document, {'$set': update.get('$setOnInsert', {})})
+                self._add(document)
+                apply_update(document, update)
+                return FakeResult(upserted_id=len(self.documents))
+            apply_update(document, update)
+            return FakeResult(matched_count=1, modified_count=1)
+
+    def update_many(self, query, update):
+        self._round_trip()
+        with self._lock:
+            documents = [document for document in self._candidates(query) if _matches(document, query)]
+            for document in documents:
+                apply_update(document, update)
+            return FakeResult(matched_count=len(documents), modified_count=len(documents))
+
+    def find_one_and_update(self, query, update, upsert=False, return_document=False):
+        self._round_trip()
+        with self._lock:
+            document = self._find(query)
+            if document is None:
+                if not upsert:
+                    return None
+                document = copy.deepcopy(query)
+                apply_update(document, {'$set': update.get('$setOnInsert', {})})
+                self._add(document)
+                before = None
+            else:
+                before = copy.deepcopy(document)
+            apply_update(document, update)
+            return copy.deepcopy(document) if return_document else before
+
+    def delete_one(self, query):
+        self._round_trip()
+        with self._lock:
+            document = self._find(query)
+            if document is None:
+                return FakeResult()
+            self._remove(document)
+            return FakeResult(deleted_count=1)
+
+    def bulk_write(self, requests, ordered=True):
+        self._round_trip()
+        latency, self.latency = self.latency, 0
+        try:
+            for request in requests:
+                if isinstance(request, DeleteOne):
+                    self.delete_one(request._filter)
+                else:
+                    self.update_one(request._filter, request._doc, upsert=bool(request._upsert))
+        finally:
+            self.latency = latency
+            self.calls -= len(requests)
+        return FakeResult(matched_count=len(requests))
+
+
+class FakeBotRequest(BaseRequest):
+    """Answers Bot API calls locally and records them, with an optional latency per call."""
+
+    BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Bot', 'username': 'fake_bot'}
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = []
+        self._message_ids = itertools.count(1000)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit('/', 1)[-1]
+        parameters = request_data.parameters if request_data else {}
+        self.calls.append((endpoint, parameters))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if endpoint == 'getMe':
+            result = dict(self.BOT_USER, can_join_groups=True, can_read_all_group_messages=False,
+                          supports_inline_queries=False)
+        elif endpoint in ('sendMessage', 'editMessageText'):
+            chat_id = parameters.get('chat_id', 0)
+            result = {
+                'message_id': next(self._message_ids),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': self.BOT_USER,
+                'text': parameters.get('text', ''),
+            }
+            if 'reply_markup' in parameters:
+                result['reply_markup'] = parameters['reply_markup']
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+    def calls_to(self, *endpoints):
+        return [parameters for endpoint, parameters in self.calls if endpoint in endpoints]
+
+
+class _Allowance:
+    """Token bucket that refuses instead of waiting, the way the Bot API applies its limits."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self):
+        """Takes a token and returns 0, or returns the seconds until one is available."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class FloodControlBotRequest(FakeBotRequest):
+    """FakeBotRequest that answers 429 with a retry_after when a flood limit is exceeded.
+
+    Requests targeting a chat are limited overall and per chat, like the Bot
+    API (the real limits are not published precisely; these are the documented
+    rules of thumb). `flood_probability` additionally answers that share of
+    those requests with 429 at random, the way Telegram sometimes does under load.
+    """
+
+    def __init__(self, latency=0.0, overall_rate=30, chat_rate=1, chat_burst=3, flood_probability=0.0, seed=0):
+        super().__init__(latency)
+        self.overall = _Allowance(overall_rate, overall_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chats = {}
+        self.flood_probability = flood_probability
+        self.random = random.Random(seed)
+        self.refused = 0
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        parameters = request_data.parameters if request_data else {}
+        chat_id = parameters.get('chat_id')
+        if chat_id is not None:
+            chat = self.chats.get(chat_id)
+            if chat is None:
+                chat = self.chats[chat_id] = _Allowance(self.chat_rate, self.chat_burst)
+            wait = chat.take() or self.overall.take()
+            if not wait and self.random.random() < self.flood_probability:
+                wait = 1
+            if wait:
+                self.refused += 1
+                self.calls.append((url.rsplit('/', 1)[-1] + ':429', parameters))
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                retry_after = max(1, math.ceil(wait))
+                return 429, json.dumps({
+                    'ok': False, 'error_code': 429, 'description': f'Too Many Requests: retry after {retry_after}',
+                    'parameters': {'retry_after': retry_after},
+                }).encode()
+        return await super().do_request(url, method, request_data, read_timeout, write_timeout, connect_timeout,
+                                        pool_timeout)
+
+
+_update_ids = itertools.count(1)
+
+
+def message_update(user_id, text):
+    """Builds the JSON of an Update carrying a private text message."""
+    message = {
+        'message_id': next(_update_ids),
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}'},
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': next(_update_ids), 'message': message}
+
+
+def callback_update(user_id, data):
+    """Builds the JSON of an Update carrying an inline keyboard button press."""
+    return {
+        'update_id': next(_update_ids),
+        'callback_query': {
+            'id': str(next(_update_ids)),
+            'chat_instance': str(user_id),
+            'data': data,
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}'},
+            'message': {
+                'message_id': 1,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': FakeBotRequest.BOT_USER,
+                'text': 'Please choose an option:',
+            },
+        },
+    }
@@ -0,0 +1,194 @@
+"""In-process cache of user documents.
+
+Every conversation step starts by reading the user's document, so the hot
+path is dominated by reads of documents this process just wrote.
+CachedUserRepository keeps recently used documents in a bounded LRU with a
+TTL and applies every write to the cached copy after the database accepts it
+(write-through), so reads can be answered from memory.
+
+The cache assumes this process is the only writer for the users it serves.
+admin.py is the exception: it changes balances from outside the bot, and
+bumps the users_version setting after every batch it writes.
+UserCacheValidator reads that setting every `interval` seconds and empties
+the cache when it changed. Reads that must not be stale (the balance a
+withdrawal is checked against) pass fresh=True and skip the cache.
+"""
+import asyncio
+import copy
+import logging
+import time
+from collections import OrderedDict
+
+from repository import UserRepository, apply_update
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_CACHE_TTL = 300
+DEFAULT_CACHE_CHECK_INTERVAL = 1
+# Setting bumped by the processes that change user documents behind the bot's back
+USERS_VERSION_KEY = 'users_version'
+
+
+class LRUCache:
+    """Bounded mapping with least-recently-used and time-to-live eviction."""
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, expires_at = entry
+        if expires_at <= self.clock():
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key):
+        """Returns a live entry without touching the statistics or the LRU order."""
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= self.clock():
+            return None
+        return entry[0]
+
+    def put(self, key, value):
+        self._entries[key] = (value, self.clock() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key):
+        entry = self._entries.pop(key, None)
+        return entry[0] if entry else None
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+        }
+
+
+class CachedUserRepository(UserRepository):
+    """UserRepository that serves reads from an LRUCache and writes through to it."""
+
+    def __init__(self, store, executor, cache, group_commit=None):
+        super().__init__(store, executor, group_commit)
+        self.cache = cache
+
+    def is_cached(self, user_id):
+        return self.cache.peek(user_id) is not None
+
+    async def get(self, user_id, fresh=False):
+        document = None if fresh else self.cache.get(user_id)
+        if document is None:
+            document = await super().get(user_id)
+            if document is None:
+                return None
+            self.cache.put(user_id, document)
+        # Callers may modify the document, the cached copy must stay as stored
+        return copy.deepcopy(document)
+
+    async def insert(self, document):
+        await super().insert(document)
+        self.cache.put(document['user_id'], copy.deepcopy(document))
+
+    async def update(self, user_id, update, condition=None):
+        try:
+            updated = await super().update(user_id, update, condition)
+        except Exception:
+            self.cache.pop(user_id)
+            raise
+        if not updated:
+            # The stored document is not what the cached copy says
+            self.cache.pop(user_id)
+            return False
+        document = self.cache.peek(user_id)
+        if document is not None:
+            apply_update(document, update)
+        return True
+
+    async def update_and_get(self, user_id, update, upsert=False, condition=None, grouped=False):
+        try:
+            document = await super().update_and_get(user_id, update, upsert=upsert, condition=condition,
+                                                    grouped=grouped)
+        except Exception:
+            self.cache.pop(user_id)
+            raise
+        if document is None:
+            self.cache.pop(user_id)
+            return None
+        self.cache.put(user_id, document)
+        return copy.deepcopy(document)
+
+    async def clear_temp_data(self, user_ids):
+        try:
+            await super().clear_temp_data(user_ids)
+        finally:
+            for user_id in user_ids:
+                self.cache.pop(user_id)
+
+
+class UserCacheValidator:
+    """Empties a user cache whenever the users_version setting changes."""
+
+    def __init__(self, cache, settings, interval=DEFAULT_CACHE_CHECK_INTERVAL):
+        self.cache = cache
+        self.settings = settings
+        self.interval = interval
+        self.version = None
+        self.invalidations = 0
+        self._task = None
+
+    async def start(self, application):
+        self.version = await self.settings.get(USERS_VERSION_KEY)
+        self._task = asyncio.get_running_loop().create_task(self._check_periodically())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _check_periodically(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check()
+            except Exception:
+                logger.exception("Checking the version of the user documents failed")
+
+    async def check(self):
+        """Empties the cache if the user documents were changed from outside. Returns whether it did."""
+        version = await self.settings.get(USERS_VERSION_KEY)
+        if version == self.version:
+            return False
+        self.version = version
+        self.cache.clear()
+        self.invalidations += 1
+        return True
@@ -0,0 +1,78 @@
+"""Suppression of repeated transaction confirmations.
+
+A confirmation can reach the confirm step more than once: Telegram delivers
+an update again when the bot did not acknowledge it in time (webhook
+timeouts, a restart between fetching and confirming updates), and a user
+double-tapping Confirm sends two callback queries for the same transaction.
+Applying either twice would change the balance twice.
+
+Every confirmation screen carries a nonce, stored in temp_data when the
+screen is shown. A confirmation is then dropped:
+
+1. when its callback query id was already handled (same update delivered
+   again), before the user document is even read. The id is only recorded
+   once the confirmation is resolved, so a delivery whose commit failed or
+   found nothing to apply can be retried;
+2. when the nonce of the transaction was already confirmed by this process,
+   or the transaction is no longer in temp_data;
+3. by MongoDB, when the conditional update that applies it finds the nonce
+   gone, e.g. because another process confirmed it first.
+
+The first two checks are bounded LRUs in memory; the last one is the
+guarantee. ConfirmationDeduplicator counts the confirmations dropped by
+each check.
+"""
+import secrets
+
+from cache import LRUCache
+
+
+DEFAULT_DEDUP_SIZE = 10000
+# Telegram gives up redelivering an update after about a day
+DEFAULT_DEDUP_TTL = 24 * 60 * 60
+
+SUPPRESSED_REASONS = ('callback_query', 'nonce', 'database')
+
+
+def new_nonce():
+    return secrets.token_hex(8)
+
+
+class ConfirmationDeduplicator:
+    """Remembers recent confirmations to drop repeated ones."""
+
+    def __init__(self, max_size=DEFAULT_DEDUP_SIZE, ttl=DEFAULT_DEDUP_TTL, metrics=None):
+        self.callback_queries = LRUCache(max_size, ttl)
+        self.nonces = LRUCache(max_size, ttl)
+        self.metrics = metrics
+        self.confirmed = 0
+        self.suppressed = dict.fromkeys(SUPPRESSED_REASONS, 0)
+
+    def seen_callback_query(self, query_id):
+        """Tells whether a callback query was already handled."""
+        if self.callback_queries.peek(query_id) is None:
+            return False
+        self.suppress('callback_query')
+        return True
+
+    def handled_callback_query(self, query_id):
+        """Records a callback query whose confirmation was resolved, to drop it if delivered again."""
+        self.callback_queries.put(query_id, True)
+
+    def seen_nonce(self, user_id, nonce):
+        """Tells whether the transaction with this nonce was already confirmed by this process."""
+        if nonce is None or self.nonces.peek((user_id, nonce)) is None:
+            return False
+        self.suppress('nonce')
+        return True
+
+    def confirm(self, user_id, nonce):
+        """Records the transaction with this nonce as confirmed."""
+        self.nonces.put((user_id, nonce), True)
+        self.confirmed += 1
+
+    def suppress(self, reason):
+        """Counts a confirmation dropped for one of SUPPRESSED_REASONS."""
+        self.suppressed[reason] += 1
+        if self.metrics is not None:
+            self.metrics.confirmations_suppressed.inc(reason)
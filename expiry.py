@@ -0,0 +1,135 @@
+"""Expiry of abandoned conversations.
+
+A user who walks away in the middle of a flow keeps the state and the
+temp_data of the flow (amount, selected method, method type) forever, and
+every user who ever talked to the bot keeps an entry in the conversation
+states and user_data, both in memory and in the database.
+
+A conversation expires once its state has not been written for the
+conversation timeout: the sessions store keeps state_updated_at along with
+every state for that (see persistence.py).
+ConversationSweeper runs every sweep interval and, for each batch of expired
+conversations:
+
+- drops the conversation state and user_data from memory, then has the
+  Application delete them from the database, in one write of each;
+- clears temp_data, and the 'state' field older versions stored, of the
+  users that had one, with one call of the users store (one update_many on
+  MongoDB).
+
+Users without a conversation state are in the main menu: its handlers are
+also the entry points of the conversation (see handlers.setup_handlers), so
+an expired conversation behaves as if the user had gone back to the main
+menu, and memory only holds the users active within the timeout.
+"""
+import asyncio
+import itertools
+import logging
+from datetime import timedelta
+from functools import partial
+
+from telegram.ext import ConversationHandler
+
+from ledger import ledger_now
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONVERSATION_TIMEOUT = 24 * 60 * 60
+DEFAULT_SWEEP_INTERVAL = 10 * 60
+DEFAULT_SWEEP_BATCH_SIZE = 1000
+
+
+class ExpiringConversationHandler(ConversationHandler):
+    """ConversationHandler whose states can be forgotten; users without a state are in `default_state`."""
+
+    def __init__(self, *args, default_state, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.default_state = default_state
+
+    def evict(self, key, state):
+        """Forgets the state of a conversation, if it is still `state`. Returns whether it did."""
+        # ConversationHandler has no public way to drop a state
+        if self._conversations.get(key) != state:
+            return False
+        self._conversations.pop(key)
+        return True
+
+
+class ConversationSweeper:
+    """Periodically expires the conversations whose state was not written for `timeout` seconds."""
+
+    def __init__(self, conversation, persistence, users, timeout=DEFAULT_CONVERSATION_TIMEOUT,
+                 interval=DEFAULT_SWEEP_INTERVAL, batch_size=DEFAULT_SWEEP_BATCH_SIZE):
+        self.conversation = conversation
+        self.persistence = persistence
+        self.users = users
+        self.timeout = timedelta(seconds=timeout)
+        self.interval = interval
+        self.batch_size = batch_size
+        # Expired conversations that were in a flow, and those that were in the default state
+        self.reset = 0
+        self.evicted = 0
+        self._task = None
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.persistence.executor, partial(func, *args, **kwargs))
+
+    async def start(self, application):
+        self._task = asyncio.get_running_loop().create_task(self._sweep_periodically(application))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _sweep_periodically(self, application):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sweep(application)
+            except Exception:
+                logger.exception("Sweeping the expired conversations failed")
+
+    async def sweep(self, application):
+        """Expires the conversations whose state was not written since the timeout. Returns how many."""
+        # Writes the states changed in memory first, so state_updated_at is current
+        await application.update_persistence()
+        await self.persistence.flush()
+
+        conversations = self.persistence.sessions.expired_conversations(
+            self.conversation.name, ledger_now() - self.timeout, self.batch_size
+        )
+        expired = 0
+        try:
+            while True:
+                batch = await self._run(lambda: list(itertools.islice(conversations, self.batch_size)))
+                if not batch:
+                    break
+                expired += await self._expire(application, batch)
+        finally:
+            await self._run(conversations.close)
+        # Deletes the expired conversation states and user_data from the database
+        await application.update_persistence()
+        await self.persistence.flush()
+        if expired:
+            logger.info("Expired %s abandoned conversations", expired)
+        return expired
+
+    async def _expire(self, application, conversations):
+        user_ids = []
+        for key, state in conversations:
+            user_id = key[-1]
+            # Skips the users of other workers, and those who were active since the query
+            if not self.persistence.owns_user(user_id) or not self.conversation.evict(key, state):
+                continue
+            application.drop_user_data(user_id)
+            user_ids.append(user_id)
+            if state == self.conversation.default_state:
+                self.evicted += 1
+            else:
+                self.reset += 1
+        if user_ids:
+            await self.users.clear_temp_data(user_ids)
+        return len(user_ids)
@@ -0,0 +1,238 @@
+"""Export of the balances and payment methods of every user, run by hand.
+
+    python export.py [--format csv parquet] [--output exports] [--workers 4] [--batch-size 10000]
+
+Writes one row per user: user_id, balance, deposit_methods and
+withdrawal_methods. CSV holds the methods as JSON; Parquet (needs pyarrow)
+holds them as lists of (type, detail, description).
+
+Only those fields are read, with a cursor sorted by user_id that fetches
+--batch-size documents at a time. The methods of each batch of users are
+read with one query on their user_id range of the payment_methods
+collection, and every batch is written out before the next one is read: a
+CSV batch as rows, a Parquet batch as one row group. Memory therefore stays
+the same whatever the number of users.
+
+With --workers N, the user_id range is split into N parts exported at the
+same time by N processes, each into its own file (users-DATE.part-K.csv).
+Files are written under a temporary name and renamed once complete.
+
+Reads go to a secondary when the deployment has one, so the export does
+not compete with the bot for the primary. The rows per second and the peak
+resident memory of each process are reported at the end.
+"""
+import argparse
+import csv
+import importlib.util
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+
+from pymongo import ASCENDING, DESCENDING, MongoClient, ReadPreference
+
+from methods import METHOD_FIELDS, METHOD_INDEX
+
+
+DEFAULT_BATCH_SIZE = 10000
+FORMATS = ('csv', 'parquet')
+COLUMNS = ('user_id', 'balance', 'deposit_methods', 'withdrawal_methods')
+# Method kind -> column
+METHOD_COLUMNS = {'deposit': 'deposit_methods', 'withdrawal': 'withdrawal_methods'}
+PROJECTION = {'_id': False, 'user_id': True, 'balance': True}
+METHOD_PROJECTION = {'_id': False, 'user_id': True, 'kind': True, **{field: True for field in METHOD_FIELDS}}
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process, in megabytes."""
+    try:
+        # Unlike ru_maxrss, VmHWM does not carry over the peak of the parent process across exec
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def user_id_ranges(users, parts):
+    """Splits the user_ids of the collection into `parts` (low, high) ranges, high excluded.
+
+    The bounds of the first and last ranges are None, so users created meanwhile are exported too.
+    """
+    first = users.find_one({}, projection={'user_id': True}, sort=[('user_id', ASCENDING)])
+    last = users.find_one({}, projection={'user_id': True}, sort=[('user_id', DESCENDING)])
+    if first is None or parts <= 1:
+        return [(None, None)]
+    low, high = first['user_id'], last['user_id'] + 1
+    step = max(1, -(-(high - low) // parts))
+    bounds = list(range(low + step, high, step))[:parts - 1]
+    return list(zip([None] + bounds, bounds + [None]))
+
+
+def range_query(low, high):
+    query = {}
+    if low is not None:
+        query['$gte'] = low
+    if high is not None:
+        query['$lt'] = high
+    return {'user_id': query} if query else {}
+
+
+class CsvWriter:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'w', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(COLUMNS)
+
+    def write(self, users):
+        self.writer.writerows(
+            (user['user_id'], user.get('balance', 0), json.dumps(user.get('deposit_methods', [])),
+             json.dumps(user.get('withdrawal_methods', [])))
+            for user in users
+        )
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    def __init__(self, path):
+        # Optional dependency, only needed for this format
+        import pyarrow
+        import pyarrow.parquet
+        self.pyarrow = pyarrow
+        methods = pyarrow.list_(pyarrow.struct([(field, pyarrow.string()) for field in METHOD_FIELDS]))
+        self.schema = pyarrow.schema([
+            ('user_id', pyarrow.int64()), ('balance', pyarrow.int64()),
+            ('deposit_methods', methods), ('withdrawal_methods', methods),
+        ])
+        self.path = path
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write(self, users):
+        columns = {
+            'user_id': [user['user_id'] for user in users],
+            'balance': [user.get('balance', 0) for user in users],
+        }
+        for field in ('deposit_methods', 'withdrawal_methods'):
+            columns[field] = [
+                [{key: method.get(key) for key in METHOD_FIELDS} for method in user.get(field, [])] for user in users
+            ]
+        # One row group per batch
+        self.writer.write_table(self.pyarrow.table(columns, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+WRITERS = {'csv': CsvWriter, 'parquet': ParquetWriter}
+
+
+def attach_methods(methods, batch):
+    """Adds the method columns to a batch of users sorted by user_id, from one query on their user_id range."""
+    by_user = {}
+    for user in batch:
+        for column in METHOD_COLUMNS.values():
+            user[column] = []
+        by_user[user['user_id']] = user
+    query = {'user_id': {'$gte': batch[0]['user_id'], '$lte': batch[-1]['user_id']}}
+    for method in methods.find(query, projection=METHOD_PROJECTION, sort=METHOD_INDEX):
+        user = by_user.get(method['user_id'])
+        if user is not None:
+            user[METHOD_COLUMNS[method['kind']]].append({field: method[field] for field in METHOD_FIELDS})
+
+
+def export_users(users, methods, query, writers, batch_size=DEFAULT_BATCH_SIZE):
+    """Streams the users matching `query` to every writer, batch_size users at a time. Returns the rows written."""
+    cursor = users.find(query, projection=PROJECTION, sort=[('user_id', ASCENDING)], batch_size=batch_size)
+    rows = 0
+    batch = []
+    for user in cursor:
+        batch.append(user)
+        if len(batch) >= batch_size:
+            rows += write_batch(methods, batch, writers)
+            batch = []
+    if batch:
+        rows += write_batch(methods, batch, writers)
+    return rows
+
+
+def write_batch(methods, batch, writers):
+    attach_methods(methods, batch)
+    for writer in writers:
+        writer.write(batch)
+    return len(batch)
+
+
+def export_part(mongo_uri, low, high, paths, batch_size=DEFAULT_BATCH_SIZE):
+    """Exports one user_id range to {format: path}. Returns (rows, seconds, peak RSS in MB) of the process."""
+    client = MongoClient(mongo_uri, read_preference=ReadPreference.SECONDARY_PREFERRED)
+    started = time.perf_counter()
+    writers = [WRITERS[name](path + '.tmp') for name, path in paths.items()]
+    try:
+        db = client['bot_database']
+        rows = export_users(db['users'], db['payment_methods'], range_query(low, high), writers, batch_size)
+    finally:
+        for writer in writers:
+            writer.close()
+        client.close()
+    for path in paths.values():
+        os.replace(path + '.tmp', path)
+    return rows, time.perf_counter() - started, peak_rss_mb()
+
+
+def main():
+    from dotenv import load_dotenv
+
+    from storage import script_mongo_uri
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--format', nargs='+', choices=FORMATS, default=['csv'])
+    parser.add_argument('--output', default='exports', help='directory of the exported files')
+    parser.add_argument('--workers', type=int, default=1, help='processes exporting user_id ranges in parallel')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+    if 'parquet' in args.format and importlib.util.find_spec('pyarrow') is None:
+        parser.error('the parquet format needs pyarrow (pip install pyarrow)')
+
+    load_dotenv()
+    mongo_uri = script_mongo_uri('export.py')
+    os.makedirs(args.output, exist_ok=True)
+    client = MongoClient(mongo_uri, read_preference=ReadPreference.SECONDARY_PREFERRED)
+    ranges = user_id_ranges(client['bot_database']['users'], args.workers)
+    client.close()
+
+    name = f'users-{date.today().isoformat()}'
+    parts = []
+    for index, (low, high) in enumerate(ranges):
+        suffix = f'.part-{index}' if len(ranges) > 1 else ''
+        parts.append((low, high, {
+            extension: os.path.join(args.output, f'{name}{suffix}.{extension}') for extension in args.format
+        }))
+
+    started = time.perf_counter()
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(len(parts), mp_context=context) as pool:
+        futures = [pool.submit(export_part, mongo_uri, low, high, paths, args.batch_size) for low, high, paths in parts]
+        results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - started
+
+    for (low, high, paths), (rows, seconds, peak) in zip(parts, results):
+        print(f"{', '.join(paths.values())}: {rows} rows in {seconds:.1f}s "
+              f"({rows / max(seconds, 1e-9):.0f} rows/s), peak RSS {peak:.0f} MB")
+    total = sum(rows for rows, _, _ in results)
+    print(f"{total} rows in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.0f} rows/s), "
+          f"peak RSS {max(peak for _, _, peak in results):.0f} MB per process")
+
+
+if __name__ == '__main__':
+    main()
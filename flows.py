@@ -0,0 +1,83 @@
+"""Declarative description of the money movement flows.
+
+Deposit and withdrawal walk through the same steps: ask for the amount, pick
+a saved method or add a new one, then confirm. A Flow only describes what
+differs between them: wording, the sign of the balance change, whether the
+balance must cover the amount, and the conversation states and callback codes
+it owns. handlers.py implements every step once and dispatches to it through
+the tables built here. A new flow of the same shape is one more Flow entry.
+
+Conversation states are integers persisted by MongoPersistence. Each flow
+declares the first of its consecutive states explicitly, so the values stay
+stable as flows are added.
+
+Callback data is '<flow code>:<action>[:<argument>]', for example
+'d:m:<method id>' to pick a saved deposit method (see methods.py). Every
+action is routed by a CallbackQueryHandler pattern.
+"""
+import re
+
+
+MAIN_MENU = 0
+
+# Steps of a flow, in the order of their states
+AMOUNT, SELECT_METHOD, ADD_METHOD_TYPE, ADD_METHOD_DETAILS, CONFIRM = range(5)
+STEP_COUNT = 5
+
+# Callback data of the main menu entries that do not start a flow
+VIEW_BALANCE = 'bal'
+HISTORY = 'h'
+
+# Method types asked for directly: callback argument -> (button label, stored type, detail asked for)
+METHOD_TYPES = {
+    'bank': ("Bank Transfer", 'Bank', 'the bank name'),
+    'paypal': ("Paypal", 'Paypal', 'your Paypal email'),
+}
+CRYPTO_CURRENCIES = ('BTC', 'ETH', 'USDT')
+
+# Detail asked for, by stored method type
+DETAIL_PROMPTS = {stored: detail for _, stored, detail in METHOD_TYPES.values()}
+DETAIL_PROMPTS.update({f'Crypto ({currency})': f'your {currency} address' for currency in CRYPTO_CURRENCIES})
+DETAIL_PROMPTS['Crypto (USDT)'] = 'your USDT address (ERC-20 or TRC-20)'
+
+
+class Flow:
+    """Configuration of one amount -> method -> confirmation flow."""
+
+    def __init__(self, name, code, first_state, title, verb, sign, check_balance=False, detail_suffix=''):
+        self.name = name
+        self.code = code
+        self.first_state = first_state
+        self.title = title
+        self.verb = verb
+        self.sign = sign
+        self.check_balance = check_balance
+        self.detail_suffix = detail_suffix
+
+    def state(self, step):
+        return self.first_state + step
+
+    def callback(self, action, argument=None):
+        return f'{self.code}:{action}' if argument is None else f'{self.code}:{action}:{argument}'
+
+    def pattern(self, action, argument=None):
+        """Regex matching the callback data of an action; `argument` is a regex captured as group 1."""
+        prefix = re.escape(f'{self.code}:{action}')
+        return f'^{prefix}$' if argument is None else f'^{prefix}:({argument})$'
+
+    def amount_prompt(self):
+        return f'How much would you like to {self.verb}? \n(Type "cancel" or "0" to cancel)'
+
+    def detail_prompt(self, method_type):
+        return f'Please provide {DETAIL_PROMPTS[method_type]}{self.detail_suffix}:'
+
+
+DEPOSIT = Flow('deposit', 'd', first_state=1, title='Deposit', verb='deposit', sign=1)
+WITHDRAWAL = Flow(
+    'withdrawal', 'w', first_state=6, title='Withdrawal', verb='withdraw', sign=-1,
+    check_balance=True, detail_suffix=' for withdrawal'
+)
+FLOWS = (DEPOSIT, WITHDRAWAL)
+
+# Conversation state -> (flow, step)
+STATES = {flow.state(step): (flow, step) for flow in FLOWS for step in range(STEP_COUNT)}
@@ -0,0 +1,118 @@
+"""Group commit of balance changes across users.
+
+Confirming a deposit or a withdrawal is one conditional update of the user
+document (see handlers.confirm). At peak, hundreds of confirmations a second
+would each wait for a database round trip and an executor thread of their
+own. GroupCommitter collects these updates from every user for up to
+`window` seconds, or until `batch_size` are waiting, and writes them with a
+single UserStore.update_many: three round trips on MongoDB (an ordered
+bulk_write, a find and the removal of the batch's markers, see
+mongo_storage.py), one transaction on SQLite. Each caller then gets the
+result of its own update, as update_and_get would have returned it.
+
+The window is the latency traded for throughput: an update waits up to
+`window` seconds for its batch to fill, and for the batch in flight to be
+written. A batch holds at most one update per user, so every result is the
+document right after that update, and a user's updates are written in the
+order they were submitted.
+"""
+import asyncio
+import contextlib
+import logging
+
+from repository import AsyncRepository
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_GROUP_COMMIT_WINDOW = 0.002
+DEFAULT_GROUP_COMMIT_SIZE = 256
+
+
+class GroupCommitter(AsyncRepository):
+    """Writes conditional user updates from many handlers in shared batches."""
+
+    def __init__(self, store, executor, window=DEFAULT_GROUP_COMMIT_WINDOW, batch_size=DEFAULT_GROUP_COMMIT_SIZE,
+                 metrics=None):
+        super().__init__(store, executor)
+        self.window = window
+        self.batch_size = batch_size
+        self.metrics = metrics
+        self.batches = 0
+        self.updates = 0
+        # (user_id, update, condition, future, queued at), oldest first
+        self._pending = []
+        self._batch_full = asyncio.Event()
+        self._writer_task = None
+
+    async def update_and_get(self, user_id, update, condition=None):
+        """Applies an update with the next batch and returns the document as stored.
+
+        Returns None, without applying it, if the document does not exist or
+        does not match `condition`.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((user_id, update, condition, future, loop.time()))
+        if len(self._pending) >= self.batch_size:
+            self._batch_full.set()
+        if self._writer_task is None or self._writer_task.done():
+            self._writer_task = loop.create_task(self._write_batches())
+        return await future
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'updates': self.updates,
+            'batch_size': self.updates / self.batches if self.batches else 0.0,
+        }
+
+    async def _write_batches(self):
+        loop = asyncio.get_running_loop()
+        while self._pending:
+            # The window runs from the arrival of the oldest update waiting
+            remaining = self._pending[0][4] + self.window - loop.time()
+            if len(self._pending) < self.batch_size and remaining > 0:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._batch_full.wait(), remaining)
+            self._batch_full.clear()
+            batch = self._next_batch()
+            if batch:
+                await self._write_batch(batch)
+
+    def _next_batch(self):
+        """Takes up to batch_size waiting updates, oldest first, at most one per user."""
+        batch, users, waiting = [], set(), []
+        for request in self._pending:
+            user_id, future = request[0], request[3]
+            if future.cancelled():
+                # Its handler is gone, nobody would record the change
+                continue
+            if len(batch) < self.batch_size and user_id not in users:
+                batch.append(request)
+                users.add(user_id)
+            else:
+                waiting.append(request)
+        self._pending = waiting
+        if len(waiting) >= self.batch_size:
+            self._batch_full.set()
+        return batch
+
+    async def _write_batch(self, batch):
+        requests = [(user_id, update, condition) for user_id, update, condition, _, _ in batch]
+        try:
+            results = await self._run(self.store.update_many, requests)
+        except Exception as exc:
+            logger.exception("Writing a batch of %s balance changes failed", len(batch))
+            results = [exc] * len(batch)
+        self.batches += 1
+        self.updates += len(batch)
+        if self.metrics is not None:
+            self.metrics.group_commit_batch_size.observe(len(batch))
+        for (_, _, _, future, _), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
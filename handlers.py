@@ -1,640 +1,524 @@
+from functools import partial
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     CommandHandler, CallbackQueryHandler,
-    MessageHandler, filters, ConversationHandler, ContextTypes, Application
+    MessageHandler, filters, ContextTypes, Application
 )
 from datetime import datetime
-import subprocess
-import sys
-import os
-
-
-# Defining states for the ConversationHandler
-(
-    MAIN_MENU, DEPOSIT_AMOUNT, SELECT_DEPOSIT_METHOD, ADD_DEPOSIT_METHOD_TYPE,
-    ADD_DEPOSIT_METHOD_DETAILS, CONFIRM_DEPOSIT,
-    WITHDRAW_AMOUNT, SELECT_WITHDRAWAL_METHOD, ADD_WITHDRAWAL_METHOD_TYPE,
-    ADD_WITHDRAWAL_METHOD_DETAILS, CONFIRM_WITHDRAWAL
-) = range(11)
-
-
-def setup_handlers(application: Application, users_collection, settings_collection):
-    # Store the users collection in the application context
-    application.bot_data['users_collection'] = users_collection
-    application.bot_data['settings_collection'] = settings_collection
-
-    # Define the ConversationHandler
-    conv_handler = ConversationHandler(
-        entry_points=[CommandHandler('start', start)],
-        states={
-            MAIN_MENU: [CallbackQueryHandler(main_menu)],
-            DEPOSIT_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, deposit_amount)],
-            SELECT_DEPOSIT_METHOD: [CallbackQueryHandler(select_deposit_method)],
-            ADD_DEPOSIT_METHOD_TYPE: [CallbackQueryHandler(add_deposit_method_type)],
-            ADD_DEPOSIT_METHOD_DETAILS: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_deposit_method_details)],
-            CONFIRM_DEPOSIT: [CallbackQueryHandler(confirm_deposit)],
-            WITHDRAW_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, withdraw_amount)],
-            SELECT_WITHDRAWAL_METHOD: [CallbackQueryHandler(select_withdrawal_method)],
-            ADD_WITHDRAWAL_METHOD_TYPE: [CallbackQueryHandler(add_withdrawal_method_type)],
-            ADD_WITHDRAWAL_METHOD_DETAILS: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_withdrawal_method_details)],
-            CONFIRM_WITHDRAWAL: [CallbackQueryHandler(confirm_withdrawal)],
-        },
-        fallbacks=[MessageHandler(filters.TEXT & ~filters.COMMAND, text_message)],
-        allow_reentry=True
+from repository import DEFAULT_MAX_WORKERS, create_executor, UserRepository, SettingsRepository
+from cache import (
+    DEFAULT_CACHE_CHECK_INTERVAL, DEFAULT_CACHE_SIZE, DEFAULT_CACHE_TTL, CachedUserRepository, LRUCache,
+    UserCacheValidator
+)
+from group_commit import DEFAULT_GROUP_COMMIT_SIZE, DEFAULT_GROUP_COMMIT_WINDOW, GroupCommitter
+from session import DbOpStats, current_reply, current_session, unit_of_work
+from storage import USER_DEFAULTS
+from flows import (
+    MAIN_MENU, AMOUNT, SELECT_METHOD, ADD_METHOD_TYPE, ADD_METHOD_DETAILS, CONFIRM,
+    CRYPTO_CURRENCIES, FLOWS, HISTORY, METHOD_TYPES, STATES, VIEW_BALANCE
+)
+import keyboards
+from rate_limiter import PRIORITY_CONFIRMATION, PRIORITY_MENU
+from ledger import (
+    DEFAULT_LEDGER_FLUSH_INTERVAL, DEFAULT_LEDGER_BATCH_SIZE, DEFAULT_SNAPSHOT_EVERY, TransactionLedger, ledger_entry
+)
+from methods import METHOD_CURSOR_PATTERN, METHOD_ID_PATTERN, MethodRepository, method_fields
+from metrics import InstrumentedStore, instrument_handlers
+from dedup import ConfirmationDeduplicator, SUPPRESSED_REASONS, new_nonce
+from restart import Restart
+from validation import validate_detail
+from expiry import DEFAULT_CONVERSATION_TIMEOUT, DEFAULT_SWEEP_INTERVAL, ConversationSweeper, ExpiringConversationHandler
+
+
+TEXT_INPUT = filters.TEXT & ~filters.COMMAND
+
+# Callback data of the history pages: 'h' for the newest page, 'h:<cursor>' for older ones
+HISTORY_PATTERN = rf'^{HISTORY}(:\d+_\d+)?$'
+
+
+def setup_handlers(application: Application, storage, max_workers=DEFAULT_MAX_WORKERS,
+                   cache_size=DEFAULT_CACHE_SIZE, cache_ttl=DEFAULT_CACHE_TTL,
+                   cache_check_interval=DEFAULT_CACHE_CHECK_INTERVAL,
+                   ledger_flush_interval=DEFAULT_LEDGER_FLUSH_INTERVAL, ledger_batch_size=DEFAULT_LEDGER_BATCH_SIZE,
+                   snapshot_every=DEFAULT_SNAPSHOT_EVERY,
+                   conversation_timeout=DEFAULT_CONVERSATION_TIMEOUT, sweep_interval=DEFAULT_SWEEP_INTERVAL,
+                   group_commit_window=DEFAULT_GROUP_COMMIT_WINDOW, group_commit_size=DEFAULT_GROUP_COMMIT_SIZE,
+                   metrics=None):
+    users_store, settings_store, ledger_store, methods_store = (
+        storage.users, storage.settings, storage.ledger, storage.methods
+    )
+    if metrics is not None:
+        users_store = InstrumentedStore(users_store, metrics, 'users')
+        settings_store = InstrumentedStore(settings_store, metrics, 'settings')
+        ledger_store = InstrumentedStore(ledger_store, metrics, 'ledger')
+        methods_store = InstrumentedStore(methods_store, metrics, 'methods')
+        application.bot_data['metrics'] = metrics
+
+    # Wrap the stores in async repositories so database I/O never blocks the event loop
+    executor = create_executor(max_workers)
+    application.bot_data['storage'] = storage
+    application.bot_data['db_executor'] = executor
+    # Balance changes of different users share batched writes, unless the window is 0
+    group_commit = None
+    if group_commit_window > 0:
+        group_commit = GroupCommitter(
+            users_store, executor, window=group_commit_window, batch_size=group_commit_size, metrics=metrics
+        )
+    application.bot_data['group_commit'] = group_commit
+    if cache_size > 0:
+        application.bot_data['users'] = CachedUserRepository(
+            users_store, executor, LRUCache(cache_size, cache_ttl), group_commit
+        )
+    else:
+        application.bot_data['users'] = UserRepository(users_store, executor, group_commit)
+    application.bot_data['settings'] = SettingsRepository(settings_store, executor)
+    if cache_size > 0:
+        # Empties the user cache once admin.py changed user documents
+        application.bot_data['cache_validator'] = UserCacheValidator(
+            application.bot_data['users'].cache, application.bot_data['settings'], cache_check_interval
+        )
+    application.bot_data['db_op_stats'] = DbOpStats()
+    application.bot_data['confirmations'] = ConfirmationDeduplicator(metrics=metrics)
+    application.bot_data['methods'] = MethodRepository(methods_store, executor)
+    application.bot_data['method_keyboards'] = keyboards.MethodKeyboardCache(cache_size, cache_ttl)
+    application.bot_data['ledger'] = TransactionLedger(
+        ledger_store, executor, flush_interval=ledger_flush_interval, batch_size=ledger_batch_size,
+        snapshot_every=snapshot_every
+    )
+
+    # Every flow gets the same step handlers, bound to its configuration
+    states = {MAIN_MENU: [CallbackQueryHandler(view_balance, pattern=f'^{VIEW_BALANCE}$')]}
+    for flow in FLOWS:
+        step = partial(partial, flow=flow)
+        currencies = '|'.join(CRYPTO_CURRENCIES)
+        states[MAIN_MENU].append(CallbackQueryHandler(step(start_flow), pattern=flow.pattern('go')))
+        states[flow.state(AMOUNT)] = [MessageHandler(TEXT_INPUT, step(enter_amount))]
+        states[flow.state(SELECT_METHOD)] = [
+            CallbackQueryHandler(step(choose_method), pattern=flow.pattern('m', METHOD_ID_PATTERN)),
+            CallbackQueryHandler(step(show_method_page), pattern=flow.pattern('p')),
+            CallbackQueryHandler(step(show_method_page), pattern=flow.pattern('p', METHOD_CURSOR_PATTERN)),
+            CallbackQueryHandler(step(ask_method_type), pattern=flow.pattern('add')),
+            CallbackQueryHandler(step(cancel_flow), pattern=flow.pattern('no')),
+        ]
+        states[flow.state(ADD_METHOD_TYPE)] = [
+            CallbackQueryHandler(step(choose_method_type), pattern=flow.pattern('t', '|'.join(METHOD_TYPES))),
+            CallbackQueryHandler(step(ask_crypto_currency), pattern=flow.pattern('crypto')),
+            CallbackQueryHandler(step(choose_crypto_currency), pattern=flow.pattern('c', currencies)),
+            CallbackQueryHandler(step(back_to_methods), pattern=flow.pattern('back')),
+        ]
+        states[flow.state(ADD_METHOD_DETAILS)] = [MessageHandler(TEXT_INPUT, step(enter_method_details))]
+        states[flow.state(CONFIRM)] = [
+            CallbackQueryHandler(step(confirm), pattern=flow.pattern('ok')),
+            CallbackQueryHandler(step(cancel_flow), pattern=flow.pattern('no')),
+        ]
+
+    # /start, /history and its page buttons work from any state; /history leaves the state unchanged
+    commands = [
+        CommandHandler('start', start),
+        CommandHandler('history', history),
+        CallbackQueryHandler(history, pattern=HISTORY_PATTERN)
+    ]
+    fallbacks = [MessageHandler(TEXT_INPUT, text_message), CallbackQueryHandler(stale_button)]
+    # Define the ConversationHandler, persisted through the application's persistence when it has one.
+    # Users without a state, whose conversation expired or who never sent /start, are in the main menu:
+    # its handlers are the entry points, so only the updates they handle store a state.
+    conv_handler = ExpiringConversationHandler(
+        entry_points=commands + states[MAIN_MENU] + fallbacks,
+        states=states,
+        fallbacks=commands + fallbacks,
+        name='main_conversation',
+        persistent=application.persistence is not None,
+        default_state=MAIN_MENU
     )
 
     # Add the ConversationHandler to the application
     application.add_handler(conv_handler)
 
+    # Expire the conversations abandoned for conversation_timeout seconds (0 keeps them forever)
+    if application.persistence is not None and conversation_timeout > 0:
+        application.bot_data['sweeper'] = ConversationSweeper(
+            conv_handler, application.persistence, application.bot_data['users'], conversation_timeout, sweep_interval
+        )
+
     # Add handler for the /debug_uptime command
     application.add_handler(CommandHandler('debug_uptime', debug_uptime))
 
+    # Add handler for the /debug_dbstats command
+    application.add_handler(CommandHandler('debug_dbstats', debug_dbstats))
+
     # Add handler for the /debug_restart command
     application.add_handler(CommandHandler('debug_restart', debug_restart))
 
+    # Add handler for the /debug_ledger command
+    application.add_handler(CommandHandler('debug_ledger', debug_ledger))
+
+    # Time every handler registered above
+    if metrics is not None:
+        instrument_handlers(application, metrics, default_state=MAIN_MENU)
 
+
+@unit_of_work
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    users_collection = context.application.bot_data['users_collection']
-    user = users_collection.find_one({'user_id': user_id})
-
-    if not user:
-        # Initialize user data
-        users_collection.insert_one({
-            'user_id': user_id,
-            'balance': 0,
-            'deposit_methods': [],
-            'withdrawal_methods': [],
-            'state': MAIN_MENU,
-            'temp_data': {}
-        })
-    else:
-        # Update the user's document if fields are missing
-        update_fields = {}
-        if 'deposit_methods' not in user:
-            update_fields['deposit_methods'] = []
-        if 'withdrawal_methods' not in user:
-            update_fields['withdrawal_methods'] = []
-        if 'state' not in user:
-            update_fields['state'] = MAIN_MENU
-        if 'temp_data' not in user:
-            update_fields['temp_data'] = {}
-        if update_fields:
-            users_collection.update_one({'user_id': user_id}, {'$set': update_fields})
-            user.update(update_fields)
-
-        # Check if there is a saved state to resume
-        state = user.get('state', MAIN_MENU)
-        if state != MAIN_MENU:
-            await update.message.reply_text('Let\'s resume where we left off.')
-            return await resume_flow(update, context, user)
-
-    await show_main_menu(update, context)
+    session = current_session()
+    # Fetch the user's document, initializing it on first contact (older documents are
+    # completed by the migration in schema.py, so this is the only database call)
+    user = await session.load_or_create(USER_DEFAULTS)
+
+    # Check if there is a saved state to resume (documents written before the
+    # conversation was persisted still carry it in their 'state' field)
+    state = context.user_data.setdefault('state', user.get('state', MAIN_MENU))
+    if state != MAIN_MENU:
+        current_reply().add('Let\'s resume where we left off.')
+        return await resume_flow(update, context, user)
+
+    show_main_menu()
     return MAIN_MENU
 
 
-async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [
-        [InlineKeyboardButton("View Balance", callback_data='view_balance')],
-        [InlineKeyboardButton("Deposit", callback_data='deposit')],
-        [InlineKeyboardButton("Withdraw", callback_data='withdraw')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    if update.message:
-        await update.message.reply_text('Please choose an option:', reply_markup=reply_markup)
-    elif update.callback_query:
-        await update.callback_query.message.reply_text('Please choose an option:', reply_markup=reply_markup)
+def show_main_menu():
+    reply = current_reply()
+    reply.add('Please choose an option:', keyboards.MAIN_MENU)
+    reply.prioritize(PRIORITY_MENU)
 
 
-async def main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    user_id = query.from_user.id
-    users_collection = context.application.bot_data['users_collection']
-    user = users_collection.find_one({'user_id': user_id})
-
-    if query.data == 'view_balance':
-        balance = user['balance']
-        await query.edit_message_text(f'Your current balance is: ${balance}')
-        await show_main_menu(update, context)
-        return MAIN_MENU
-
-    elif query.data == 'deposit':
-        await query.edit_message_text('How much would you like to deposit? \n(Type "cancel" or "0" to cancel)')
-        users_collection.update_one({'user_id': user_id}, {'$set': {'state': DEPOSIT_AMOUNT}})
-        return DEPOSIT_AMOUNT
+def set_state(context, flow, step):
+    """Records the step the user is in, for resume_flow."""
+    state = flow.state(step)
+    context.user_data['state'] = state
+    return state
 
-    elif query.data == 'withdraw':
-        await query.edit_message_text('How much would you like to withdraw? \n(Type "cancel" or "0" to cancel)')
-        users_collection.update_one({'user_id': user_id}, {'$set': {'state': WITHDRAW_AMOUNT}})
-        return WITHDRAW_AMOUNT
 
+def return_to_main_menu(context: ContextTypes.DEFAULT_TYPE, text):
+    """Ends the current flow with a message and shows the main menu."""
+    current_reply().add(text)
+    context.user_data['state'] = MAIN_MENU
+    current_session().set('temp_data', {})
+    show_main_menu()
+    return MAIN_MENU
 
-# ------------------ Deposit-Related Functions ------------------
 
-async def deposit_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def send_method_keyboard(update: Update, context: ContextTypes.DEFAULT_TYPE, flow, user=None, cursor=None):
+    """Shows a page of the user's saved methods, the first one unless a cursor is given."""
     user_id = update.effective_user.id
+    method_keyboards = context.application.bot_data['method_keyboards']
+    reply_markup = method_keyboards.get(user_id, flow.name) if cursor is None else None
+    if reply_markup is None:
+        methods, next_cursor = await context.application.bot_data['methods'].page(user_id, flow.name, cursor)
+        if cursor is None:
+            reply_markup = method_keyboards.put(user_id, flow.name, methods, next_cursor)
+        else:
+            reply_markup = keyboards.build_method_keyboard(flow.name, methods, cursor, next_cursor)
+    current_reply().add(f'Select a {flow.name} method:', reply_markup)
+
+
+def send_confirmation(flow, value, method, nonce=None):
+    if nonce is None:
+        # Identifies the transaction, so it is applied once however often it is confirmed
+        current_session().set('temp_data.nonce', new_nonce())
+    reply = current_reply()
+    reply.add(f"Confirm the {flow.name} of ${value} via {method['description']}.")
+    reply.add('Do you wish to confirm?', keyboards.CONFIRM[flow.name])
+    reply.prioritize(PRIORITY_CONFIRMATION)
+
+
+@unit_of_work
+async def view_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = await current_session().load()
+    current_reply().add(f"Your current balance is: ${user['balance']}")
+    show_main_menu()
+    return MAIN_MENU
+
+
+# ------------------ Flow Steps ------------------
+# Shared by every flow in flows.FLOWS; `flow` is bound when the handlers are registered.
+
+@unit_of_work
+async def start_flow(update: Update, context: ContextTypes.DEFAULT_TYPE, flow):
+    current_reply().add(flow.amount_prompt())
+    return set_state(context, flow, AMOUNT)
+
+
+@unit_of_work
+async def enter_amount(update: Update, context: ContextTypes.DEFAULT_TYPE, flow):
     value_text = update.message.text.strip().lower()
-    users_collection = context.application.bot_data['users_collection']
+    session = current_session()
 
     # Check if the user wants to cancel
     if value_text == 'cancel' or value_text == '0':
-        await update.message.reply_text('Deposit canceled.')
-        users_collection.update_one({'user_id': user_id}, {'$set': {'state': MAIN_MENU, 'temp_data': {}}})
-        await show_main_menu(update, context)
-        return MAIN_MENU
+        return return_to_main_menu(context, f'{flow.title} canceled.')
+
+    if not (value_text.isdigit() and int(value_text) > 0):
+        current_reply().add('Please enter a valid amount greater than zero or "cancel" to cancel.')
+        return flow.state(AMOUNT)
+
+    value = int(value_text)
+    if flow.check_balance:
+        # Not from the cache: admin.py may have changed the balance since it was cached
+        user = await session.load(fresh=True)
+        if value > user['balance']:
+            current_reply().add(
+                f"You don't have sufficient balance. Your current balance is ${user['balance']}.\n\n"
+                'Please enter an amount less than or equal to your balance or type "cancel" or "0" to cancel.'
+            )
+            return flow.state(AMOUNT)
 
-    if value_text.isdigit() and int(value_text) > 0:
-        value = int(value_text)
-        users_collection.update_one({'user_id': user_id}, {'$set': {'temp_data.transaction_value': value}})
+    session.set('temp_data.transaction_value', value)
+    await send_method_keyboard(update, context, flow)
+    return set_state(context, flow, SELECT_METHOD)
 
-        # Retrieve user's deposit methods
-        user = users_collection.find_one({'user_id': user_id})
-        methods = user['deposit_methods']
 
-        keyboard = [[InlineKeyboardButton(m['description'], callback_data=f"deposit_method_{idx}")] for idx, m in enumerate(methods)]
-        keyboard.append([InlineKeyboardButton("Add New Method", callback_data='add_deposit_method')])
-        keyboard.append([InlineKeyboardButton("Cancel", callback_data='cancel')])
-        reply_markup = InlineKeyboardMarkup(keyboard)
+@unit_of_work
+async def show_method_page(update: Update, context: ContextTypes.DEFAULT_TYPE, flow):
+    cursor = context.match.group(1) if context.match.re.groups else None
+    await send_method_keyboard(update, context, flow, cursor=cursor)
+    return flow.state(SELECT_METHOD)
 
-        await update.message.reply_text('Select a deposit method:', reply_markup=reply_markup)
-        users_collection.update_one({'user_id': user_id}, {'$set': {'state': SELECT_DEPOSIT_METHOD}})
-        return SELECT_DEPOSIT_METHOD
-    else:
-        await update.message.reply_text('Please enter a valid amount greater than zero or "cancel" to cancel.')
-        return DEPOSIT_AMOUNT
 
+@unit_of_work
+async def choose_method(update: Update, context: ContextTypes.DEFAULT_TYPE, flow):
+    user_id = update.effective_user.id
+    method_id = context.match.group(1)
+    # Methods on the cached first page need no database round trip
+    method = context.application.bot_data['method_keyboards'].find(user_id, flow.name, method_id)
+    if method is None:
+        method = await context.application.bot_data['methods'].get(user_id, flow.name, method_id)
+    if method is None:
+        current_reply().answer('This method is no longer available.')
+        return flow.state(SELECT_METHOD)
 
-async def select_deposit_method(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    user_id = query.from_user.id
-    users_collection = context.application.bot_data['users_collection']
-    user = users_collection.find_one({'user_id': user_id})
-
-    if query.data == 'cancel':
-        await query.edit_message_text('Deposit canceled.')
-        users_collection.update_one({'user_id': user_id}, {'$set': {'state': MAIN_MENU, 'temp_data': {}}})
-        await show_main_menu(update, context)
-        return MAIN_MENU
+    session = current_session()
+    user = await session.load()
+    session.set('temp_data.selected_method', method_fields(method))
+    send_confirmation(flow, user['temp_data']['transaction_value'], method)
+    return set_state(context, flow, CONFIRM)
 
-    if query.data.startswith('deposit_method_'):
-        idx = int(query.data.split('_')[-1])
-        method = user['deposit_methods'][idx]
-        users_collection.update_one({'user_id': user_id}, {'$set': {'temp_data.selected_method': method}})
-        value = user['temp_data']['transaction_value']
-        await query.edit_message_text(f"Confirm the deposit of ${value} via {method['description']}.")
 
-        keyboard = [
-            [InlineKeyboardButton("Confirm", callback_data='confirm_deposit')],
-            [InlineKeyboardButton("Cancel", callback_data='cancel')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.reply_text('Do you wish to confirm?', reply_markup=reply_markup)
-        users_collection.update_one({'user_id': user_id}, {'$set': {'state': CONFIRM_DEPOSIT}})
-        return CONFIRM_DEPOSIT
-
-    elif query.data == 'add_deposit_method':
-        await query.edit_message_text('Select the type of method you wish to add:')
-        keyboard = [
-            [InlineKeyboardButton("Bank Transfer", callback_data='type_bank_deposit')],
-            [InlineKeyboardButton("Paypal", callback_data='type_paypal_deposit')],
-            [InlineKeyboardButton("Crypto", callback_data='type_crypto_deposit')],
-            [InlineKeyboardButton("Cancel", callback_data='cancel_add_deposit_method')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        users_collection.update_one({'user_id': user_id}, {'$set': {'state': ADD_DEPOSIT_METHOD_TYPE}})
-        await query.message.reply_text('Choose the method type:', reply_markup=reply_markup)
-        return ADD_DEPOSIT_METHOD_TYPE
+@unit_of_work
+async def ask_method_type(update: Update, context: ContextTypes.DEFAULT_TYPE, flow):
+    current_reply().add('Select the type of method you wish to add:', keyboards.METHOD_TYPES[flow.name])
+    return set_state(context, flow, ADD_METHOD_TYPE)
 
 
-async def add_deposit_method_type(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    user_id = query.from_user.id
-    users_collection = context.application.bot_data['users_collection']
-
-    if query.data == 'cancel_add_deposit_method':
-        await query.edit_message_text('Adding method canceled.')
-        users_collection.update_one({'user_id': user_id}, {'$set': {'state': SELECT_DEPOSIT_METHOD}})
-        # Return to method selection
-        await resume_flow(update, context, users_collection.find_one({'user_id': user_id}))
-        return SELECT_DEPOSIT_METHOD
-
-    if query.data == 'type_bank_deposit':
-        users_collection.update_one({'user_id': user_id}, {'$set': {'temp_data.new_method_type': 'Bank'}})
-        await query.message.reply_text('Please provide the bank name:\n(Type "cancel" or "0" to cancel)')
-        users_collection.update_one({'user_id': user_id}, {'$set': {'state': ADD_DEPOSIT_METHOD_DETAILS}})
-        return ADD_DEPOSIT_METHOD_DETAILS
-
-    elif query.data == 'type_paypal_deposit':
-        users_collection.update_one({'user_id': user_id}, {'$set': {'temp_data.new_method_type': 'Paypal'}})
-        await query.message.reply_text('Please provide your Paypal email:\n(Type "cancel" or "0" to cancel)')
-        users_collection.update_one({'user_id': user_id}, {'$set': {'state': ADD_DEPOSIT_METHOD_DETAILS}})
-        return ADD_DEPOSIT_METHOD_DETAILS
-
-    elif query.data == 'type_crypto_deposit':
-        keyboard = [
-            [InlineKeyboardButton("BTC", callback_data='crypto_BTC_deposit')],
-            [InlineKeyboardButton("ETH", callback_data='crypto_ETH_deposit')],
-            [InlineKeyboardButton("USDT", callback_data='crypto_USDT_deposit')],
-            [InlineKeyboardButton("Cancel", callback_data='cancel_add_deposit_method')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.reply_text('Select the cryptocurrency:', reply_markup=reply_markup)
-        return ADD_DEPOSIT_METHOD_TYPE
+def ask_method_detail(context: ContextTypes.DEFAULT_TYPE, flow, method_type):
+    current_session().set('temp_data.new_method_type', method_type)
+    current_reply().add(f'{flow.detail_prompt(method_type)}\n(Type "cancel" or "0" to cancel)')
+    return set_state(context, flow, ADD_METHOD_DETAILS)
 
-    elif query.data.startswith('crypto_') and query.data.endswith('_deposit'):
-        crypto = query.data.split('_')[1]
-        users_collection.update_one({'user_id': user_id}, {'$set': {'temp_data.new_method_type': f'Crypto ({crypto})'}})
-        await query.message.reply_text(f'Please provide your {crypto} address:\n(Type "cancel" or "0" to cancel)')
-        users_collection.update_one({'user_id': user_id}, {'$set': {'state': ADD_DEPOSIT_METHOD_DETAILS}})
-        return ADD_DEPOSIT_METHOD_DETAILS
 
+@unit_of_work
+async def choose_method_type(update: Update, context: ContextTypes.DEFAULT_TYPE, flow):
+    _, method_type, _ = METHOD_TYPES[context.match.group(1)]
+    return ask_method_detail(context, flow, method_type)
 
-async def add_deposit_method_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    detail = update.message.text.strip().lower()
-    users_collection = context.application.bot_data['users_collection']
-    user = users_collection.find_one({'user_id': user_id})
-    method_type = user['temp_data']['new_method_type']
 
-    if detail == 'cancel' or detail == '0':
-        await update.message.reply_text('Adding method canceled.')
-        users_collection.update_one({'user_id': user_id}, {'$set': {'state': MAIN_MENU, 'temp_data': {}}})
-        await show_main_menu(update, context)
-        return MAIN_MENU
+@unit_of_work
+async def ask_crypto_currency(update: Update, context: ContextTypes.DEFAULT_TYPE, flow):
+    current_reply().add('Select the cryptocurrency:', keyboards.CRYPTO_CURRENCIES[flow.name])
+    return flow.state(ADD_METHOD_TYPE)
 
-    new_method = {
-        'type': method_type,
-        'detail': detail,
-        'description': f"{method_type}: {detail}"
-    }
 
-    users_collection.update_one({'user_id': user_id}, {'$push': {'deposit_methods': new_method}})
-    await update.message.reply_text(f"Method {method_type} added successfully!")
+@unit_of_work
+async def choose_crypto_currency(update: Update, context: ContextTypes.DEFAULT_TYPE, flow):
+    return ask_method_detail(context, flow, f'Crypto ({context.match.group(1)})')
 
-    # Continue the deposit flow
-    users_collection.update_one({'user_id': user_id}, {'$set': {'temp_data.selected_method': new_method}})
-    value = user['temp_data']['transaction_value']
-    await update.message.reply_text(f"Confirm the deposit of ${value} via {new_method['description']}.")
 
-    keyboard = [
-        [InlineKeyboardButton("Confirm", callback_data='confirm_deposit')],
-        [InlineKeyboardButton("Cancel", callback_data='cancel')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    users_collection.update_one({'user_id': user_id}, {'$set': {'state': CONFIRM_DEPOSIT}})
-    await update.message.reply_text('Do you wish to confirm?', reply_markup=reply_markup)
-    return CONFIRM_DEPOSIT
+@unit_of_work
+async def back_to_methods(update: Update, context: ContextTypes.DEFAULT_TYPE, flow):
+    current_reply().add('Adding method canceled.')
+    # Return to method selection
+    await send_method_keyboard(update, context, flow)
+    return set_state(context, flow, SELECT_METHOD)
 
 
-async def confirm_deposit(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    user_id = query.from_user.id
-    users_collection = context.application.bot_data['users_collection']
-    user = users_collection.find_one({'user_id': user_id})
-
-    if query.data == 'confirm_deposit':
-        value = user['temp_data']['transaction_value']
-        users_collection.update_one({'user_id': user_id}, {'$inc': {'balance': value}})
-        await query.edit_message_text(f"Deposit of ${value} completed successfully!")
-        users_collection.update_one({'user_id': user_id}, {'$set': {'state': MAIN_MENU, 'temp_data': {}}})
-        await show_main_menu(update, context)
-        return MAIN_MENU
+@unit_of_work
+async def enter_method_details(update: Update, context: ContextTypes.DEFAULT_TYPE, flow):
+    # Not lowercased: Base58 addresses are case-sensitive and ETH addresses carry their checksum in the case
+    text = update.message.text.strip()
+    session = current_session()
 
-    elif query.data == 'cancel':
-        await query.edit_message_text("Deposit canceled.")
-        users_collection.update_one({'user_id': user_id}, {'$set': {'state': MAIN_MENU, 'temp_data': {}}})
-        await show_main_menu(update, context)
-        return MAIN_MENU
+    if text.lower() == 'cancel' or text == '0':
+        return return_to_main_menu(context, 'Adding method canceled.')
 
+    user = await session.load()
+    method_type = user['temp_data']['new_method_type']
+    detail, error = validate_detail(method_type, text)
+    if error is not None:
+        current_reply().add(f'{error}\n{flow.detail_prompt(method_type)}\n(Type "cancel" or "0" to cancel)')
+        return flow.state(ADD_METHOD_DETAILS)
+
+    # A method the user already has is not saved twice
+    method, added = await context.application.bot_data['methods'].add(session.user_id, flow.name, method_type, detail)
+    if added:
+        context.application.bot_data['method_keyboards'].add(session.user_id, flow.name, method)
+        current_reply().add(f"Method {method_type} added successfully!")
+    else:
+        current_reply().add(f"You already have this {method_type} method, it is selected.")
 
-# ------------------ Withdrawal-Related Functions ------------------
+    # Continue the flow with the new method
+    session.set('temp_data.selected_method', method_fields(method))
+    send_confirmation(flow, user['temp_data']['transaction_value'], method)
+    return set_state(context, flow, CONFIRM)
 
-async def withdraw_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    value_text = update.message.text.strip().lower()
-    users_collection = context.application.bot_data['users_collection']
 
-    # Check if the user wants to cancel
-    if value_text == 'cancel' or value_text == '0':
-        await update.message.reply_text('Withdrawal canceled.')
-        users_collection.update_one({'user_id': user_id}, {'$set': {'state': MAIN_MENU, 'temp_data': {}}})
-        await show_main_menu(update, context)
+@unit_of_work
+async def confirm(update: Update, context: ContextTypes.DEFAULT_TYPE, flow):
+    confirmations = context.application.bot_data['confirmations']
+    if confirmations.seen_callback_query(update.callback_query.id):
+        # The same update delivered again, already handled and answered
+        current_reply().already_answered()
         return MAIN_MENU
 
-    if value_text.isdigit() and int(value_text) > 0:
-        value = int(value_text)
-        user = users_collection.find_one({'user_id': user_id})
-        balance = user['balance']
+    session = current_session()
+    user = await session.load()
+    temp_data = user['temp_data']
+    nonce = temp_data.get('nonce')
+    if 'transaction_value' not in temp_data:
+        confirmations.suppress('nonce')
+        return already_confirmed(context)
+    if confirmations.seen_nonce(session.user_id, nonce):
+        return already_confirmed(context)
+
+    value = temp_data['transaction_value']
+    ledger = context.application.bot_data['ledger']
+    ledger.apply(session, flow.sign * value)
+    context.user_data['state'] = MAIN_MENU
+    session.set('temp_data', {})
+    # Applies only if no other confirmation of the transaction got there first.
+    # The balance must be stored before the ledger entry is queued
+    session.expect('temp_data.nonce', nonce)
+    if flow.check_balance:
+        # The store refuses a withdrawal the balance no longer covers
+        session.expect_at_least('balance', value)
+    stored = await session.commit_and_load(grouped=True)
+    if stored is None:
+        if flow.check_balance:
+            current = await context.application.bot_data['users'].get(session.user_id, fresh=True)
+            if current is not None and current['temp_data'].get('nonce') == nonce:
+                confirmations.handled_callback_query(update.callback_query.id)
+                return return_to_main_menu(
+                    context, f"{flow.title} canceled: your balance of ${current['balance']} no longer covers ${value}."
+                )
+        confirmations.suppress('database')
+        return already_confirmed(context)
+    confirmations.confirm(session.user_id, nonce)
+    confirmations.handled_callback_query(update.callback_query.id)
+    # Described from the stored document, which a cached copy may lag behind
+    ledger.append(ledger_entry(stored, flow.name, flow.sign * value, temp_data.get('selected_method')))
+    reply = current_reply()
+    reply.add(f"{flow.title} of ${value} completed successfully!")
+    reply.prioritize(PRIORITY_CONFIRMATION)
+    show_main_menu()
+    return MAIN_MENU
 
-        if value > balance:
-            await update.message.reply_text(
-                f"You don't have sufficient balance. Your current balance is ${balance}.\n\n"
-                'Please enter an amount less than or equal to your balance or type "cancel" or "0" to cancel.'
-            )
-            return WITHDRAW_AMOUNT
 
-        users_collection.update_one({'user_id': user_id}, {'$set': {'temp_data.transaction_value': value}})
+def already_confirmed(context: ContextTypes.DEFAULT_TYPE):
+    context.user_data['state'] = MAIN_MENU
+    current_reply().answer('This transaction was already confirmed.')
+    return MAIN_MENU
 
-        # Retrieve user's withdrawal methods
-        methods = user.get('withdrawal_methods', [])
 
-        keyboard = [[InlineKeyboardButton(m['description'], callback_data=f"withdrawal_method_{idx}")] for idx, m in enumerate(methods)]
-        keyboard.append([InlineKeyboardButton("Add New Method", callback_data='add_withdrawal_method')])
-        keyboard.append([InlineKeyboardButton("Cancel", callback_data='cancel')])
-        reply_markup = InlineKeyboardMarkup(keyboard)
+@unit_of_work
+async def cancel_flow(update: Update, context: ContextTypes.DEFAULT_TYPE, flow):
+    return return_to_main_menu(context, f'{flow.title} canceled.')
 
-        await update.message.reply_text('Select a withdrawal method:', reply_markup=reply_markup)
-        users_collection.update_one({'user_id': user_id}, {'$set': {'state': SELECT_WITHDRAWAL_METHOD}})
-        return SELECT_WITHDRAWAL_METHOD
-    else:
-        await update.message.reply_text(
-            'Please enter a valid amount greater than zero or "cancel" to cancel.'
-        )
-        return WITHDRAW_AMOUNT
 
+# ------------------ Common Functions ------------------
 
-async def select_withdrawal_method(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    user_id = query.from_user.id
-    users_collection = context.application.bot_data['users_collection']
-    user = users_collection.find_one({'user_id': user_id})
-
-    if query.data == 'cancel':
-        await query.edit_message_text('Withdrawal canceled.')
-        users_collection.update_one({'user_id': user_id}, {'$set': {'state': MAIN_MENU, 'temp_data': {}}})
-        await show_main_menu(update, context)
-        return MAIN_MENU
-
-    if query.data.startswith('withdrawal_method_'):
-        idx = int(query.data.split('_')[-1])
-        method = user['withdrawal_methods'][idx]
-        users_collection.update_one({'user_id': user_id}, {'$set': {'temp_data.selected_method': method}})
-        value = user['temp_data']['transaction_value']
-        await query.edit_message_text(f"Confirm the withdrawal of ${value} via {method['description']}.")
-
-        keyboard = [
-            [InlineKeyboardButton("Confirm", callback_data='confirm_withdrawal')],
-            [InlineKeyboardButton("Cancel", callback_data='cancel')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.reply_text('Do you wish to confirm?', reply_markup=reply_markup)
-        users_collection.update_one({'user_id': user_id}, {'$set': {'state': CONFIRM_WITHDRAWAL}})
-        return CONFIRM_WITHDRAWAL
-
-    elif query.data == 'add_withdrawal_method':
-        await query.edit_message_text('Select the type of method you wish to add:')
-        keyboard = [
-            [InlineKeyboardButton("Bank Transfer", callback_data='type_bank_withdrawal')],
-            [InlineKeyboardButton("Paypal", callback_data='type_paypal_withdrawal')],
-            [InlineKeyboardButton("Crypto", callback_data='type_crypto_withdrawal')],
-            [InlineKeyboardButton("Cancel", callback_data='cancel_add_withdrawal_method')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        users_collection.update_one({'user_id': user_id}, {'$set': {'state': ADD_WITHDRAWAL_METHOD_TYPE}})
-        await query.message.reply_text('Choose the method type:', reply_markup=reply_markup)
-        return ADD_WITHDRAWAL_METHOD_TYPE
+async def stale_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Answers buttons of keyboards that do not belong to the current step, leaving the state unchanged."""
+    await update.callback_query.answer('This button is no longer active.')
 
 
-async def add_withdrawal_method_type(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    user_id = query.from_user.id
-    users_collection = context.application.bot_data['users_collection']
-
-    if query.data == 'cancel_add_withdrawal_method':
-        await query.edit_message_text('Adding method canceled.')
-        users_collection.update_one({'user_id': user_id}, {'$set': {'state': SELECT_WITHDRAWAL_METHOD}})
-        # Return to method selection
-        await resume_flow(update, context, users_collection.find_one({'user_id': user_id}))
-        return SELECT_WITHDRAWAL_METHOD
-
-    if query.data == 'type_bank_withdrawal':
-        users_collection.update_one({'user_id': user_id}, {'$set': {'temp_data.new_method_type': 'Bank'}})
-        await query.message.reply_text('Please provide the bank name for withdrawal:\n(Type "cancel" or "0" to cancel)')
-        users_collection.update_one({'user_id': user_id}, {'$set': {'state': ADD_WITHDRAWAL_METHOD_DETAILS}})
-        return ADD_WITHDRAWAL_METHOD_DETAILS
-
-    elif query.data == 'type_paypal_withdrawal':
-        users_collection.update_one({'user_id': user_id}, {'$set': {'temp_data.new_method_type': 'Paypal'}})
-        await query.message.reply_text('Please provide your Paypal email for withdrawal:\n(Type "cancel" or "0" to cancel)')
-        users_collection.update_one({'user_id': user_id}, {'$set': {'state': ADD_WITHDRAWAL_METHOD_DETAILS}})
-        return ADD_WITHDRAWAL_METHOD_DETAILS
-
-    elif query.data == 'type_crypto_withdrawal':
-        keyboard = [
-            [InlineKeyboardButton("BTC", callback_data='crypto_BTC_withdrawal')],
-            [InlineKeyboardButton("ETH", callback_data='crypto_ETH_withdrawal')],
-            [InlineKeyboardButton("USDT", callback_data='crypto_USDT_withdrawal')],
-            [InlineKeyboardButton("Cancel", callback_data='cancel_add_withdrawal_method')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.reply_text('Select the cryptocurrency:', reply_markup=reply_markup)
-        return ADD_WITHDRAWAL_METHOD_TYPE
+@unit_of_work
+async def text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    session = current_session()
 
-    elif query.data.startswith('crypto_') and query.data.endswith('_withdrawal'):
-        crypto = query.data.split('_')[1]
-        users_collection.update_one({'user_id': user_id}, {'$set': {'temp_data.new_method_type': f'Crypto ({crypto})'}})
-        await query.message.reply_text(f'Please provide your {crypto} address for withdrawal:\n(Type "cancel" or "0" to cancel)')
-        users_collection.update_one({'user_id': user_id}, {'$set': {'state': ADD_WITHDRAWAL_METHOD_DETAILS}})
-        return ADD_WITHDRAWAL_METHOD_DETAILS
+    # Check if the user typed 'cancel' at any stage
+    if update.message.text.strip().lower() == 'cancel':
+        return return_to_main_menu(context, 'Operation canceled.')
 
+    flow, step = STATES.get(context.user_data.get('state', MAIN_MENU), (None, None))
+    handler = TEXT_STEPS.get(step)
+    if handler:
+        return await handler(update, context, flow=flow)
+    current_reply().add("Let's resume where we left off.")
+    return await resume_flow(update, context, await session.load())
 
-async def add_withdrawal_method_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    detail = update.message.text.strip().lower()
-    users_collection = context.application.bot_data['users_collection']
-    user = users_collection.find_one({'user_id': user_id})
-    method_type = user['temp_data']['new_method_type']
 
-    if detail == 'cancel' or detail == '0':
-        await update.message.reply_text('Adding method canceled.')
-        users_collection.update_one({'user_id': user_id}, {'$set': {'state': MAIN_MENU, 'temp_data': {}}})
-        await show_main_menu(update, context)
+async def resume_flow(update: Update, context: ContextTypes.DEFAULT_TYPE, user):
+    """Asks again for whatever the user's current step is waiting for."""
+    state = context.user_data.get('state', MAIN_MENU)
+    if state not in STATES:
+        show_main_menu()
         return MAIN_MENU
+    flow, step = STATES[state]
+    await RESUME_STEPS[step](update, context, flow, user)
+    return state
 
-    new_method = {
-        'type': method_type,
-        'detail': detail,
-        'description': f"{method_type}: {detail}"
-    }
 
-    users_collection.update_one({'user_id': user_id}, {'$push': {'withdrawal_methods': new_method}})
-    await update.message.reply_text(f"Method {method_type} added successfully!")
+async def resume_amount(update: Update, context: ContextTypes.DEFAULT_TYPE, flow, user):
+    current_reply().add(flow.amount_prompt())
 
-    # Continue the withdrawal flow
-    users_collection.update_one({'user_id': user_id}, {'$set': {'temp_data.selected_method': new_method}})
-    value = user['temp_data']['transaction_value']
-    await update.message.reply_text(f"Confirm the withdrawal of ${value} via {new_method['description']}.")
 
-    keyboard = [
-        [InlineKeyboardButton("Confirm", callback_data='confirm_withdrawal')],
-        [InlineKeyboardButton("Cancel", callback_data='cancel')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    users_collection.update_one({'user_id': user_id}, {'$set': {'state': CONFIRM_WITHDRAWAL}})
-    await update.message.reply_text('Do you wish to confirm?', reply_markup=reply_markup)
-    return CONFIRM_WITHDRAWAL
+async def resume_method_type(update: Update, context: ContextTypes.DEFAULT_TYPE, flow, user):
+    current_reply().add('Choose the method type:', keyboards.METHOD_TYPES[flow.name])
 
 
-async def confirm_withdrawal(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    user_id = query.from_user.id
-    users_collection = context.application.bot_data['users_collection']
-    user = users_collection.find_one({'user_id': user_id})
-
-    if query.data == 'confirm_withdrawal':
-        value = user['temp_data']['transaction_value']
-        users_collection.update_one({'user_id': user_id}, {'$inc': {'balance': -value}})
-        await query.edit_message_text(f"Withdrawal of ${value} completed successfully!")
-        users_collection.update_one({'user_id': user_id}, {'$set': {'state': MAIN_MENU, 'temp_data': {}}})
-        await show_main_menu(update, context)
-        return MAIN_MENU
+async def resume_method_details(update: Update, context: ContextTypes.DEFAULT_TYPE, flow, user):
+    current_reply().add(flow.detail_prompt(user['temp_data']['new_method_type']))
 
-    elif query.data == 'cancel':
-        await query.edit_message_text("Withdrawal canceled.")
-        users_collection.update_one({'user_id': user_id}, {'$set': {'state': MAIN_MENU, 'temp_data': {}}})
-        await show_main_menu(update, context)
-        return MAIN_MENU
 
+async def resume_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE, flow, user):
+    temp_data = user['temp_data']
+    send_confirmation(flow, temp_data['transaction_value'], temp_data['selected_method'], temp_data.get('nonce'))
 
-# ------------------ Common Functions ------------------
 
-async def text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    users_collection = context.application.bot_data['users_collection']
-    user = users_collection.find_one({'user_id': user_id})
-    state = user.get('state', MAIN_MENU)
+# Steps that take typed text, and what each step asks again when a flow is resumed
+TEXT_STEPS = {AMOUNT: enter_amount, ADD_METHOD_DETAILS: enter_method_details}
+RESUME_STEPS = {
+    AMOUNT: resume_amount,
+    SELECT_METHOD: send_method_keyboard,
+    ADD_METHOD_TYPE: resume_method_type,
+    ADD_METHOD_DETAILS: resume_method_details,
+    CONFIRM: resume_confirmation,
+}
 
-    # Check if the user typed 'cancel' at any stage
-    if update.message.text.strip().lower() == 'cancel':
-        await update.message.reply_text('Operation canceled.')
-        users_collection.update_one({'user_id': user_id}, {'$set': {'state': MAIN_MENU, 'temp_data': {}}})
-        await show_main_menu(update, context)
-        return MAIN_MENU
 
-    if state == DEPOSIT_AMOUNT:
-        return await deposit_amount(update, context)
-    elif state == ADD_DEPOSIT_METHOD_DETAILS:
-        return await add_deposit_method_details(update, context)
-    elif state == WITHDRAW_AMOUNT:
-        return await withdraw_amount(update, context)
-    elif state == ADD_WITHDRAWAL_METHOD_DETAILS:
-        return await add_withdrawal_method_details(update, context)
+@unit_of_work
+async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Shows a page of the user's transactions, newest first."""
+    ledger = context.application.bot_data['ledger']
+    query = update.callback_query
+    cursor = None
+    if query and query.data != HISTORY:
+        cursor = query.data[len(HISTORY) + 1:]
+
+    # Entries still waiting for the batch writer would be missing from the page
+    await ledger.flush()
+    entries, next_cursor = await ledger.history(update.effective_user.id, cursor)
+
+    if entries:
+        lines = []
+        for entry in entries:
+            line = f"{entry['ts']:%Y-%m-%d %H:%M} {entry['type'].capitalize()} "
+            line += f"{'-' if entry['amount'] < 0 else '+'}${abs(entry['amount'])}"
+            if entry['method']:
+                line += f" via {entry['method']}"
+            lines.append(line + f" (balance ${entry['balance']})")
+        text = "Transaction history (UTC):\n" + "\n".join(lines)
+    elif cursor is None:
+        text = "You have no transactions yet."
     else:
-        await update.message.reply_text("Let's resume where we left off.")
-        return await resume_flow(update, context, user)
+        text = "There are no older transactions."
 
+    reply_markup = None
+    if next_cursor:
+        reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("Older", callback_data=f'{HISTORY}:{next_cursor}')]])
 
-async def resume_flow(update: Update, context: ContextTypes.DEFAULT_TYPE, user):
-    state = user.get('state', MAIN_MENU)
-    user_id = user['user_id']
-    users_collection = context.application.bot_data['users_collection']
-
-    if state == MAIN_MENU:
-        await show_main_menu(update, context)
-        return MAIN_MENU
-
-    elif state == DEPOSIT_AMOUNT:
-        await update.message.reply_text('How much would you like to deposit? \n(Type "cancel" or "0" to cancel)')
-        return DEPOSIT_AMOUNT
-
-    elif state == SELECT_DEPOSIT_METHOD:
-        methods = user['deposit_methods']
-        keyboard = [[InlineKeyboardButton(m['description'], callback_data=f"deposit_method_{idx}")] for idx, m in enumerate(methods)]
-        keyboard.append([InlineKeyboardButton("Add New Method", callback_data='add_deposit_method')])
-        keyboard.append([InlineKeyboardButton("Cancel", callback_data='cancel')])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text('Select a deposit method:', reply_markup=reply_markup)
-        return SELECT_DEPOSIT_METHOD
-
-    elif state == ADD_DEPOSIT_METHOD_TYPE:
-        keyboard = [
-            [InlineKeyboardButton("Bank Transfer", callback_data='type_bank_deposit')],
-            [InlineKeyboardButton("Paypal", callback_data='type_paypal_deposit')],
-            [InlineKeyboardButton("Crypto", callback_data='type_crypto_deposit')],
-            [InlineKeyboardButton("Cancel", callback_data='cancel_add_deposit_method')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text('Choose the method type:', reply_markup=reply_markup)
-        return ADD_DEPOSIT_METHOD_TYPE
-
-    elif state == ADD_DEPOSIT_METHOD_DETAILS:
-        method_type = user['temp_data']['new_method_type']
-        if 'Crypto' in method_type:
-            crypto = method_type.split('(')[1].strip(')')
-            await update.message.reply_text(f'Please provide your {crypto} address:')
-        elif method_type == 'Paypal':
-            await update.message.reply_text('Please provide your Paypal email:')
-        elif method_type == 'Bank':
-            await update.message.reply_text('Please provide the bank name:')
-        return ADD_DEPOSIT_METHOD_DETAILS
-
-    elif state == CONFIRM_DEPOSIT:
-        value = user['temp_data']['transaction_value']
-        method = user['temp_data']['selected_method']
-        await update.message.reply_text(f"Confirm the deposit of ${value} via {method['description']}.")
-
-        keyboard = [
-            [InlineKeyboardButton("Confirm", callback_data='confirm_deposit')],
-            [InlineKeyboardButton("Cancel", callback_data='cancel')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text('Do you wish to confirm?', reply_markup=reply_markup)
-        return CONFIRM_DEPOSIT
-
-    elif state == WITHDRAW_AMOUNT:
-        await update.message.reply_text('How much would you like to withdraw? \n(Type "cancel" or "0" to cancel)')
-        return WITHDRAW_AMOUNT
-
-    elif state == SELECT_WITHDRAWAL_METHOD:
-        methods = user['withdrawal_methods']
-        keyboard = [[InlineKeyboardButton(m['description'], callback_data=f"withdrawal_method_{idx}")] for idx, m in enumerate(methods)]
-        keyboard.append([InlineKeyboardButton("Add New Method", callback_data='add_withdrawal_method')])
-        keyboard.append([InlineKeyboardButton("Cancel", callback_data='cancel')])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text('Select a withdrawal method:', reply_markup=reply_markup)
-        return SELECT_WITHDRAWAL_METHOD
-
-    elif state == ADD_WITHDRAWAL_METHOD_TYPE:
-        keyboard = [
-            [InlineKeyboardButton("Bank Transfer", callback_data='type_bank_withdrawal')],
-            [InlineKeyboardButton("Paypal", callback_data='type_paypal_withdrawal')],
-            [InlineKeyboardButton("Crypto", callback_data='type_crypto_withdrawal')],
-            [InlineKeyboardButton("Cancel", callback_data='cancel_add_withdrawal_method')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text('Choose the method type:', reply_markup=reply_markup)
-        return ADD_WITHDRAWAL_METHOD_TYPE
-
-    elif state == ADD_WITHDRAWAL_METHOD_DETAILS:
-        method_type = user['temp_data']['new_method_type']
-        if 'Crypto' in method_type:
-            crypto = method_type.split('(')[1].strip(')')
-            await update.message.reply_text(f'Please provide your {crypto} address for withdrawal:')
-        elif method_type == 'Paypal':
-            await update.message.reply_text('Please provide your Paypal email for withdrawal:')
-        elif method_type == 'Bank':
-            await update.message.reply_text('Please provide the bank name for withdrawal:')
-        return ADD_WITHDRAWAL_METHOD_DETAILS
-
-    elif state == CONFIRM_WITHDRAWAL:
-        value = user['temp_data']['transaction_value']
-        method = user['temp_data']['selected_method']
-        await update.message.reply_text(f"Confirm the withdrawal of ${value} via {method['description']}.")
-
-        keyboard = [
-            [InlineKeyboardButton("Confirm", callback_data='confirm_withdrawal')],
-            [InlineKeyboardButton("Cancel", callback_data='cancel')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text('Do you wish to confirm?', reply_markup=reply_markup)
-        return CONFIRM_WITHDRAWAL
+    current_reply().add(text, reply_markup)
+    if query is not None and cursor is None:
+        # Opened from the main menu, which is shown again below the history
+        show_main_menu()
 
 
 async def debug_uptime(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -650,36 +534,84 @@ async def debug_uptime(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text("Unable to determine the bot's uptime.")
 
-async def debug_restart(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Restarts the bot by executing an external script."""
+async def debug_dbstats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Responds with the average number of database operations per conversation step and the cache statistics."""
+    lines = context.application.bot_data['db_op_stats'].summary()
+    if lines:
+        text = "Database operations per step:\n" + "\n".join(lines)
+    else:
+        text = "No conversation steps have been recorded yet."
+
+    users = context.application.bot_data['users']
+    if isinstance(users, CachedUserRepository):
+        stats = users.cache.stats()
+        invalidations = context.application.bot_data['cache_validator'].invalidations
+        text += (
+            f"\n\nUser cache: {stats['size']} documents, {stats['hits']} hits, {stats['misses']} misses, "
+            f"{stats['evictions']} evictions, {stats['expirations']} expirations ({stats['hit_ratio']:.0%} hit ratio), "
+            f"emptied {invalidations} times after outside changes"
+        )
 
-    await update.message.reply_text("Restarting the bot...")
+    confirmations = context.application.bot_data['confirmations']
+    suppressed = ', '.join(f"{confirmations.suppressed[reason]} {reason}" for reason in SUPPRESSED_REASONS)
+    text += f"\n\nConfirmations: {confirmations.confirmed} applied, repeated ones dropped by check: {suppressed}"
 
-    # Stores the chat ID to send a message after restarting
-    chat_id = update.effective_chat.id
-    context.application.bot_data['restart_chat_id'] = chat_id
-    print(chat_id)
+    group_commit = context.application.bot_data['group_commit']
+    if group_commit is not None:
+        stats = group_commit.stats()
+        text += (
+            f"\n\nGroup commit: {stats['updates']} balance changes in {stats['batches']} batches "
+            f"({stats['batch_size']:.1f} per batch)"
+        )
 
-    # Accesses the settings_collection from bot_data
-    settings_collection = context.bot_data['settings_collection']
+    sweeper = context.application.bot_data.get('sweeper')
+    if sweeper is not None:
+        text += f"\n\nExpired conversations: {sweeper.reset} in a flow, {sweeper.evicted} in the main menu"
+    text += f"\n\nStorage backend: {context.application.bot_data['storage'].name}"
+    await update.message.reply_text(text)
 
-    # Stores the chat ID in MongoDB to send a message after restarting
-    chat_id = update.effective_chat.id
-    settings_collection.update_one(
-        {'key': 'restart_chat_id'},
-        {'$set': {'value': chat_id}},
-        upsert=True
+async def debug_ledger(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Compares the user's stored balance with the balance rebuilt from the ledger."""
+    ledger = context.application.bot_data['ledger']
+    user_id = update.effective_user.id
+    await ledger.flush()
+    user = await context.application.bot_data['users'].get(user_id)
+    result = await ledger.replay_balance(user_id)
+    if user is None or result is None:
+        await update.message.reply_text("No transactions have been recorded for you yet.")
+        return
+
+    missing = result['seq'] - result['snapshot_seq'] - result['replayed']
+    consistent = user['balance'] == result['balance'] and user.get('ledger_seq', 0) == result['seq'] and not missing
+    await update.message.reply_text(
+        f"Ledger balance: ${result['balance']} (snapshot #{result['snapshot_seq']} "
+        f"+ {result['replayed']} transactions replayed)\n"
+        f"Stored balance: ${user['balance']} (transaction #{user.get('ledger_seq', 0)})\n"
+        + ("The ledger matches the stored balance." if consistent else "The ledger does NOT match the stored balance.")
     )
 
-    # Executes the external script to restart the bot
-    dir_path = os.path.dirname(os.path.realpath(__file__))
-    script_path = os.path.join(dir_path, 'reload.py')
+async def debug_restart(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Replaces the bot process with a new one, without losing updates (see restart.py)."""
+    if 'shard' in context.bot_data:
+        await update.message.reply_text("Restarting is not available when running with several workers.")
+        return
+    if context.bot_data['storage'].name == 'memory':
+        await update.message.reply_text(
+            "Restarting is not available with the memory storage, every user would be lost."
+        )
+        return
+
+    await update.message.reply_text("Restarting the bot...")
+
+    # Stores the chat ID in the settings so the new process tells when the restart is done
+    settings = context.bot_data['settings']
+    chat_id = update.effective_chat.id
+    await settings.set('restart_chat_id', chat_id)
 
-    def restart_bot():
-        subprocess.Popen([sys.executable, script_path])
-        print(chat_id)
-        # Terminates the current process
-        sys.exit(0)
+    async def restart():
+        if not await Restart(context.application).run():
+            await settings.delete('restart_chat_id')
+            await context.bot.send_message(chat_id, "Restart failed, the bot keeps running.")
 
-    # Calls the restart function
-    restart_bot()
\ No newline at end of file
+    # The draining waits for this update to be done, so the restart must not run inside it
+    context.application.create_task(restart(), update=update)
@@ -0,0 +1,130 @@
+"""Inline keyboards shown by the handlers.
+
+python-telegram-bot keyboards are immutable, so the menus that look the same
+for everyone are built once at import and shared by every update.
+
+The keyboard listing a user's saved deposit or withdrawal methods is
+different for each user, and shows one page of methods at a time.
+MethodKeyboardCache keeps the rendered first page of recently active users.
+When a method is added, it updates the cached page instead of reading the
+methods again.
+"""
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from cache import DEFAULT_CACHE_SIZE, DEFAULT_CACHE_TTL, LRUCache
+from flows import CRYPTO_CURRENCIES as CURRENCIES, FLOWS, HISTORY, METHOD_TYPES as TYPES, VIEW_BALANCE
+from methods import METHOD_PAGE_SIZE, encode_cursor
+
+
+def _markup(*buttons):
+    """One button per row, given as (text, callback_data) pairs."""
+    return InlineKeyboardMarkup([[InlineKeyboardButton(text, callback_data=data)] for text, data in buttons])
+
+
+MAIN_MENU = _markup(
+    ("View Balance", VIEW_BALANCE),
+    *((flow.verb.capitalize(), flow.callback('go')) for flow in FLOWS),
+    ("Transaction History", HISTORY),
+)
+
+# The keyboards below are keyed by flow name
+
+METHOD_TYPES = {
+    flow.name: _markup(
+        *((label, flow.callback('t', key)) for key, (label, _, _) in TYPES.items()),
+        ("Crypto", flow.callback('crypto')),
+        ("Cancel", flow.callback('back')),
+    )
+    for flow in FLOWS
+}
+
+CRYPTO_CURRENCIES = {
+    flow.name: _markup(
+        *((currency, flow.callback('c', currency)) for currency in CURRENCIES),
+        ("Cancel", flow.callback('back')),
+    )
+    for flow in FLOWS
+}
+
+CONFIRM = {flow.name: _markup(("Confirm", flow.callback('ok')), ("Cancel", flow.callback('no'))) for flow in FLOWS}
+
+# Rows below the saved methods
+METHOD_FOOTERS = {
+    flow.name: (
+        (InlineKeyboardButton("Add New Method", callback_data=flow.callback('add')),),
+        (InlineKeyboardButton("Cancel", callback_data=flow.callback('no')),),
+    )
+    for flow in FLOWS
+}
+FLOWS_BY_NAME = {flow.name: flow for flow in FLOWS}
+
+
+def method_row(kind, method):
+    callback_data = FLOWS_BY_NAME[kind].callback('m', method['_id'])
+    return (InlineKeyboardButton(method['description'], callback_data=callback_data),)
+
+
+def page_row(kind, cursor, next_cursor):
+    """Buttons to the next page of methods, and back to the first one from later pages."""
+    flow = FLOWS_BY_NAME[kind]
+    buttons = []
+    if cursor is not None:
+        buttons.append(InlineKeyboardButton("« First", callback_data=flow.callback('p')))
+    if next_cursor is not None:
+        buttons.append(InlineKeyboardButton("More »", callback_data=flow.callback('p', next_cursor)))
+    return (tuple(buttons),) if buttons else ()
+
+
+def build_method_keyboard(kind, methods, cursor=None, next_cursor=None):
+    """Renders one page of the method picker from scratch."""
+    rows = tuple(method_row(kind, method) for method in methods)
+    return InlineKeyboardMarkup(rows + page_row(kind, cursor, next_cursor) + METHOD_FOOTERS[kind])
+
+
+class MethodKeyboardCache:
+    """First page of the method picker of recently active users, keyed by (user_id, kind).
+
+    Most users have fewer methods than a page holds, so the first page is
+    all a returning user ever sees, and the methods it lists are enough to
+    resolve the button the user picks without a database round trip. Every
+    user is served by a single process, which sees every method the user
+    adds, so a cached page is kept current by add() instead of being read again.
+    """
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL):
+        self.cache = LRUCache(max_size, ttl)
+
+    def get(self, user_id, kind):
+        """Returns the cached first page of a user's method picker, or None."""
+        entry = self.cache.get((user_id, kind))
+        return entry[2] if entry is not None else None
+
+    def find(self, user_id, kind, method_id):
+        """Returns a method listed on the cached first page, or None."""
+        entry = self.cache.get((user_id, kind))
+        if entry is None:
+            return None
+        return next((method for method in entry[0] if method['_id'] == method_id), None)
+
+    def put(self, user_id, kind, methods, next_cursor):
+        """Caches the first page read from the database. Returns its keyboard."""
+        return self._store(user_id, kind, tuple(methods), next_cursor)
+
+    def add(self, user_id, kind, method):
+        """Updates a cached first page for a newly saved method, which sorts after every other one."""
+        entry = self.cache.peek((user_id, kind))
+        if entry is None:
+            return
+        methods, next_cursor, _ = entry
+        if next_cursor is not None:
+            # The new method is on a later page
+            return
+        if len(methods) < METHOD_PAGE_SIZE:
+            self._store(user_id, kind, methods + (method,), None)
+        else:
+            self._store(user_id, kind, methods, encode_cursor(methods[-1]))
+
+    def _store(self, user_id, kind, methods, next_cursor):
+        markup = build_method_keyboard(kind, methods, None, next_cursor)
+        self.cache.put((user_id, kind), (methods, next_cursor, markup))
+        return markup
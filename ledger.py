@@ -0,0 +1,220 @@
+"""Append-only ledger of balance changes.
+
+Every confirmed deposit or withdrawal appends one document to the transactions
+collection:
+
+    {_id: '<user_id>:<seq>', user_id, seq, ts, type, amount, balance, method}
+
+seq numbers a user's transactions 1, 2, 3... It is kept next to the balance in
+the user document (ledger_seq), so the update that changes the balance also
+advances it. ts never goes backwards for a user (ledger_ts), which makes the
+(user_id, ts, seq) index order and seq order the same.
+
+Handlers do not write the entries themselves. TransactionLedger buffers them
+and writes them in one batch (an unordered insert_many on MongoDB, one
+transaction on SQLite, see storage.py). This happens every
+`flush_interval` seconds, or sooner once `batch_size` entries are waiting. The
+_id comes from (user_id, seq), so writing a batch again after a failure cannot
+duplicate an entry. If the process dies before an entry is written, the user's
+seq numbers show a gap.
+
+The balance is also copied to balance_snapshots before a user's first
+transaction and after every `snapshot_every` transactions. Checking a balance
+then only replays the transactions after the latest snapshot, not the whole
+history.
+"""
+import asyncio
+import contextlib
+import logging
+from datetime import datetime, timedelta, timezone
+
+from repository import AsyncRepository
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LEDGER_FLUSH_INTERVAL = 1
+DEFAULT_LEDGER_BATCH_SIZE = 500
+DEFAULT_SNAPSHOT_EVERY = 100
+HISTORY_PAGE_SIZE = 10
+DUPLICATE_KEY_ERROR = 11000
+
+# pymongo's sort directions, kept here so the SQLite and memory backends never import pymongo
+ASCENDING = 1
+DESCENDING = -1
+
+# Newest first; seq breaks ties between transactions recorded in the same millisecond
+HISTORY_ORDER = [('ts', DESCENDING), ('seq', DESCENDING)]
+REPLAY_ORDER = [('ts', ASCENDING), ('seq', ASCENDING)]
+# Index of both ledger collections, created by schema.py
+LEDGER_INDEX = [('user_id', ASCENDING), ('ts', DESCENDING), ('seq', DESCENDING)]
+
+EPOCH = datetime(1970, 1, 1)
+MILLISECOND = timedelta(milliseconds=1)
+
+
+def ledger_now():
+    """Current UTC time the way MongoDB stores it: naive and truncated to milliseconds."""
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+
+def ledger_entry(user, kind, amount, method=None):
+    """The entry of the last balance change of a user document, as stored after the change."""
+    return {
+        '_id': f"{user['user_id']}:{user['ledger_seq']}",
+        'user_id': user['user_id'],
+        'seq': user['ledger_seq'],
+        'ts': user['ledger_ts'],
+        'type': kind,
+        'amount': amount,
+        'balance': user['balance'],
+        'method': method['description'] if method else None,
+    }
+
+
+def _snapshot(entry, seq, balance):
+    return {
+        '_id': f"{entry['user_id']}:{seq}",
+        'user_id': entry['user_id'],
+        'seq': seq,
+        'ts': entry['ts'],
+        'balance': balance,
+    }
+
+
+def ledger_snapshots(entry, snapshot_every=DEFAULT_SNAPSHOT_EVERY):
+    """The balance snapshots to store along with an entry."""
+    snapshots = []
+    if entry['seq'] == 1:
+        # The opening balance, which predates the ledger for existing users
+        snapshots.append(_snapshot(entry, 0, entry['balance'] - entry['amount']))
+    if entry['seq'] % snapshot_every == 0:
+        snapshots.append(_snapshot(entry, entry['seq'], entry['balance']))
+    return snapshots
+
+
+def insert_entries(collection, documents):
+    """Inserts ledger entries or snapshots, ignoring those an earlier attempt already stored."""
+    from pymongo.errors import BulkWriteError
+
+    try:
+        collection.insert_many(documents, ordered=False)
+    except BulkWriteError as error:
+        # Documents stored by an earlier attempt of the same batch collide on their _id
+        details = error.details
+        if details.get('writeConcernErrors') or any(
+                write_error['code'] != DUPLICATE_KEY_ERROR for write_error in details['writeErrors']):
+            raise
+
+
+def encode_cursor(entry):
+    """Position of an entry in a user's history, compact enough for callback data."""
+    return f"{(entry['ts'] - EPOCH) // MILLISECOND}_{entry['seq']}"
+
+
+def decode_cursor(cursor):
+    milliseconds, seq = cursor.split('_')
+    return EPOCH + int(milliseconds) * MILLISECOND, int(seq)
+
+
+class TransactionLedger(AsyncRepository):
+    """Records balance changes in batches and reads them back page by page."""
+
+    def __init__(self, store, executor, flush_interval=DEFAULT_LEDGER_FLUSH_INTERVAL,
+                 batch_size=DEFAULT_LEDGER_BATCH_SIZE, snapshot_every=DEFAULT_SNAPSHOT_EVERY):
+        super().__init__(store, executor)
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.snapshot_every = snapshot_every
+        self._pending = []
+        self._pending_snapshots = []
+        self._batch_full = asyncio.Event()
+        self._write_lock = asyncio.Lock()
+        self._writer_task = None
+
+    # ------------------ Recording ------------------
+
+    def apply(self, session, amount):
+        """Stages a balance change in a handler's session, which must be loaded.
+
+        Once the session is committed, ledger_entry() describes the change from
+        the stored document, which append() then records.
+        """
+        session.inc('balance', amount)
+        session.inc('ledger_seq', 1)
+        session.set('ledger_ts', max(ledger_now(), session.document.get('ledger_ts', EPOCH)))
+
+    def append(self, entry):
+        """Buffers a committed entry for the next batch."""
+        self._pending.append(entry)
+        self._pending_snapshots.extend(ledger_snapshots(entry, self.snapshot_every))
+
+        if len(self._pending) >= self.batch_size:
+            self._batch_full.set()
+        if self._writer_task is None or self._writer_task.done():
+            self._writer_task = asyncio.get_running_loop().create_task(self._write_batches())
+
+    async def flush(self):
+        """Writes every buffered entry now. Raises if the database refuses them."""
+        await self._write_pending()
+
+    async def _write_batches(self):
+        while self._pending or self._pending_snapshots:
+            if len(self._pending) < self.batch_size:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._batch_full.wait(), self.flush_interval)
+            self._batch_full.clear()
+            try:
+                await self._write_pending()
+            except Exception:
+                # The entries were put back, try again after the next interval
+                logger.exception("Writing %s ledger entries failed", len(self._pending))
+
+    async def _write_pending(self):
+        # One batch at a time, so flush() returns only once a batch in flight is stored as well
+        async with self._write_lock:
+            entries, self._pending = self._pending, []
+            snapshots, self._pending_snapshots = self._pending_snapshots, []
+            try:
+                if entries:
+                    await self._run(self.store.insert_entries, entries)
+                if snapshots:
+                    await self._run(self.store.insert_snapshots, snapshots)
+            except Exception:
+                self._pending[:0] = entries
+                self._pending_snapshots[:0] = snapshots
+                raise
+
+    # ------------------ Reading ------------------
+
+    async def history(self, user_id, cursor=None, limit=HISTORY_PAGE_SIZE):
+        """Returns a page of a user's transactions, newest first, and the cursor of the next page.
+
+        The cursor is None on the last page. Pages start after the (ts, seq) of
+        the previous page's last entry instead of skipping entries, so every
+        page is one short range scan on the (user_id, ts) index.
+        """
+        before = decode_cursor(cursor) if cursor is not None else None
+        entries = await self._run(self.store.history, user_id, before, limit + 1)
+        if len(entries) > limit:
+            return entries[:limit], encode_cursor(entries[limit - 1])
+        return entries, None
+
+    async def replay_balance(self, user_id):
+        """Rebuilds a user's balance from the latest snapshot and the transactions recorded after it.
+
+        Returns a dict with the balance, the seq of the snapshot and of the last
+        transaction, and the number of transactions replayed, or None if the
+        user has no ledger yet.
+        """
+        snapshot = await self._run(self.store.latest_snapshot, user_id)
+        if snapshot is None:
+            return None
+        entries = await self._run(self.store.entries_after, user_id, snapshot['ts'], snapshot['seq'])
+        return {
+            'balance': snapshot['balance'] + sum(entry['amount'] for entry in entries),
+            'snapshot_seq': snapshot['seq'],
+            'seq': entries[-1]['seq'] if entries else snapshot['seq'],
+            'replayed': len(entries),
+        }
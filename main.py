@@ -1,44 +1,267 @@
+import time
+# Origin of the --measure-startup timings
+PROCESS_STARTED = time.perf_counter()
+
 import os
+import sys
+import asyncio
 import logging
-from telegram.ext import ApplicationBuilder
-from handlers import setup_handlers
 from dotenv import load_dotenv
-import pymongo
-from datetime import datetime
+from repository import DEFAULT_MAX_WORKERS
+from startup import DEFAULT_PREWARM_CONNECTIONS, StartupTimer, prewarm_mongo
+from storage import STORAGE_BACKENDS
+
+startup_timer = StartupTimer(PROCESS_STARTED)
+# Prints the start-up phases once updates are being taken, then stops
+MEASURE_STARTUP = '--measure-startup' in sys.argv
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
 load_dotenv()
 
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+# Where users, settings, conversations, the ledger and methods are stored: 'mongo' (default), 'sqlite' or 'memory'
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'mongo')
 MONGO_URI = os.getenv('MONGO_URI')
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'bot.sqlite3')
+DB_MAX_WORKERS = int(os.getenv('DB_MAX_WORKERS', DEFAULT_MAX_WORKERS))
+# MongoDB connections opened at start-up, before the first update needs one
+MONGO_PREWARM_CONNECTIONS = int(os.getenv('MONGO_PREWARM_CONNECTIONS', DEFAULT_PREWARM_CONNECTIONS))
+
+if not TELEGRAM_BOT_TOKEN:
+    raise Exception("Please set the environment variable TELEGRAM_BOT_TOKEN.")
+if STORAGE_BACKEND not in STORAGE_BACKENDS:
+    raise Exception(f"STORAGE_BACKEND must be one of {', '.join(STORAGE_BACKENDS)}.")
+if STORAGE_BACKEND == 'mongo' and not MONGO_URI:
+    raise Exception("Please set the environment variable MONGO_URI, or choose another STORAGE_BACKEND.")
+startup_timer.mark('read the configuration')
+
+mongo_prewarm = None
+if STORAGE_BACKEND == 'mongo':
+    # Only imported when used: pymongo and bson take a noticeable part of the start-up
+    import pymongo
+    from mongo_storage import MongoStorage
+    # The connection pool is sized to match the executor threads that use it
+    client = pymongo.MongoClient(MONGO_URI, maxPoolSize=DB_MAX_WORKERS)
+    storage = MongoStorage(client['bot_database'], client)
+    # Connecting (DNS, TLS, authentication) happens in the background while python-telegram-bot is imported
+    mongo_prewarm = prewarm_mongo(client, min(MONGO_PREWARM_CONNECTIONS, DB_MAX_WORKERS))
+    startup_timer.mark('import pymongo, create the MongoDB client')
+elif STORAGE_BACKEND == 'sqlite':
+    from sqlite_storage import SQLiteStorage
+    storage = SQLiteStorage(SQLITE_PATH)
+    startup_timer.mark('open the SQLite database')
+else:
+    from memory_storage import MemoryStorage
+    storage = MemoryStorage()
+    startup_timer.mark('create the in-memory storage')
+
+from telegram.ext import ApplicationBuilder
+from telegram.request import HTTPXRequest
+from handlers import setup_handlers
+from cache import DEFAULT_CACHE_CHECK_INTERVAL, DEFAULT_CACHE_SIZE, DEFAULT_CACHE_TTL
+from ledger import DEFAULT_LEDGER_FLUSH_INTERVAL, DEFAULT_LEDGER_BATCH_SIZE, DEFAULT_SNAPSHOT_EVERY
+from group_commit import DEFAULT_GROUP_COMMIT_SIZE, DEFAULT_GROUP_COMMIT_WINDOW
+from persistence import DEFAULT_FLUSH_INTERVAL, StoragePersistence
+from expiry import DEFAULT_CONVERSATION_TIMEOUT, DEFAULT_SWEEP_INTERVAL
+from update_processor import DEFAULT_MAX_CONCURRENT_UPDATES, PerUserUpdateProcessor
+from polling import run_polling
+from webhook import DEFAULT_PORT, DEFAULT_QUEUE_SIZE, run_webhook
+from metrics import DEFAULT_METRICS_LISTEN, InstrumentedRequest, Metrics
+from restart import Handoff, track_update_offset
+from rate_limiter import (
+    DEFAULT_CHAT_BURST, DEFAULT_CHAT_RATE, DEFAULT_MAX_RETRIES, DEFAULT_OVERALL_RATE, PRIORITY_NOTICE,
+    PriorityRateLimiter
+)
+from datetime import datetime
+
+startup_timer.mark('import python-telegram-bot and the handlers')
 
-if not all([TELEGRAM_BOT_TOKEN, MONGO_URI]):
-    raise Exception("Please set the environment variables TELEGRAM_BOT_TOKEN and MONGO_URI.")
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', DEFAULT_CACHE_SIZE))
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', DEFAULT_CACHE_TTL))
+# Seconds between two checks for user documents changed by admin.py, which empty the user cache
+USER_CACHE_CHECK_INTERVAL = float(os.getenv('USER_CACHE_CHECK_INTERVAL', DEFAULT_CACHE_CHECK_INTERVAL))
+PERSISTENCE_FLUSH_INTERVAL = float(os.getenv('PERSISTENCE_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL))
+CONVERSATION_TIMEOUT = float(os.getenv('CONVERSATION_TIMEOUT', DEFAULT_CONVERSATION_TIMEOUT))
+CONVERSATION_SWEEP_INTERVAL = float(os.getenv('CONVERSATION_SWEEP_INTERVAL', DEFAULT_SWEEP_INTERVAL))
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', DEFAULT_MAX_CONCURRENT_UPDATES))
+LEDGER_FLUSH_INTERVAL = float(os.getenv('LEDGER_FLUSH_INTERVAL', DEFAULT_LEDGER_FLUSH_INTERVAL))
+LEDGER_BATCH_SIZE = int(os.getenv('LEDGER_BATCH_SIZE', DEFAULT_LEDGER_BATCH_SIZE))
+LEDGER_SNAPSHOT_EVERY = int(os.getenv('LEDGER_SNAPSHOT_EVERY', DEFAULT_SNAPSHOT_EVERY))
+# Seconds balance changes wait to share a batched write with other users' (0 writes each on its own), batch size
+GROUP_COMMIT_WINDOW = float(os.getenv('GROUP_COMMIT_WINDOW', DEFAULT_GROUP_COMMIT_WINDOW))
+GROUP_COMMIT_SIZE = int(os.getenv('GROUP_COMMIT_SIZE', DEFAULT_GROUP_COMMIT_SIZE))
 
-client = pymongo.MongoClient(MONGO_URI)
-db = client['bot_database']
-users_collection = db['users']
-settings_collection = db['settings']
+# Update delivery: 'polling' (default) or 'webhook'
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', DEFAULT_PORT))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', DEFAULT_QUEUE_SIZE))
 
-async def send_restart_message(application):
+# Outbound Bot API limits: messages per second overall and per private chat, burst allowed in a
+# private chat, and retries of a request answered with 429
+OUTBOUND_RATE = float(os.getenv('OUTBOUND_RATE', DEFAULT_OVERALL_RATE))
+OUTBOUND_CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', DEFAULT_CHAT_RATE))
+OUTBOUND_CHAT_BURST = int(os.getenv('OUTBOUND_CHAT_BURST', DEFAULT_CHAT_BURST))
+OUTBOUND_MAX_RETRIES = int(os.getenv('OUTBOUND_MAX_RETRIES', DEFAULT_MAX_RETRIES))
+
+# Prometheus metrics, off unless a port is set; in supervisor mode worker N listens on METRICS_PORT + N
+METRICS_PORT = int(os.getenv('METRICS_PORT')) if os.getenv('METRICS_PORT') else None
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', DEFAULT_METRICS_LISTEN)
+
+# Number of worker processes; more than 1 starts the supervisor, which shards users across them
+WORKERS = int(os.getenv('WORKERS', 1))
+
+if BOT_MODE not in ('polling', 'webhook'):
+    raise Exception("BOT_MODE must be either 'polling' or 'webhook'.")
+if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+    raise Exception("Please set the environment variable WEBHOOK_URL to use the webhook mode.")
+if MEASURE_STARTUP and WORKERS > 1:
+    raise Exception("--measure-startup measures a single process, unset WORKERS to use it.")
+if STORAGE_BACKEND == 'memory' and WORKERS > 1:
+    raise Exception("Each worker would have users of its own with STORAGE_BACKEND=memory, unset WORKERS to use it.")
+
+async def send_restart_message(application, downtime=None):
     """Sends the message 'Restart completed' if necessary."""
-    stored_data = settings_collection.find_one({'key': 'restart_chat_id'})
-    if stored_data and 'value' in stored_data:
-        restart_chat_id = stored_data['value']
-        await application.bot.send_message(chat_id=restart_chat_id, text="Restart has been completed. \nTo continue where you left off, please use the command: /start")
-        settings_collection.delete_one({'key': 'restart_chat_id'})  # Removes the record to prevent resending
+    settings = application.bot_data['settings']
+    restart_chat_id = await settings.get('restart_chat_id')
+    if restart_chat_id is not None:
+        took = f" The bot was unavailable for {downtime:.0f} ms." if downtime is not None else ""
+        await application.bot.send_message(chat_id=restart_chat_id, text=f"Restart has been completed.{took} \nTo continue where you left off, please use the command: /start", rate_limit_args=PRIORITY_NOTICE)
+        await settings.delete('restart_chat_id')  # Removes the record to prevent resending
 
-def main():
-    # Create the bot application
-    application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).post_init(send_restart_message).build()
+async def post_init(application):
+    """Does what must be done before updates are taken: prepares the database and takes over from a restarting process."""
+    startup_timer.mark('initialize the application (getMe)')
+    if mongo_prewarm is not None:
+        started, ended = await asyncio.wrap_future(mongo_prewarm)
+        startup_timer.record('warm up the MongoDB connection pool', started, ended)
+        startup_timer.mark('wait for the MongoDB connection pool')
+    # Work that must happen once per bot is left to the first worker in supervisor mode
+    if application.bot_data.get('shard', 0) == 0:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(application.bot_data['db_executor'], storage.bootstrap)
+        startup_timer.mark('prepare the database (indexes, schema migration)')
+    handoff = application.bot_data.pop('handoff', None)
+    if handoff is not None:
+        # Until now the old process serves, and its metrics endpoint holds the port
+        application.bot_data['restart_downtime'] = await handoff.take_over(application)
+        startup_timer.mark('take over from the old process')
+    if 'metrics' in application.bot_data:
+        await application.bot_data['metrics'].start(application)
+        startup_timer.mark('start the metrics endpoint')
+
+async def post_start(application):
+    """Starts the work nothing has to wait for, once updates are being taken."""
+    startup_timer.mark('start taking updates')
+    if MEASURE_STARTUP:
+        print(startup_timer.report())
+        application.bot_data['stop_serving']()
+        return
+    # Every worker expires the conversations of its own users
+    if 'sweeper' in application.bot_data:
+        await application.bot_data['sweeper'].start(application)
+    if 'cache_validator' in application.bot_data:
+        await application.bot_data['cache_validator'].start(application)
+    if application.bot_data.get('shard', 0) == 0:
+        loop = asyncio.get_running_loop()
+        application.create_task(send_restart_message(application, application.bot_data.pop('restart_downtime', None)))
+        application.create_task(loop.run_in_executor(application.bot_data['db_executor'], storage.check_query_plans))
+
+async def post_stop(application):
+    """Stops the sweeper and the cache validator, writes the ledger entries still buffered and stops the metrics."""
+    if 'sweeper' in application.bot_data:
+        await application.bot_data['sweeper'].stop()
+    if 'cache_validator' in application.bot_data:
+        await application.bot_data['cache_validator'].stop()
+    await application.bot_data['ledger'].flush()
+    if 'metrics' in application.bot_data:
+        await application.bot_data['metrics'].stop()
+
+async def post_shutdown(application):
+    """Hands over to the new process when stopping for a restart."""
+    if 'restart' in application.bot_data:
+        await application.bot_data['restart'].hand_over()
+
+def build_application(owns_user=None, update_queue=None, updater=True, metrics_port=METRICS_PORT,
+                      outbound_rate=OUTBOUND_RATE, handoff=None):
+    """Creates the bot application with its handlers."""
+    metrics = Metrics(METRICS_LISTEN, metrics_port) if metrics_port is not None else None
+    # Conversation states are persisted in the storage and updates of different users are processed concurrently
+    persistence = StoragePersistence(storage.sessions, update_interval=PERSISTENCE_FLUSH_INTERVAL, owns_user=owns_user)
+    builder = (
+        ApplicationBuilder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .persistence(persistence)
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .rate_limiter(PriorityRateLimiter(
+            outbound_rate, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST, max_retries=OUTBOUND_MAX_RETRIES, metrics=metrics
+        ))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if metrics is not None:
+        # Same connection pool size as the request ApplicationBuilder creates by default
+        builder = builder.request(InstrumentedRequest(HTTPXRequest(connection_pool_size=256), metrics))
+    if update_queue is not None:
+        builder = builder.update_queue(update_queue)
+    if not updater:
+        builder = builder.updater(None)
+    application = builder.build()
 
     application.bot_data['start_time'] = datetime.now()
+    if handoff is not None:
+        application.bot_data['handoff'] = handoff
 
-    setup_handlers(application, users_collection, settings_collection)
+    setup_handlers(
+        application, storage, max_workers=DB_MAX_WORKERS, cache_size=USER_CACHE_SIZE, cache_ttl=USER_CACHE_TTL,
+        cache_check_interval=USER_CACHE_CHECK_INTERVAL,
+        ledger_flush_interval=LEDGER_FLUSH_INTERVAL, ledger_batch_size=LEDGER_BATCH_SIZE,
+        snapshot_every=LEDGER_SNAPSHOT_EVERY, conversation_timeout=CONVERSATION_TIMEOUT,
+        sweep_interval=CONVERSATION_SWEEP_INTERVAL, group_commit_window=GROUP_COMMIT_WINDOW,
+        group_commit_size=GROUP_COMMIT_SIZE, metrics=metrics
+    )
+    if updater:
+        track_update_offset(application)
+    return application
 
+def build_worker_application(index, shards):
+    """Creates the application of a worker process, which only serves the users of its shard."""
+    from supervisor import shard_for
+    application = build_application(
+        owns_user=lambda user_id: shard_for(user_id, shards) == index, updater=False,
+        metrics_port=METRICS_PORT + index if METRICS_PORT is not None else None,
+        # The overall limit applies to the bot, so the workers share it
+        outbound_rate=OUTBOUND_RATE / shards
+    )
+    application.bot_data['shard'] = index
+    return application
+
+def main():
+    # Set when this process was started by /debug_restart to replace the running one
+    handoff = Handoff.from_environment()
     # Start the bot
-    application.run_polling()
+    if WORKERS > 1:
+        # Imported here, multiprocessing is only needed with several workers
+        from supervisor import run_supervisor
+        run_supervisor(
+            TELEGRAM_BOT_TOKEN, build_worker_application, WORKERS, mode=BOT_MODE, webhook_url=WEBHOOK_URL,
+            listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, secret_token=WEBHOOK_SECRET, queue_size=WEBHOOK_QUEUE_SIZE,
+            post_start=post_start
+        )
+    elif BOT_MODE == 'webhook':
+        # Bounded so a burst is refused at the door instead of piling up in memory
+        application = build_application(update_queue=asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE), handoff=handoff)
+        startup_timer.mark('build the application')
+        run_webhook(application, WEBHOOK_URL, listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, secret_token=WEBHOOK_SECRET,
+                    sock=handoff.listen_socket() if handoff is not None else None, post_start=post_start)
+    else:
+        application = build_application(handoff=handoff)
+        startup_timer.mark('build the application')
+        run_polling(application, post_start=post_start)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,243 @@
+"""Storage backend keeping everything in the memory of the process.
+
+Meant for tests and for trying the bot out without a database: nothing
+survives a restart, and each worker process would have data of its own, so
+main.py refuses it with WORKERS. Documents are copied on the way in and
+out, like a database would, so callers can change what they get.
+
+Ledger entries and methods are kept per user in lists sorted the way they
+are read, so history and method pages are a bisection and a slice. Their
+documents are flat, so copying them is a dict() instead of a deepcopy.
+"""
+import bisect
+import copy
+import threading
+
+from repository import apply_update
+from storage import (
+    LedgerStore, MethodStore, SessionStore, SettingsStore, Storage, UserStore, cleared_temp_data, matches_condition,
+    upserted_document
+)
+
+
+class MemoryUserStore(UserStore):
+    def __init__(self):
+        self.documents = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            return copy.deepcopy(self.documents.get(user_id))
+
+    def insert(self, document):
+        with self._lock:
+            if document['user_id'] in self.documents:
+                raise KeyError(f"user {document['user_id']} already exists")
+            self.documents[document['user_id']] = copy.deepcopy(document)
+
+    def _apply(self, user_id, update, upsert, condition):
+        """Applies an update under the lock. Returns the stored document, or None if it did not apply."""
+        document = self.documents.get(user_id)
+        if document is None:
+            if not upsert:
+                return None
+            document = self.documents[user_id] = upserted_document(user_id, update, condition)
+            return document
+        if not matches_condition(document, condition):
+            return None
+        apply_update(document, update)
+        return document
+
+    def update(self, user_id, update, condition=None):
+        with self._lock:
+            return self._apply(user_id, update, False, condition) is not None
+
+    def update_and_get(self, user_id, update, upsert=False, condition=None):
+        with self._lock:
+            return copy.deepcopy(self._apply(user_id, update, upsert, condition))
+
+    def update_many(self, requests):
+        with self._lock:
+            return [
+                copy.deepcopy(self._apply(user_id, update, False, condition))
+                for user_id, update, condition in requests
+            ]
+
+    def clear_temp_data(self, user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                if user_id in self.documents:
+                    cleared_temp_data(self.documents[user_id])
+
+
+class MemorySettingsStore(SettingsStore):
+    def __init__(self):
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return copy.deepcopy(self.values.get(key))
+
+    def set(self, key, value):
+        with self._lock:
+            self.values[key] = copy.deepcopy(value)
+
+    def delete(self, key):
+        with self._lock:
+            self.values.pop(key, None)
+
+
+class MemorySessionStore(SessionStore):
+    def __init__(self):
+        # (name, key) -> (state, state_updated_at)
+        self.states = {}
+        self.data = {}
+        self._lock = threading.Lock()
+
+    def conversations(self, name):
+        with self._lock:
+            return {key: state for (stored_name, key), (state, _) in self.states.items() if stored_name == name}
+
+    def user_data(self):
+        with self._lock:
+            return copy.deepcopy(self.data)
+
+    def write_conversations(self, changes):
+        with self._lock:
+            for (name, key), (state, updated_at) in changes.items():
+                if state is None:
+                    self.states.pop((name, tuple(key)), None)
+                else:
+                    self.states[(name, tuple(key))] = (state, updated_at)
+
+    def write_user_data(self, changes):
+        with self._lock:
+            for user_id, data in changes.items():
+                if data is None:
+                    self.data.pop(user_id, None)
+                else:
+                    self.data[user_id] = copy.deepcopy(data)
+
+    def expired_conversations(self, name, before, batch_size):
+        with self._lock:
+            expired = [
+                (key, state) for (stored_name, key), (state, updated_at) in self.states.items()
+                if stored_name == name and updated_at < before
+            ]
+        yield from expired
+
+
+class _SortedDocuments:
+    """Documents of one user, sorted by a key, with each _id stored once."""
+
+    def __init__(self):
+        self.keys = []
+        self.documents = []
+        self.ids = {}
+
+    def insert(self, key, document):
+        if document['_id'] in self.ids:
+            return False
+        index = bisect.bisect_right(self.keys, key)
+        self.keys.insert(index, key)
+        self.documents.insert(index, dict(document))
+        self.ids[document['_id']] = self.documents[index]
+        return True
+
+
+def _ledger_key(document):
+    return document['ts'], document['seq']
+
+
+class MemoryLedgerStore(LedgerStore):
+    def __init__(self):
+        self.entries = {}
+        self.snapshots = {}
+        self._lock = threading.Lock()
+
+    def _insert(self, by_user, documents):
+        with self._lock:
+            for document in documents:
+                by_user.setdefault(document['user_id'], _SortedDocuments()).insert(_ledger_key(document), document)
+
+    def insert_entries(self, entries):
+        self._insert(self.entries, entries)
+
+    def insert_snapshots(self, snapshots):
+        self._insert(self.snapshots, snapshots)
+
+    def history(self, user_id, before=None, limit=None):
+        with self._lock:
+            ledger = self.entries.get(user_id)
+            if ledger is None:
+                return []
+            end = bisect.bisect_left(ledger.keys, before) if before is not None else len(ledger.keys)
+            start = max(0, end - limit) if limit else 0
+            return [dict(entry) for entry in reversed(ledger.documents[start:end])]
+
+    def latest_snapshot(self, user_id):
+        with self._lock:
+            snapshots = self.snapshots.get(user_id)
+            return dict(snapshots.documents[-1]) if snapshots else None
+
+    def entries_after(self, user_id, ts, seq):
+        with self._lock:
+            ledger = self.entries.get(user_id)
+            if ledger is None:
+                return []
+            start = bisect.bisect_right(ledger.keys, (ts, seq))
+            return [{'seq': entry['seq'], 'amount': entry['amount']} for entry in ledger.documents[start:]]
+
+
+def _method_key(document):
+    return document['added_at'], document['_id']
+
+
+class MemoryMethodStore(MethodStore):
+    def __init__(self):
+        # (user_id, kind) -> _SortedDocuments
+        self.methods = {}
+        self._lock = threading.Lock()
+
+    def page(self, user_id, kind, after=None, limit=None):
+        with self._lock:
+            methods = self.methods.get((user_id, kind))
+            if methods is None:
+                return []
+            start = bisect.bisect_right(methods.keys, tuple(after)) if after is not None else 0
+            page = []
+            for method in methods.documents[start:]:
+                if 'invalid' not in method:
+                    page.append(dict(method))
+                    if len(page) == limit:
+                        break
+            return page
+
+    def get(self, user_id, kind, method_id):
+        with self._lock:
+            methods = self.methods.get((user_id, kind))
+            method = methods.ids.get(method_id) if methods is not None else None
+            return dict(method) if method is not None and 'invalid' not in method else None
+
+    def add(self, document):
+        with self._lock:
+            methods = self.methods.setdefault((document['user_id'], document['kind']), _SortedDocuments())
+            existing = methods.ids.get(document['_id'])
+            if existing is not None:
+                return dict(existing)
+            methods.insert(_method_key(document), document)
+            return None
+
+
+class MemoryStorage(Storage):
+    name = 'memory'
+
+    def __init__(self):
+        super().__init__(
+            users=MemoryUserStore(),
+            settings=MemorySettingsStore(),
+            sessions=MemorySessionStore(),
+            ledger=MemoryLedgerStore(),
+            methods=MemoryMethodStore(),
+        )
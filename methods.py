@@ -0,0 +1,93 @@
+"""Saved deposit and withdrawal methods.
+
+Each method is one document of the payment_methods collection:
+
+    {_id, user_id, kind, type, detail, description, added_at[, invalid]}
+
+kind is the flow the method belongs to ('deposit' or 'withdrawal'). The _id
+is a hash of (user_id, kind, type, detail): saving a method the user already
+has matches the stored document instead of adding a second one, and the _id
+stays the same for as long as the method exists, so callback data can carry
+it instead of a position in a list. Methods found invalid by
+validation.revalidate_methods() carry the error in `invalid` and are no
+longer offered.
+
+A user's methods are listed in the order they were added, a page at a time.
+Like the history pages of ledger.py, a page starts after the (added_at, _id)
+of the previous page's last method, so every page is one short range scan on
+the (user_id, kind, added_at) index however many methods the user has.
+"""
+import hashlib
+
+from ledger import ASCENDING, EPOCH, MILLISECOND, ledger_now
+from repository import AsyncRepository
+
+
+METHOD_PAGE_SIZE = 5
+# Fields of a method shown to the user and copied into temp_data and exports
+METHOD_FIELDS = ('type', 'detail', 'description')
+
+# Order of a user's methods of one kind; also the index created by schema.py
+METHOD_ORDER = [('added_at', ASCENDING), ('_id', ASCENDING)]
+METHOD_INDEX = [('user_id', ASCENDING), ('kind', ASCENDING), *METHOD_ORDER]
+
+# Regex of the callback arguments below
+METHOD_ID_PATTERN = r'[0-9a-f]{16}'
+METHOD_CURSOR_PATTERN = rf'\d+_{METHOD_ID_PATTERN}'
+
+
+def hash_method(user_id, kind, method_type, detail):
+    """Identifies a method by what it is, compact enough for callback data."""
+    key = f'{user_id}\0{kind}\0{method_type}\0{detail}'.encode()
+    return hashlib.sha256(key).hexdigest()[:16]
+
+
+def method_document(user_id, kind, method_type, detail, added_at=None):
+    return {
+        '_id': hash_method(user_id, kind, method_type, detail),
+        'user_id': user_id,
+        'kind': kind,
+        'type': method_type,
+        'detail': detail,
+        'description': f'{method_type}: {detail}',
+        'added_at': added_at or ledger_now(),
+    }
+
+
+def method_fields(method):
+    """The fields of a method stored along with a transaction."""
+    return {field: method[field] for field in METHOD_FIELDS}
+
+
+def encode_cursor(method):
+    """Position of a method in a user's list, compact enough for callback data."""
+    return f"{(method['added_at'] - EPOCH) // MILLISECOND}_{method['_id']}"
+
+
+def decode_cursor(cursor):
+    milliseconds, last_id = cursor.split('_')
+    return EPOCH + int(milliseconds) * MILLISECOND, last_id
+
+
+class MethodRepository(AsyncRepository):
+    """Saved methods, read back one page at a time."""
+
+    async def page(self, user_id, kind, cursor=None, limit=METHOD_PAGE_SIZE):
+        """Returns a page of a user's methods of one kind, oldest first, and the cursor of the next page.
+
+        The cursor is None on the last page.
+        """
+        after = decode_cursor(cursor) if cursor is not None else None
+        methods = await self._run(self.store.page, user_id, kind, after, limit + 1)
+        if len(methods) > limit:
+            return methods[:limit], encode_cursor(methods[limit - 1])
+        return methods, None
+
+    async def get(self, user_id, kind, method_id):
+        return await self._run(self.store.get, user_id, kind, method_id)
+
+    async def add(self, user_id, kind, method_type, detail):
+        """Saves a method unless the user already has it. Returns (stored method, whether it is new)."""
+        document = method_document(user_id, kind, method_type, detail)
+        existing = await self._run(self.store.add, document)
+        return (document, True) if existing is None else (existing, False)
@@ -0,0 +1,339 @@
+"""Prometheus metrics of the running bot.
+
+Metrics are off unless METRICS_PORT is set. Off means nothing is wrapped: the
+handlers, stores and Bot API requests are the plain objects, so the only
+cost left is one `if metrics` at start-up.
+
+When they are on, setup_handlers wraps every handler it registers and the
+stores of the storage it is given, main.py wraps the Bot API request object, and
+Metrics.start serves the text exposition format on
+http://METRICS_LISTEN:METRICS_PORT/metrics:
+
+- bot_handler_seconds{handler, state}: handler latency, by the conversation
+  state the user was in when the update arrived;
+- bot_handler_errors_total{handler, state}: handlers that raised;
+- bot_db_op_seconds{store, op}: duration of each call of a storage.py store
+  (users, settings, ledger, methods), measured on the executor thread, so
+  time spent waiting for a free thread is not in it;
+- bot_api_request_seconds{method} and bot_api_rate_limited_total{method}:
+  Bot API round trips and the 429 answers among them;
+- bot_rate_limiter_wait_seconds{priority}: time outbound requests waited in
+  rate_limiter.PriorityRateLimiter before being sent;
+- bot_webhook_requests_total{status}: webhook requests by the HTTP status
+  they were answered with, 503 meaning the update queue was full;
+- bot_confirmations_suppressed_total{reason}: repeated transaction
+  confirmations dropped by dedup.ConfirmationDeduplicator;
+- bot_group_commit_batch_size: balance changes written per batch of
+  group_commit.GroupCommitter;
+- bot_event_loop_lag_seconds: how late a periodic timer fires, i.e. how long
+  something held the event loop;
+- bot_update_queue_size: updates received but not yet taken by the Application.
+
+Histograms only keep bucket counters, so recording is a bisect and a few
+integer additions under a lock. The lock is needed because database
+operations are recorded from the executor threads.
+"""
+import asyncio
+import bisect
+import functools
+import logging
+import threading
+import time
+
+from telegram.ext import ConversationHandler
+from telegram.request import BaseRequest
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_METRICS_LISTEN = '127.0.0.1'
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+LOOP_LAG_INTERVAL = 0.5
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, *labels):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        for labels, value in sorted(self._values.items()):
+            yield self.name, _format_labels(self.labelnames, labels), value
+
+
+class Gauge:
+    """Single value read from a callback when the metrics are scraped."""
+
+    type = 'gauge'
+
+    def __init__(self, name, documentation, read=None):
+        self.name = name
+        self.documentation = documentation
+        self.read = read
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        yield self.name, '', self.read() if self.read is not None else self.value
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket..., count above the last bucket, sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def count(self, *labels):
+        series = self._series.get(labels)
+        return sum(series[:-1]) if series else 0
+
+    def samples(self):
+        names = self.labelnames + ('le',)
+        for labels, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                cumulative += count
+                yield f'{self.name}_bucket', _format_labels(names, labels + (bound,)), cumulative
+            yield f'{self.name}_sum', _format_labels(self.labelnames, labels), series[-1]
+            yield f'{self.name}_count', _format_labels(self.labelnames, labels), cumulative
+
+
+class Metrics:
+    """The bot's metrics, their exposition endpoint and the event loop lag probe."""
+
+    def __init__(self, listen=DEFAULT_METRICS_LISTEN, port=None):
+        self.listen = listen
+        self.port = port
+        self.handler_seconds = Histogram('bot_handler_seconds', 'Handler latency.', ('handler', 'state'))
+        self.handler_errors = Counter('bot_handler_errors_total', 'Handlers that raised.', ('handler', 'state'))
+        self.db_op_seconds = Histogram('bot_db_op_seconds', 'Duration of storage operations.', ('store', 'op'))
+        self.api_request_seconds = Histogram('bot_api_request_seconds', 'Duration of Bot API requests.', ('method',))
+        self.api_rate_limited = Counter(
+            'bot_api_rate_limited_total', 'Bot API requests answered with 429 Too Many Requests.', ('method',)
+        )
+        self.rate_limiter_wait_seconds = Histogram(
+            'bot_rate_limiter_wait_seconds', 'Time outbound requests waited for the rate limiter.', ('priority',)
+        )
+        self.webhook_requests = Counter('bot_webhook_requests_total', 'Webhook requests by answer status.', ('status',))
+        self.confirmations_suppressed = Counter(
+            'bot_confirmations_suppressed_total', 'Repeated transaction confirmations dropped.', ('reason',)
+        )
+        self.group_commit_batch_size = Histogram(
+            'bot_group_commit_batch_size', 'Balance changes written per group commit batch.',
+            buckets=BATCH_SIZE_BUCKETS
+        )
+        self.loop_lag_seconds = Histogram('bot_event_loop_lag_seconds', 'Delay of a periodic event loop timer.')
+        self.update_queue_size = Gauge('bot_update_queue_size', 'Updates waiting in the update queue.')
+        self.metrics = [
+            self.handler_seconds, self.handler_errors, self.db_op_seconds, self.api_request_seconds,
+            self.api_rate_limited, self.rate_limiter_wait_seconds, self.webhook_requests, self.confirmations_suppressed,
+            self.group_commit_batch_size, self.loop_lag_seconds, self.update_queue_size,
+        ]
+        self._server = None
+        self._lag_task = None
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    async def start(self, application):
+        """Starts the lag probe and, if a port was given, the HTTP endpoint."""
+        self.update_queue_size.read = application.update_queue.qsize
+        self._lag_task = asyncio.get_running_loop().create_task(self._probe_loop_lag())
+        if self.port is not None:
+            self._server = await asyncio.start_server(self._handle_connection, self.listen, self.port)
+            self.port = self._server.sockets[0].getsockname()[1]
+            logger.info("Metrics available on http://%s:%s/metrics", self.listen, self.port)
+
+    async def stop(self):
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+            self._lag_task = None
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _probe_loop_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + LOOP_LAG_INTERVAL
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            self.loop_lag_seconds.observe(max(0.0, loop.time() - expected))
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 10)
+            while (await asyncio.wait_for(reader.readline(), 10)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) == 3 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', self.render().encode()
+            else:
+                status, body = '404 Not Found', b''
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {CONTENT_TYPE}\r\nContent-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode('latin-1') + body
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.TimeoutError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+# ------------------ Instrumentation ------------------
+
+def _callback_name(callback):
+    # Flow steps are registered as functools.partial objects
+    return getattr(getattr(callback, 'func', callback), '__name__', repr(callback))
+
+
+def timed_callback(callback, metrics, default_state):
+    """Wraps a handler callback so its latency is recorded."""
+    name = _callback_name(callback)
+
+    async def timed(update, context):
+        user_data = context.user_data
+        state = user_data.get('state', default_state) if user_data is not None else default_state
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            metrics.handler_errors.inc(name, state)
+            raise
+        finally:
+            metrics.handler_seconds.observe(time.perf_counter() - started, name, state)
+
+    timed.__name__ = name
+    timed.__wrapped__ = callback
+    return timed
+
+
+def instrument_handlers(application, metrics, default_state):
+    """Times every handler registered on the application, including those inside conversations."""
+    def instrument(handler):
+        if isinstance(handler, ConversationHandler):
+            for child in handler.entry_points + handler.fallbacks:
+                instrument(child)
+            for handlers in handler.states.values():
+                for child in handlers:
+                    instrument(child)
+        else:
+            handler.callback = timed_callback(handler.callback, metrics, default_state)
+
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            instrument(handler)
+
+
+class InstrumentedStore:
+    """Store proxy that times every public method of a storage.py store."""
+
+    def __init__(self, store, metrics, name):
+        self._store = store
+        self._metrics = metrics
+        self._name = name
+
+    def __getattr__(self, attribute):
+        value = getattr(self._store, attribute)
+        if attribute.startswith('_') or not callable(value):
+            return value
+        histogram, labels = self._metrics.db_op_seconds, (self._name, attribute)
+
+        @functools.wraps(value)
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return value(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, *labels)
+
+        # Later lookups find the wrapper directly and skip __getattr__
+        setattr(self, attribute, timed)
+        return timed
+
+
+class InstrumentedRequest(BaseRequest):
+    """Bot API request object that times every call made through another one."""
+
+    def __init__(self, request, metrics):
+        self._request = request
+        self._metrics = metrics
+
+    @property
+    def read_timeout(self):
+        return self._request.read_timeout
+
+    async def initialize(self):
+        await self._request.initialize()
+
+    async def shutdown(self):
+        await self._request.shutdown()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE):
+        endpoint = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            status, payload = await self._request.do_request(
+                url, method, request_data=request_data, read_timeout=read_timeout, write_timeout=write_timeout,
+                connect_timeout=connect_timeout, pool_timeout=pool_timeout
+            )
+        finally:
+            self._metrics.api_request_seconds.observe(time.perf_counter() - started, endpoint)
+        if status == 429:
+            self._metrics.api_rate_limited.inc(endpoint)
+        return status, payload
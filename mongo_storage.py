@@ -0,0 +1,248 @@
+"""Storage backend on the bot_database of a MongoDB deployment.
+
+Each store is a thin layer of queries over one or two collections, served
+by the indexes schema.py creates:
+
+    users               user documents, updated with the operators UserSession stages
+    settings            {key, value}
+    conversations       {name, key, state, state_updated_at}
+    user_data           {user_id, data}
+    transactions        ledger entries       } see ledger.py
+    balance_snapshots   balance snapshots    }
+    payment_methods     saved methods, see methods.py
+
+A batch of user updates (update_many) is one ordered bulk_write, which only
+reports how many documents matched in total. Every update of the batch also
+sets group_commit to the id of the batch, like admin.py marks the users it
+changes, so one find afterwards tells which updates applied and returns the
+documents as stored. A last update_many removes the marker again; a marker
+left behind by a process that died in between only names a batch no one
+will look for.
+
+`db` only needs to map collection names to collections, so the benchmarks
+run this backend on in-memory fakes.
+"""
+import logging
+import uuid
+
+from pymongo import DeleteOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+import schema
+from ledger import HISTORY_ORDER, REPLAY_ORDER, insert_entries
+from methods import METHOD_ORDER
+from storage import LedgerStore, MethodStore, SessionStore, SettingsStore, Storage, UserStore
+
+
+logger = logging.getLogger(__name__)
+
+# Field marking the user documents a batch of update_many changed, until the batch resolves
+GROUP_COMMIT_MARKER = 'group_commit'
+
+
+def _user_query(user_id, condition=None):
+    return {'user_id': user_id, **condition} if condition else {'user_id': user_id}
+
+
+class MongoUserStore(UserStore):
+    def __init__(self, collection):
+        self.collection = collection
+
+    def get(self, user_id):
+        return self.collection.find_one({'user_id': user_id})
+
+    def insert(self, document):
+        self.collection.insert_one(document)
+
+    def update(self, user_id, update, condition=None):
+        return self.collection.update_one(_user_query(user_id, condition), update).matched_count > 0
+
+    def update_and_get(self, user_id, update, upsert=False, condition=None):
+        # A single round trip
+        return self.collection.find_one_and_update(
+            _user_query(user_id, condition), update, upsert=upsert, return_document=ReturnDocument.AFTER
+        )
+
+    def update_many(self, requests):
+        batch_id = uuid.uuid4().hex
+        operations = []
+        for user_id, update, condition in requests:
+            marked = dict(update)
+            marked['$set'] = {**update.get('$set', {}), GROUP_COMMIT_MARKER: batch_id}
+            operations.append(UpdateOne(_user_query(user_id, condition), marked))
+        error, attempted = None, len(requests)
+        try:
+            self.collection.bulk_write(operations, ordered=True)
+        except BulkWriteError as exc:
+            # Ordered: the updates after the one that failed were not attempted
+            error, attempted = exc, exc.details['writeErrors'][0]['index']
+        except PyMongoError as exc:
+            # Which updates reached the server is unknown, only the marker tells
+            error, attempted = exc, 0
+        stored = {
+            document['user_id']: document
+            for document in self.collection.find({'user_id': {'$in': [user_id for user_id, _, _ in requests]}})
+        }
+        results, marked = [], []
+        for index, (user_id, _, _) in enumerate(requests):
+            document = stored.get(user_id)
+            if document is not None and document.pop(GROUP_COMMIT_MARKER, None) == batch_id:
+                results.append(document)
+                marked.append(user_id)
+            else:
+                results.append(None if index < attempted else error)
+        if marked:
+            try:
+                self.collection.update_many(
+                    {'user_id': {'$in': marked}, GROUP_COMMIT_MARKER: batch_id}, {'$unset': {GROUP_COMMIT_MARKER: ''}}
+                )
+            except PyMongoError:
+                # The updates are stored and their results known, only the markers stay
+                logger.warning("Removing the markers of group commit batch %s failed", batch_id, exc_info=True)
+        return results
+
+    def clear_temp_data(self, user_ids):
+        query = {'user_id': {'$in': user_ids}, '$or': [{'temp_data': {'$ne': {}}}, {'state': {'$exists': True}}]}
+        self.collection.update_many(query, {'$set': {'temp_data': {}}, '$unset': {'state': ''}})
+
+
+class MongoSettingsStore(SettingsStore):
+    def __init__(self, collection):
+        self.collection = collection
+
+    def get(self, key):
+        document = self.collection.find_one({'key': key})
+        if document and 'value' in document:
+            return document['value']
+        return None
+
+    def set(self, key, value):
+        self.collection.update_one({'key': key}, {'$set': {'value': value}}, upsert=True)
+
+    def delete(self, key):
+        self.collection.delete_one({'key': key})
+
+
+class MongoSessionStore(SessionStore):
+    """Every write is one unordered bulk_write per collection."""
+
+    def __init__(self, conversations, user_data):
+        self.conversations_collection = conversations
+        self.user_data_collection = user_data
+
+    def conversations(self, name):
+        documents = self.conversations_collection.find({'name': name})
+        return {tuple(document['key']): document['state'] for document in documents}
+
+    def user_data(self):
+        return {document['user_id']: document['data'] for document in self.user_data_collection.find({})}
+
+    def write_conversations(self, changes):
+        requests = []
+        for (name, key), (state, updated_at) in changes.items():
+            selector = {'name': name, 'key': list(key)}
+            if state is None:
+                requests.append(DeleteOne(selector))
+            else:
+                update = {'$set': {'state': state, 'state_updated_at': updated_at}}
+                requests.append(UpdateOne(selector, update, upsert=True))
+        if requests:
+            self.conversations_collection.bulk_write(requests, ordered=False)
+
+    def write_user_data(self, changes):
+        requests = []
+        for user_id, data in changes.items():
+            if data is None:
+                requests.append(DeleteOne({'user_id': user_id}))
+            else:
+                requests.append(UpdateOne({'user_id': user_id}, {'$set': {'data': data}}, upsert=True))
+        if requests:
+            self.user_data_collection.bulk_write(requests, ordered=False)
+
+    def expired_conversations(self, name, before, batch_size):
+        # The cursor fetches batch_size documents per round trip, and is closed along with the generator
+        cursor = self.conversations_collection.find(
+            {'name': name, 'state_updated_at': {'$lt': before}},
+            projection={'_id': False, 'key': True, 'state': True}, batch_size=batch_size
+        )
+        try:
+            for document in cursor:
+                yield tuple(document['key']), document['state']
+        finally:
+            cursor.close()
+
+
+class MongoLedgerStore(LedgerStore):
+    def __init__(self, transactions, snapshots):
+        self.collection = transactions
+        self.snapshots_collection = snapshots
+
+    def insert_entries(self, entries):
+        insert_entries(self.collection, entries)
+
+    def insert_snapshots(self, snapshots):
+        insert_entries(self.snapshots_collection, snapshots)
+
+    def history(self, user_id, before=None, limit=None):
+        query = {'user_id': user_id}
+        if before is not None:
+            # ts never goes backwards within a user's ledger, so this equals (ts, seq) < before
+            query['ts'] = {'$lte': before[0]}
+            query['seq'] = {'$lt': before[1]}
+        return list(self.collection.find(query, sort=HISTORY_ORDER, limit=limit or 0))
+
+    def latest_snapshot(self, user_id):
+        return self.snapshots_collection.find_one({'user_id': user_id}, sort=HISTORY_ORDER)
+
+    def entries_after(self, user_id, ts, seq):
+        query = {'user_id': user_id, 'ts': {'$gte': ts}, 'seq': {'$gt': seq}}
+        return list(self.collection.find(query, projection={'seq': True, 'amount': True}, sort=REPLAY_ORDER))
+
+
+class MongoMethodStore(MethodStore):
+    def __init__(self, collection):
+        self.collection = collection
+
+    def page(self, user_id, kind, after=None, limit=None):
+        query = {'user_id': user_id, 'kind': kind, 'invalid': {'$exists': False}}
+        if after is not None:
+            added_at, last_id = after
+            query['$or'] = [{'added_at': {'$gt': added_at}}, {'added_at': added_at, '_id': {'$gt': last_id}}]
+        return list(self.collection.find(query, sort=METHOD_ORDER, limit=limit or 0))
+
+    def get(self, user_id, kind, method_id):
+        query = {'_id': method_id, 'user_id': user_id, 'kind': kind, 'invalid': {'$exists': False}}
+        return self.collection.find_one(query)
+
+    def add(self, document):
+        query = {'_id': document['_id'], 'user_id': document['user_id']}
+        inserted = {key: value for key, value in document.items() if key not in query}
+        # The document as it was before the upsert: None if the method is new
+        return self.collection.find_one_and_update(
+            query, {'$setOnInsert': inserted}, upsert=True, return_document=ReturnDocument.BEFORE
+        )
+
+
+class MongoStorage(Storage):
+    name = 'mongo'
+
+    def __init__(self, db, client=None):
+        self.db = db
+        self.client = client
+        super().__init__(
+            users=MongoUserStore(db['users']),
+            settings=MongoSettingsStore(db['settings']),
+            sessions=MongoSessionStore(db['conversations'], db['user_data']),
+            ledger=MongoLedgerStore(db['transactions'], db['balance_snapshots']),
+            methods=MongoMethodStore(db['payment_methods']),
+        )
+
+    def bootstrap(self):
+        schema.bootstrap(self.db, query_plans=False)
+
+    def check_query_plans(self):
+        schema.check_query_plans(self.db)
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
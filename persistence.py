@@ -0,0 +1,145 @@
+"""python-telegram-bot persistence backed by the sessions store of the bot's storage.
+
+The Application hands changed conversation states and user_data to the
+persistence every `update_interval` seconds. StoragePersistence only buffers
+them in memory and writes each run as one write of conversations and one of
+user_data (one bulk_write per collection on MongoDB), so conversation
+bookkeeping never adds a database round trip to a handler.
+
+Every conversation state is stored with the time it was last written
+(state_updated_at), which expiry.ConversationSweeper uses to find abandoned
+conversations.
+
+bot_data is not persisted: it holds the live repositories and statistics set
+up by setup_handlers, and chat_data is not used by the bot.
+"""
+import asyncio
+import copy
+from functools import partial
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from ledger import ledger_now
+from repository import create_executor
+
+
+DEFAULT_FLUSH_INTERVAL = 5
+
+
+class StoragePersistence(BasePersistence):
+    """Stores ConversationHandler states and user_data in a storage.SessionStore."""
+
+    def __init__(self, sessions, update_interval=DEFAULT_FLUSH_INTERVAL, executor=None, owns_user=None):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.sessions = sessions
+        # A single thread keeps the flushes in the order they were issued
+        self.executor = executor or create_executor(1)
+        # Worker processes only load the users of their own shard
+        self.owns_user = owns_user or (lambda user_id: True)
+        self._user_data = None
+        self._pending_conversations = {}
+        self._pending_user_data = {}
+        self._flush_task = None
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    def _schedule_flush(self):
+        # The Application calls the update_* methods of one run concurrently. Flushing from a
+        # separate task lets all of them land in the buffer before anything is written.
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._write_pending())
+
+    # ------------------ Loading ------------------
+
+    async def get_conversations(self, name):
+        conversations = await self._run(self.sessions.conversations, name)
+        # Conversation keys are (chat_id, user_id)
+        return {key: state for key, state in conversations.items() if self.owns_user(key[-1])}
+
+    async def get_user_data(self):
+        if self._user_data is None:
+            user_data = await self._run(self.sessions.user_data)
+            self._user_data = {user_id: data for user_id, data in user_data.items() if self.owns_user(user_id)}
+        return copy.deepcopy(self._user_data)
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    # ------------------ Buffered updates ------------------
+
+    async def update_conversation(self, name, key, new_state):
+        self._pending_conversations[(name, tuple(key))] = (new_state, ledger_now())
+        self._schedule_flush()
+
+    async def update_user_data(self, user_id, data):
+        if self._user_data is None:
+            self._user_data = {}
+        # The Application reports every user that sent an update, changed or not
+        if self._user_data.get(user_id) == data:
+            return
+        self._user_data[user_id] = data
+        self._pending_user_data[user_id] = data
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id):
+        if self._user_data is not None:
+            self._user_data.pop(user_id, None)
+        self._pending_user_data[user_id] = None
+        self._schedule_flush()
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    # ------------------ Writing ------------------
+
+    async def flush(self):
+        """Waits for a scheduled write and writes whatever is still buffered."""
+        if self._flush_task is not None and not self._flush_task.done():
+            await self._flush_task
+        await self._write_pending()
+
+    async def _write_pending(self):
+        """Writes everything buffered so far, conversations first."""
+        conversations, self._pending_conversations = self._pending_conversations, {}
+        user_data, self._pending_user_data = self._pending_user_data, {}
+        try:
+            if conversations:
+                await self._run(self.sessions.write_conversations, conversations)
+            if user_data:
+                await self._run(self.sessions.write_user_data, user_data)
+        except Exception:
+            # Put the entries back for the next run unless a newer value was buffered meanwhile
+            for key, pending in conversations.items():
+                self._pending_conversations.setdefault(key, pending)
+            for user_id, data in user_data.items():
+                self._pending_user_data.setdefault(user_id, data)
+            raise
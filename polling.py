@@ -0,0 +1,47 @@
+"""Long polling serving mode.
+
+Application.run_polling runs everything between start-up and shutdown
+itself, so nothing can run once updates are being taken and it can only be
+stopped from a handler with Application.stop_running. serve_polling is the
+polling counterpart of webhook.serve_webhook: same post_init/post_stop/
+post_shutdown hooks, plus post_start once the updater is fetching updates,
+and a stop event exposed as bot_data['stop_serving'].
+"""
+import asyncio
+import signal
+
+
+async def serve_polling(application, stop_event=None, post_start=None):
+    """Runs the application with long polling until stop_event is set."""
+    stop_event = stop_event or asyncio.Event()
+    # For restart.Restart and --measure-startup, which stop serving from inside the application
+    application.bot_data['stop_serving'] = stop_event.set
+
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        await application.updater.start_polling()
+        await application.start()
+        try:
+            if post_start:
+                await post_start(application)
+            await stop_event.wait()
+        finally:
+            await application.updater.stop()
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+
+def run_polling(application, post_start=None):
+    """Blocking counterpart of serve_polling, stopped by SIGINT or SIGTERM."""
+    async def main():
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop_event.set)
+        await serve_polling(application, stop_event, post_start)
+
+    asyncio.run(main())
@@ -0,0 +1,174 @@
+"""Outbound rate limiting of Bot API requests.
+
+Telegram limits how fast a bot may send: about 30 messages per second
+overall, about one per second in a private chat (short bursts are tolerated)
+and 20 per minute in a group. Requests over the limit are answered with 429
+and a retry_after during which further requests keep failing, so a crowd of
+users arriving at once used to stall everything behind flood waits.
+
+PriorityRateLimiter plugs into python-telegram-bot as the bot's rate
+limiter. Every request that targets a chat (sending or editing a message)
+takes a token from the bucket of its chat, then one from the overall bucket.
+When tokens run out, the waiting requests are served by priority, then in
+arrival order, so a transaction confirmation overtakes queued menu
+re-renders. A 429 that still gets through pauses every bucket for its
+retry_after before the request is tried again.
+
+The priority of a request is given as `rate_limit_args` (one of the
+PRIORITY_* constants) to the bot method; requests without one count as
+PRIORITY_REPLY. Requests without a chat (answering a callback query) are
+not throttled, but still wait out a flood pause. With metrics on, the time
+each request waited is recorded by priority.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+
+logger = logging.getLogger(__name__)
+
+# Lower values are sent first
+PRIORITY_CONFIRMATION = 0
+PRIORITY_REPLY = 1
+PRIORITY_MENU = 2
+PRIORITY_NOTICE = 3
+# Label of each priority in the metrics
+PRIORITY_NAMES = {
+    PRIORITY_CONFIRMATION: 'confirmation', PRIORITY_REPLY: 'reply', PRIORITY_MENU: 'menu', PRIORITY_NOTICE: 'notice',
+}
+
+DEFAULT_OVERALL_RATE = 30
+DEFAULT_CHAT_RATE = 1
+DEFAULT_CHAT_BURST = 3
+GROUP_RATE = 20 / 60
+GROUP_BURST = 20
+DEFAULT_MAX_RETRIES = 3
+MAX_IDLE_CHAT_BUCKETS = 10000
+
+
+class PriorityTokenBucket:
+    """Token bucket whose waiters are served by priority, then in arrival order."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._serving = None
+
+    def _take(self):
+        """Takes a token and returns 0, or returns the seconds until one can be taken."""
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self, priority=PRIORITY_REPLY):
+        # Requests only skip the queue when nobody is waiting
+        if not self._waiters and self._take() == 0:
+            return
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        if self._serving is None or self._serving.done():
+            self._serving = loop.create_task(self._serve())
+        await future
+
+    async def _serve(self):
+        while self._waiters:
+            if self._waiters[0][2].done():
+                # Its request was cancelled while waiting
+                heapq.heappop(self._waiters)
+                continue
+            delay = self._take()
+            if delay:
+                await asyncio.sleep(delay)
+                continue
+            heapq.heappop(self._waiters)[2].set_result(None)
+
+    async def wait_unpaused(self):
+        while (delay := self.paused_until - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def idle(self):
+        """Tells whether the bucket is back to its initial state and can be dropped."""
+        return not self._waiters and self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+
+class PriorityRateLimiter(BaseRateLimiter):
+    """Keeps outbound requests within Telegram's overall and per-chat limits, by priority."""
+
+    def __init__(self, overall_rate=DEFAULT_OVERALL_RATE, chat_rate=DEFAULT_CHAT_RATE,
+                 chat_burst=DEFAULT_CHAT_BURST, max_retries=DEFAULT_MAX_RETRIES, metrics=None):
+        self.overall = PriorityTokenBucket(overall_rate, max(1, overall_rate))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.chats = {}
+        self.retried = 0
+        self.metrics = metrics
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            if len(self.chats) >= MAX_IDLE_CHAT_BUCKETS:
+                self.chats = {key: value for key, value in self.chats.items() if not value.idle()}
+            # Group and channel ids are negative
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket = PriorityTokenBucket(self.chat_rate, self.chat_burst)
+            else:
+                bucket = PriorityTokenBucket(GROUP_RATE, GROUP_BURST)
+            self.chats[chat_id] = bucket
+        return bucket
+
+    async def _acquire(self, chat_id, priority):
+        started = time.monotonic()
+        if chat_id is None:
+            await self.overall.wait_unpaused()
+        else:
+            await self._chat_bucket(chat_id).acquire(priority)
+            await self.overall.acquire(priority)
+        if self.metrics is not None:
+            self.metrics.rate_limiter_wait_seconds.observe(time.monotonic() - started, PRIORITY_NAMES[priority])
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = PRIORITY_REPLY if rate_limit_args is None else rate_limit_args
+        chat_id = data.get('chat_id')
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(chat_id, priority)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as error:
+                if attempt == self.max_retries:
+                    raise
+                self.retried += 1
+                retry_after = error.retry_after
+                if not isinstance(retry_after, (int, float)):
+                    retry_after = retry_after.total_seconds()
+                logger.warning("%s hit the flood limit, pausing requests for %ss", endpoint, retry_after)
+                # Telegram does not say which limit was hit, so everything waits
+                self.overall.pause(retry_after)
+                if chat_id is not None:
+                    self._chat_bucket(chat_id).pause(retry_after)
@@ -0,0 +1,97 @@
+"""Coalesced responses to an update.
+
+Handlers used to answer with several Bot API calls in a row: answering the
+button press, editing the message it belongs to, then sending the main menu
+or a prompt as new messages. Each call is a full HTTP round trip, taken one
+after the other.
+
+A Reply collects what a handler wants to say instead, and @unit_of_work sends
+it once the handler returned and its database changes are committed:
+
+- the paragraphs are joined into a single message;
+- the keyboards are stacked into a single inline keyboard, in order (a
+  prebuilt keyboard given alone is sent as is);
+- for a button press, the message carrying the button is edited in place and
+  the callback query is answered at the same time, so the press costs one
+  round trip;
+- for a text message or a command, one new message is sent.
+
+The reply also carries the priority rate_limiter.PriorityRateLimiter sends it
+with: the most urgent of the priorities the handler asked for, PRIORITY_REPLY
+if it asked for none.
+"""
+import asyncio
+
+from telegram import InlineKeyboardMarkup
+from telegram.error import BadRequest
+
+from rate_limiter import PRIORITY_REPLY
+
+
+PARAGRAPH_SEPARATOR = '\n\n'
+
+
+class Reply:
+    """Text and keyboard a handler responds with, sent in as few Bot API calls as possible."""
+
+    def __init__(self, update):
+        self.update = update
+        self.paragraphs = []
+        self.markups = []
+        self.answer_text = None
+        self.answered = False
+        self.priority = None
+
+    def add(self, text, reply_markup=None):
+        """Appends a paragraph and, optionally, the keyboard that goes below it."""
+        self.paragraphs.append(text)
+        if reply_markup is not None:
+            self.markups.append(reply_markup)
+
+    def answer(self, text):
+        """Shows a notification for the pressed button instead of only dismissing its progress bar."""
+        self.answer_text = text
+
+    def already_answered(self):
+        """Skips answering the pressed button, e.g. for a callback query delivered a second time."""
+        self.answered = True
+
+    def prioritize(self, priority):
+        """Asks for the reply to be sent at least with the given rate limiter priority."""
+        self.priority = priority if self.priority is None else min(self.priority, priority)
+
+    def markup(self):
+        if len(self.markups) <= 1:
+            return self.markups[0] if self.markups else None
+        return InlineKeyboardMarkup([row for markup in self.markups for row in markup.inline_keyboard])
+
+    async def send(self):
+        query = self.update.callback_query
+        if not self.paragraphs:
+            if query is not None and not self.answered:
+                await query.answer(self.answer_text)
+            return
+
+        text, reply_markup = PARAGRAPH_SEPARATOR.join(self.paragraphs), self.markup()
+        bot = self.update.get_bot()
+        options = {'reply_markup': reply_markup}
+        # The shortcuts of Message and CallbackQuery do not take rate_limit_args, and bots without
+        # a rate limiter refuse it
+        if getattr(bot, 'rate_limiter', None) is not None:
+            options['rate_limit_args'] = PRIORITY_REPLY if self.priority is None else self.priority
+        chat_id = self.update.effective_chat.id
+        if query is None:
+            await bot.send_message(chat_id, text, **options)
+            return
+        await asyncio.gather(query.answer(self.answer_text), self._edit(bot, chat_id, query, text, options))
+
+    @staticmethod
+    async def _edit(bot, chat_id, query, text, options):
+        try:
+            await bot.edit_message_text(text, chat_id, query.message.message_id, **options)
+        except BadRequest as error:
+            # Pressing a button that leads to the same screen (View Balance twice) changes nothing
+            if 'not modified' in error.message:
+                return
+            # The message is gone or can no longer be edited: say it in a new one
+            await bot.send_message(chat_id, text, **options)
@@ -0,0 +1,114 @@
+"""Async data access layer used by every handler.
+
+The stores of storage.py are blocking (pymongo, sqlite3), so calling them
+directly from a handler stalls the event loop (and with it every other chat)
+for the whole database round trip. The repositories below dispatch each call
+to a bounded thread pool instead.
+"""
+import asyncio
+import copy
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+
+DEFAULT_MAX_WORKERS = 16
+
+
+def create_executor(max_workers=DEFAULT_MAX_WORKERS):
+    """Creates the thread pool shared by all repositories."""
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='db')
+
+
+def resolve_path(document, path, create=False):
+    """Returns the parent dict and final key of a dotted path."""
+    keys = path.split('.')
+    for key in keys[:-1]:
+        if key not in document:
+            if not create:
+                return None, keys[-1]
+            document[key] = {}
+        document = document[key]
+    return document, keys[-1]
+
+
+def apply_update(document, update):
+    """Applies the $set, $inc, $push and $unset operators to a local document in place."""
+    for path, value in update.get('$set', {}).items():
+        parent, key = resolve_path(document, path, create=True)
+        parent[key] = copy.deepcopy(value)
+    for path, value in update.get('$inc', {}).items():
+        parent, key = resolve_path(document, path, create=True)
+        parent[key] = parent.get(key, 0) + value
+    for path, value in update.get('$push', {}).items():
+        parent, key = resolve_path(document, path, create=True)
+        values = value['$each'] if isinstance(value, dict) and '$each' in value else [value]
+        parent.setdefault(key, []).extend(copy.deepcopy(values))
+    for path in update.get('$unset', {}):
+        parent, key = resolve_path(document, path)
+        if parent is not None:
+            parent.pop(key, None)
+
+
+class AsyncRepository:
+    """Base class that runs the blocking calls of a storage.Storage store on an executor."""
+
+    def __init__(self, store, executor):
+        self.store = store
+        self.executor = executor
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+
+class UserRepository(AsyncRepository):
+    """User documents, keyed by the Telegram user_id."""
+
+    def __init__(self, store, executor, group_commit=None):
+        super().__init__(store, executor)
+        # group_commit.GroupCommitter writing the updates made with grouped=True, if any
+        self.group_commit = group_commit
+
+    def is_cached(self, user_id):
+        """Tells whether get() can answer without a database round trip."""
+        return False
+
+    async def get(self, user_id, fresh=False):
+        """Returns the user document; fresh=True reads it from the database even when a copy is cached."""
+        return await self._run(self.store.get, user_id)
+
+    async def insert(self, document):
+        await self._run(self.store.insert, document)
+
+    async def update(self, user_id, update, condition=None):
+        """Applies an update, only if the document also matches `condition`. Returns whether it did."""
+        return await self._run(self.store.update, user_id, update, condition)
+
+    async def update_and_get(self, user_id, update, upsert=False, condition=None, grouped=False):
+        """Applies an update and returns the resulting document in a single round trip.
+
+        Returns None, without applying it, if the document does not also match
+        `condition`. With grouped=True the update is written in a batch with
+        other users' updates when group commit is on (see group_commit.py);
+        it cannot be an upsert then.
+        """
+        if grouped and self.group_commit is not None:
+            return await self.group_commit.update_and_get(user_id, update, condition)
+        return await self._run(self.store.update_and_get, user_id, update, upsert=upsert, condition=condition)
+
+    async def clear_temp_data(self, user_ids):
+        """Empties temp_data, and drops the 'state' field of older versions, of the given users."""
+        await self._run(self.store.clear_temp_data, user_ids)
+
+
+class SettingsRepository(AsyncRepository):
+    """Key/value settings shared by the whole bot."""
+
+    async def get(self, key):
+        return await self._run(self.store.get, key)
+
+    async def set(self, key, value):
+        await self._run(self.store.set, key, value)
+
+    async def delete(self, key):
+        await self._run(self.store.delete, key)
@@ -0,0 +1,173 @@
+"""Zero-downtime restart of the bot process.
+
+/debug_restart replaces the running process with a new one without losing
+updates and with the bot unavailable only for the moment it takes to hand
+over:
+
+1. The old process starts the new one (fork/exec of the same command line)
+   and keeps serving while the new one imports, connects to the database and the
+   Bot API and prepares the database.
+2. The new process says it is ready over a socket pair inherited from the
+   old one, then waits for its turn.
+3. The old process stops taking updates, finishes the ones in flight, writes
+   the buffered ledger entries and conversation states, then hands over: the
+   next update offset when polling, nothing more for the webhook, whose
+   listening socket the new process inherited at start. Connections Telegram
+   opens meanwhile wait in that socket's backlog.
+4. The new process confirms the updates up to the offset, starts taking
+   updates and reports the downtime: from the moment the old process stopped
+   taking updates until the new one started again. Both read the system-wide
+   monotonic clock, so the two timestamps can be compared.
+
+Nothing waits for a fixed time: every step waits for the previous one to be
+done. If the new process fails before it is ready, the old one keeps serving.
+
+Restarting is not available in supervisor mode (WORKERS > 1).
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from telegram import Update
+from telegram.ext import TypeHandler
+
+
+logger = logging.getLogger(__name__)
+
+HANDOFF_FD_ENV = 'RESTART_HANDOFF_FD'
+LISTEN_FD_ENV = 'RESTART_LISTEN_FD'
+READY_TIMEOUT = 120
+# Runs before every other handler group
+OFFSET_TRACKER_GROUP = -100
+
+
+def track_update_offset(application):
+    """Remembers the highest update id received, to hand the polling offset over on restart."""
+    async def track(update, context):
+        if update.update_id >= application.bot_data.get('last_update_id', -1):
+            application.bot_data['last_update_id'] = update.update_id
+
+    application.add_handler(TypeHandler(Update, track), group=OFFSET_TRACKER_GROUP)
+
+
+async def _read_line(channel):
+    loop = asyncio.get_running_loop()
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = await loop.sock_recv(channel, 4096)
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+# ------------------ Old process ------------------
+
+class Restart:
+    """Replacement of the running process, seen from the process being replaced."""
+
+    def __init__(self, application):
+        self.application = application
+        self.process = None
+        self.stopped_at = None
+        self._channel = None
+
+    async def run(self):
+        """Starts the new process and, once it is ready, stops serving to hand over to it.
+
+        Returns False, and leaves this process serving, if the new one does not get ready.
+        """
+        channel, child_channel = socket.socketpair()
+        env = dict(os.environ, **{HANDOFF_FD_ENV: str(child_channel.fileno())})
+        pass_fds = [child_channel.fileno()]
+        server = self.application.bot_data.get('webhook_server')
+        if server is not None:
+            env[LISTEN_FD_ENV] = str(server.fileno())
+            pass_fds.append(server.fileno())
+        self.process = subprocess.Popen([sys.executable] + sys.argv, env=env, pass_fds=pass_fds)
+        child_channel.close()
+        channel.setblocking(False)
+        logger.info("Started the new process %s, waiting for it to be ready", self.process.pid)
+
+        try:
+            ready = await asyncio.wait_for(_read_line(channel), READY_TIMEOUT)
+        except asyncio.TimeoutError:
+            ready = None
+        if ready is None:
+            logger.error("The new process did not get ready, this one keeps serving")
+            channel.close()
+            if self.process.poll() is None:
+                self.process.kill()
+            return False
+
+        self._channel = channel
+        self.stopped_at = time.monotonic()
+        self.application.bot_data['restart'] = self
+        # Set by polling.serve_polling and webhook.serve_webhook
+        self.application.bot_data['stop_serving']()
+        return True
+
+    async def hand_over(self):
+        """Lets the new process take over. To be called once this one stopped and flushed everything."""
+        last_update_id = self.application.bot_data.get('last_update_id')
+        message = {
+            'offset': last_update_id + 1 if last_update_id is not None else None,
+            'stopped_at': self.stopped_at,
+        }
+        loop = asyncio.get_running_loop()
+        await loop.sock_sendall(self._channel, json.dumps(message).encode() + b'\n')
+        self._channel.close()
+        logger.info("Handed over to the new process %s", self.process.pid)
+
+
+# ------------------ New process ------------------
+
+class Handoff:
+    """Takeover from the process being replaced, seen from the new process."""
+
+    def __init__(self, channel, listen_fd=None):
+        self.channel = channel
+        self.listen_fd = listen_fd
+
+    @classmethod
+    def from_environment(cls):
+        """Returns the handoff this process was started for, None if it was not started by a restart."""
+        handoff_fd = os.environ.pop(HANDOFF_FD_ENV, None)
+        if handoff_fd is None:
+            return None
+        listen_fd = os.environ.pop(LISTEN_FD_ENV, None)
+        channel = socket.socket(fileno=int(handoff_fd))
+        channel.setblocking(False)
+        return cls(channel, int(listen_fd) if listen_fd is not None else None)
+
+    def listen_socket(self):
+        """The webhook's listening socket, inherited from the old process."""
+        if self.listen_fd is None:
+            return None
+        return socket.socket(fileno=self.listen_fd)
+
+    async def take_over(self, application):
+        """Tells the old process this one is ready and waits for its turn.
+
+        Returns the downtime in milliseconds, None if the old process went away without handing over.
+        """
+        loop = asyncio.get_running_loop()
+        await loop.sock_sendall(self.channel, b'ready\n')
+        message = await _read_line(self.channel)
+        self.channel.close()
+        if message is None:
+            logger.warning("The old process exited without handing over")
+            return None
+        message = json.loads(message)
+        if message['offset'] is not None:
+            # Confirms every update before the offset; the one returned, if any, is not confirmed and
+            # is fetched again by the polling
+            await application.bot.get_updates(offset=message['offset'], limit=1, timeout=0)
+        downtime = (time.monotonic() - message['stopped_at']) * 1000
+        logger.info("Took over from the old process, downtime %.0f ms", downtime)
+        return downtime
@@ -0,0 +1,209 @@
+"""Database bootstrap, run once when the bot starts.
+
+- Declares the indexes every query of the bot relies on. create_indexes is a
+  no-op for indexes that already exist.
+- Migrates user documents created by older versions, which lack some of the
+  fields the handlers expect, and conversation documents, which lack the
+  state_updated_at the conversation sweeper relies on. The method arrays of
+  user documents are moved to the payment_methods collection. It runs once per schema version: the documents
+  are streamed and fixed with unordered bulk_writes, so the /start handler
+  no longer needs to check and backfill fields on every call.
+- Explains the queries on the hot path and warns about any that would scan
+  a whole collection.
+
+Run `python schema.py` to bootstrap the database by hand and print the query plans.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import ASCENDING, IndexModel, UpdateOne
+from pymongo.errors import OperationFailure
+
+from ledger import EPOCH, HISTORY_ORDER, LEDGER_INDEX, MILLISECOND, ledger_now
+from methods import METHOD_INDEX, METHOD_ORDER, method_document
+from storage import USER_DEFAULTS
+
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_VERSION = 3
+SCHEMA_VERSION_KEY = 'schema_version'
+MIGRATION_BATCH_SIZE = 1000
+
+INDEXES = {
+    'users': [IndexModel([('user_id', ASCENDING)], name='user_id', unique=True)],
+    'settings': [IndexModel([('key', ASCENDING)], name='key', unique=True)],
+    'conversations': [
+        IndexModel([('name', ASCENDING), ('key', ASCENDING)], name='name_key', unique=True),
+        IndexModel([('name', ASCENDING), ('state_updated_at', ASCENDING)], name='name_state_updated_at'),
+    ],
+    'user_data': [IndexModel([('user_id', ASCENDING)], name='user_id', unique=True)],
+    'transactions': [IndexModel(LEDGER_INDEX, name='user_id_ts')],
+    'balance_snapshots': [IndexModel(LEDGER_INDEX, name='user_id_ts')],
+    'payment_methods': [IndexModel(METHOD_INDEX, name='user_id_kind_added_at')],
+}
+# Arrays of saved methods kept in user documents before schema version 3, by method kind
+LEGACY_METHOD_FIELDS = {'deposit': 'deposit_methods', 'withdrawal': 'withdrawal_methods'}
+
+# (description, collection, filter, sort) of the queries run while handling updates
+HOT_PATH_QUERIES = [
+    ('user document', 'users', {'user_id': 0}, None),
+    ('setting', 'settings', {'key': 'restart_chat_id'}, None),
+    ('conversation state', 'conversations', {'name': 'main_conversation', 'key': [0, 0]}, None),
+    ('user_data', 'user_data', {'user_id': 0}, None),
+    ('history page', 'transactions', {'user_id': 0, 'ts': {'$lte': EPOCH}, 'seq': {'$lt': 1}}, HISTORY_ORDER),
+    ('latest balance snapshot', 'balance_snapshots', {'user_id': 0}, HISTORY_ORDER),
+    ('method page', 'payment_methods', {'user_id': 0, 'kind': 'deposit'}, METHOD_ORDER),
+]
+
+
+def _create_collection_indexes(db, name):
+    try:
+        db[name].create_indexes(INDEXES[name])
+    except OperationFailure:
+        # Typically duplicates left by older versions, which must be merged by hand
+        logger.error("Creating the indexes of the %s collection failed", name)
+        raise
+
+
+def create_indexes(db):
+    # One round trip per collection, all at the same time, as the bot waits for them to start
+    with ThreadPoolExecutor(len(INDEXES), thread_name_prefix='create-indexes') as pool:
+        for created in [pool.submit(_create_collection_indexes, db, name) for name in INDEXES]:
+            created.result()
+
+
+def migrate_users(users, batch_size=MIGRATION_BATCH_SIZE):
+    """Adds the missing default fields to user documents. Returns the number of documents changed."""
+    query = {'$or': [{field: {'$exists': False}} for field in USER_DEFAULTS]}
+    projection = {field: True for field in USER_DEFAULTS}
+    requests = []
+    migrated = 0
+    # The cursor fetches batch_size documents per round trip instead of loading the whole collection
+    for document in users.find(query, projection=projection, batch_size=batch_size):
+        missing = {field: value for field, value in USER_DEFAULTS.items() if field not in document}
+        requests.append(UpdateOne({'_id': document['_id']}, {'$set': missing}))
+        if len(requests) >= batch_size:
+            users.bulk_write(requests, ordered=False)
+            migrated += len(requests)
+            requests = []
+    if requests:
+        users.bulk_write(requests, ordered=False)
+        migrated += len(requests)
+    return migrated
+
+
+def migrate_methods(users, methods, batch_size=MIGRATION_BATCH_SIZE):
+    """Moves the method arrays of user documents to the payment_methods collection.
+
+    Duplicates within an array are stored once. The methods are written
+    before the arrays are dropped and written again harmlessly if the
+    migration is interrupted, so none is lost. Returns the number of user
+    documents changed.
+    """
+    fields = list(LEGACY_METHOD_FIELDS.values())
+    query = {'$or': [{field: {'$exists': True}} for field in fields]}
+    projection = {'user_id': True, **{field: True for field in fields}}
+    method_requests = []
+    user_requests = []
+    migrated = 0
+    now = ledger_now()
+    for document in users.find(query, projection=projection, batch_size=batch_size):
+        for kind, field in LEGACY_METHOD_FIELDS.items():
+            for index, method in enumerate(document.get(field) or []):
+                # One millisecond apart, so the methods keep their order
+                stored = method_document(document['user_id'], kind, method['type'], method['detail'],
+                                         now + index * MILLISECOND)
+                method_id = stored.pop('_id')
+                method_requests.append(UpdateOne({'_id': method_id}, {'$setOnInsert': stored}, upsert=True))
+        user_requests.append(UpdateOne({'_id': document['_id']}, {'$unset': {field: '' for field in fields}}))
+        if len(user_requests) >= batch_size:
+            migrated += _write_method_batch(users, methods, method_requests, user_requests)
+            method_requests, user_requests = [], []
+    if user_requests:
+        migrated += _write_method_batch(users, methods, method_requests, user_requests)
+    return migrated
+
+
+def _write_method_batch(users, methods, method_requests, user_requests):
+    if method_requests:
+        methods.bulk_write(method_requests, ordered=False)
+    users.bulk_write(user_requests, ordered=False)
+    return len(user_requests)
+
+
+def migrate_conversations(conversations):
+    """Dates the conversation states written before state_updated_at existed to now, so they expire later."""
+    query = {'state_updated_at': {'$exists': False}}
+    result = conversations.update_many(query, {'$set': {'state_updated_at': ledger_now()}})
+    return result.modified_count
+
+
+def migrate(db):
+    """Brings the documents up to SCHEMA_VERSION, once."""
+    settings = db['settings']
+    current = settings.find_one({'key': SCHEMA_VERSION_KEY})
+    version = current.get('value', 0) if current else 0
+    if version >= SCHEMA_VERSION:
+        return
+    moved = migrate_methods(db['users'], db['payment_methods'])
+    migrated = migrate_users(db['users'])
+    dated = migrate_conversations(db['conversations'])
+    settings.update_one({'key': SCHEMA_VERSION_KEY}, {'$set': {'value': SCHEMA_VERSION}}, upsert=True)
+    logger.info(
+        "Migrated the database to schema version %s (%s user and %s conversation documents updated, "
+        "methods of %s users moved)", SCHEMA_VERSION, migrated, dated, moved
+    )
+
+
+def plan_stages(plan):
+    """Lists the stages of an explain() plan, outermost first."""
+    stages = [plan['stage']] if 'stage' in plan else []
+    # Plans of the slot-based engine wrap the classic plan in queryPlan
+    children = [plan[key] for key in ('queryPlan', 'inputStage') if key in plan] + plan.get('inputStages', [])
+    for child in children:
+        stages.extend(plan_stages(child))
+    return stages
+
+
+def explain_hot_paths(db):
+    """Returns (description, collection, plan stages) for every hot-path query."""
+    report = []
+    for description, name, query, sort in HOT_PATH_QUERIES:
+        cursor = db[name].find(query).limit(1)
+        if sort:
+            cursor = cursor.sort(sort)
+        plan = cursor.explain()['queryPlanner']['winningPlan']
+        report.append((description, name, plan_stages(plan)))
+    return report
+
+
+def check_query_plans(db):
+    """Logs the plan of every hot-path query, with a warning for those scanning a whole collection."""
+    for description, name, stages in explain_hot_paths(db):
+        if 'COLLSCAN' in stages:
+            logger.warning("Query for the %s scans the whole %s collection: %s", description, name, ' <- '.join(stages))
+        else:
+            logger.info("Query plan for the %s: %s", description, ' <- '.join(stages))
+
+
+def bootstrap(db, query_plans=True):
+    """Creates the indexes, migrates old documents and, unless told not to, checks the hot-path query plans.
+
+    The bot checks the query plans itself once it is taking updates, since nothing has to wait for them.
+    """
+    create_indexes(db)
+    migrate(db)
+    if query_plans:
+        check_query_plans(db)
+
+
+if __name__ == '__main__':
+    import pymongo
+    from dotenv import load_dotenv
+
+    from storage import script_mongo_uri
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    load_dotenv()
+    bootstrap(pymongo.MongoClient(script_mongo_uri('schema.py'))['bot_database'])
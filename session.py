@@ -0,0 +1,217 @@
+"""Per-update unit of work for user documents.
+
+A handler stages its reads and mutations on a UserSession instead of calling
+the repository for each one. The session then talks to the database at most
+once per kind of access:
+
+- mutations staged before the first read are applied by the read itself
+  through find_one_and_update;
+- mutations staged after the read are committed as one combined update_one.
+
+A user without a document (one who never sent /start, or whose document the
+memory backend lost in a restart) gets one created with USER_DEFAULTS the
+first time a handler reads or writes it, at the cost of extra operations.
+
+Handlers are wrapped with @unit_of_work, which opens the session, commits it
+when the handler returns and records how many database operations each step
+cost in DbOpStats. The unit of work also collects the handler's response in a
+reply.Reply and sends it after the commit, so a user is never told about a
+change that is not stored yet.
+"""
+import contextvars
+import copy
+import functools
+
+from reply import Reply
+from repository import apply_update, resolve_path
+from storage import USER_DEFAULTS
+
+
+_current_session = contextvars.ContextVar('current_session', default=None)
+_current_reply = contextvars.ContextVar('current_reply', default=None)
+
+
+class UserSession:
+    """Collects the reads and mutations a handler makes on one user document."""
+
+    def __init__(self, users, user_id):
+        self.users = users
+        self.user_id = user_id
+        self.document = None
+        self.pending = {}
+        self.conditions = {}
+        self.ops = 0
+
+    async def load(self, fresh=False):
+        """Returns the user document, reading it at most once per session.
+
+        fresh=True reads it from the database, not from the user cache.
+        """
+        if self.document is None:
+            pending = self.pending
+            if pending:
+                self.document = await self.users.update_and_get(self.user_id, pending)
+                self.pending = {}
+                self.ops += 1
+            else:
+                if fresh or not self.users.is_cached(self.user_id):
+                    self.ops += 1
+                self.document = await self.users.get(self.user_id, fresh=fresh)
+            if self.document is None:
+                self.document = await self._create()
+                if pending:
+                    self.document = await self.users.update_and_get(self.user_id, pending)
+                    self.ops += 1
+        return self.document
+
+    async def load_or_create(self, defaults):
+        """Returns the user document, inserting it with the given defaults if it does not exist."""
+        if self.document is None:
+            update = dict(self.pending)
+            update['$setOnInsert'] = defaults
+            self.document = await self.users.update_and_get(self.user_id, update, upsert=True)
+            self.pending = {}
+            self.ops += 1
+        return self.document
+
+    async def _create(self):
+        """Inserts the missing user document with USER_DEFAULTS, and returns it."""
+        # Created on its own: MongoDB rejects $setOnInsert of temp_data along with a $set of one of its fields
+        document = await self.users.update_and_get(self.user_id, {'$setOnInsert': USER_DEFAULTS}, upsert=True)
+        self.ops += 1
+        return document
+
+    def expect(self, path, value):
+        """Makes the next commit apply only if the stored document still has `value` at `path`."""
+        self.conditions[path] = value
+
+    def expect_at_least(self, path, value):
+        """Makes the next commit apply only if the stored document has at least `value` at `path`."""
+        self.conditions[path] = {'$gte': value}
+
+    def set(self, path, value):
+        self._stage('$set', path, value)
+
+    def inc(self, path, value):
+        self._stage('$inc', path, value)
+
+    def push(self, path, value):
+        self._stage('$push', path, value)
+
+    def _stage(self, operator, path, value):
+        value = copy.deepcopy(value)
+        if self.document is not None:
+            apply_update(self.document, {operator: {path: value}})
+
+        fields = self.pending.setdefault(operator, {})
+        if operator == '$set':
+            # MongoDB rejects an update that sets both a field and one of its children
+            for key in [key for key in fields if key.startswith(path + '.')]:
+                del fields[key]
+            for key in fields:
+                if path.startswith(key + '.'):
+                    parent, leaf = resolve_path(fields[key], path[len(key) + 1:], create=True)
+                    parent[leaf] = value
+                    return
+            fields[path] = value
+        elif operator == '$inc':
+            fields[path] = fields.get(path, 0) + value
+        elif operator == '$push':
+            if path in fields:
+                fields[path]['$each'].append(value)
+            else:
+                fields[path] = {'$each': [value]}
+
+    async def commit(self):
+        """Writes all pending mutations in a single update.
+
+        Returns False if the conditions set with expect() did not hold, in which case nothing was written.
+        """
+        if not self.pending:
+            return True
+        updated = await self.users.update(self.user_id, self.pending, self.conditions)
+        if not updated and not self.conditions and self.document is None:
+            # Without conditions, only a missing document stops the update
+            await self._create()
+            updated = await self.users.update(self.user_id, self.pending)
+            self.ops += 1
+        self.pending = {}
+        self.conditions = {}
+        self.ops += 1
+        return updated
+
+    async def commit_and_load(self, grouped=False):
+        """Writes all pending mutations in a single update and returns the document as stored.
+
+        The stored document may differ from the one loaded when the user was
+        changed behind the handler's back (by admin.py, for example). Returns
+        None if the conditions set with expect() did not hold, in which case
+        nothing was written. grouped=True lets the update share a batch with
+        other users' updates (see group_commit.py).
+        """
+        document = await self.users.update_and_get(
+            self.user_id, self.pending, condition=self.conditions, grouped=grouped
+        )
+        self.pending = {}
+        self.conditions = {}
+        self.ops += 1
+        if document is not None:
+            self.document = document
+        return document
+
+
+class DbOpStats:
+    """Counts steps and database operations per handler."""
+
+    def __init__(self):
+        self.steps = {}
+        self.ops = {}
+
+    def record(self, handler_name, ops):
+        self.steps[handler_name] = self.steps.get(handler_name, 0) + 1
+        self.ops[handler_name] = self.ops.get(handler_name, 0) + ops
+
+    def summary(self):
+        lines = []
+        for name in sorted(self.steps):
+            steps = self.steps[name]
+            lines.append(f"{name}: {steps} steps, {self.ops[name] / steps:.2f} DB ops/step")
+        return lines
+
+
+def unit_of_work(handler):
+    """Runs a handler inside a UserSession and a Reply, commits the session and then sends the reply.
+
+    Handlers called from inside another handler (text_message dispatching to
+    enter_amount, for example) join the session and reply that are already open.
+    """
+    @functools.wraps(handler)
+    async def wrapper(update, context, *args, **kwargs):
+        if _current_session.get() is not None:
+            return await handler(update, context, *args, **kwargs)
+
+        session = UserSession(context.application.bot_data['users'], update.effective_user.id)
+        reply = Reply(update)
+        session_token = _current_session.set(session)
+        reply_token = _current_reply.set(reply)
+        try:
+            result = await handler(update, context, *args, **kwargs)
+            await session.commit()
+        finally:
+            _current_session.reset(session_token)
+            _current_reply.reset(reply_token)
+        context.application.bot_data['db_op_stats'].record(handler.__name__, session.ops)
+        await reply.send()
+        return result
+
+    return wrapper
+
+
+def current_session():
+    """Returns the session opened by the innermost @unit_of_work handler."""
+    return _current_session.get()
+
+
+def current_reply():
+    """Returns the reply collected by the innermost @unit_of_work handler."""
+    return _current_reply.get()
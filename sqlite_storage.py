@@ -0,0 +1,395 @@
+"""Storage backend on a single SQLite file, for deployments without MongoDB.
+
+The database is opened in WAL mode, so reads go on while another thread or
+worker process writes, with synchronous=NORMAL: a commit waits for the WAL
+but not for a checkpoint. Each executor thread has a connection of its own.
+Every query is one of the parameterised statements below; sqlite3 prepares a
+statement the first time a connection runs it and reuses it afterwards.
+
+Documents are stored as JSON, datetimes as {"$date": ISO 8601}. Every
+column a query filters or sorts on is stored next to the document, times as
+milliseconds since the epoch, with the index that query needs:
+
+    users               user_id | document
+    settings            key | value
+    conversations       name, key | state, state_updated_at
+    user_data           user_id | data
+    transactions        user_id, seq | ts, document
+    balance_snapshots   user_id, seq | ts, document
+    payment_methods     id | user_id, kind, added_at, invalid, document
+
+User updates read the document, apply the update in Python with
+repository.apply_update and write it back, inside a BEGIN IMMEDIATE
+transaction, so concurrent updates of a user are applied one after the other.
+A batch of updates (update_many) shares one transaction, and so one commit.
+"""
+import contextlib
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+from ledger import EPOCH, MILLISECOND
+from repository import apply_update
+from storage import (
+    LedgerStore, MethodStore, SessionStore, SettingsStore, Storage, UserStore, cleared_temp_data, matches_condition,
+    upserted_document
+)
+
+
+DEFAULT_SQLITE_PATH = 'bot.sqlite3'
+# Milliseconds a statement waits for another connection's write lock before failing
+BUSY_TIMEOUT = 5000
+# Statements each connection keeps prepared
+CACHED_STATEMENTS = 256
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, document TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS conversations (
+    name TEXT NOT NULL, key TEXT NOT NULL, state TEXT NOT NULL, state_updated_at INTEGER NOT NULL,
+    PRIMARY KEY (name, key)
+);
+CREATE INDEX IF NOT EXISTS conversations_name_state_updated_at ON conversations (name, state_updated_at);
+CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS transactions (
+    user_id INTEGER NOT NULL, seq INTEGER NOT NULL, ts INTEGER NOT NULL, document TEXT NOT NULL,
+    PRIMARY KEY (user_id, seq)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS transactions_user_id_ts ON transactions (user_id, ts DESC, seq DESC);
+CREATE TABLE IF NOT EXISTS balance_snapshots (
+    user_id INTEGER NOT NULL, seq INTEGER NOT NULL, ts INTEGER NOT NULL, document TEXT NOT NULL,
+    PRIMARY KEY (user_id, seq)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS balance_snapshots_user_id_ts ON balance_snapshots (user_id, ts DESC, seq DESC);
+CREATE TABLE IF NOT EXISTS payment_methods (
+    id TEXT PRIMARY KEY, user_id INTEGER NOT NULL, kind TEXT NOT NULL, added_at INTEGER NOT NULL,
+    invalid INTEGER NOT NULL, document TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS payment_methods_user_id_kind_added_at ON payment_methods (user_id, kind, added_at, id);
+"""
+
+SELECT_USER = 'SELECT document FROM users WHERE user_id = ?'
+INSERT_USER = 'INSERT INTO users (user_id, document) VALUES (?, ?)'
+UPSERT_USER = 'INSERT OR REPLACE INTO users (user_id, document) VALUES (?, ?)'
+
+SELECT_SETTING = 'SELECT value FROM settings WHERE key = ?'
+UPSERT_SETTING = 'INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)'
+DELETE_SETTING = 'DELETE FROM settings WHERE key = ?'
+
+SELECT_CONVERSATIONS = 'SELECT key, state FROM conversations WHERE name = ?'
+UPSERT_CONVERSATION = 'INSERT OR REPLACE INTO conversations (name, key, state, state_updated_at) VALUES (?, ?, ?, ?)'
+DELETE_CONVERSATION = 'DELETE FROM conversations WHERE name = ? AND key = ?'
+SELECT_EXPIRED_CONVERSATIONS = (
+    'SELECT key, state FROM conversations WHERE name = ? AND state_updated_at < ? AND key > ? ORDER BY key LIMIT ?'
+)
+SELECT_USER_DATA = 'SELECT user_id, data FROM user_data'
+UPSERT_USER_DATA = 'INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)'
+DELETE_USER_DATA = 'DELETE FROM user_data WHERE user_id = ?'
+
+# {table} is transactions or balance_snapshots
+INSERT_LEDGER = 'INSERT OR IGNORE INTO {table} (user_id, seq, ts, document) VALUES (?, ?, ?, ?)'
+SELECT_HISTORY = 'SELECT document FROM transactions WHERE user_id = ? ORDER BY ts DESC, seq DESC LIMIT ?'
+# ts never goes backwards within a user's ledger, so this equals (ts, seq) < cursor
+SELECT_HISTORY_BEFORE = (
+    'SELECT document FROM transactions WHERE user_id = ? AND ts <= ? AND seq < ? ORDER BY ts DESC, seq DESC LIMIT ?'
+)
+SELECT_LATEST_SNAPSHOT = 'SELECT document FROM balance_snapshots WHERE user_id = ? ORDER BY ts DESC, seq DESC LIMIT 1'
+SELECT_ENTRIES_AFTER = (
+    "SELECT seq, json_extract(document, '$.amount') FROM transactions "
+    'WHERE user_id = ? AND ts >= ? AND seq > ? ORDER BY ts, seq'
+)
+
+SELECT_METHOD_PAGE = (
+    'SELECT document FROM payment_methods WHERE user_id = ? AND kind = ? AND invalid = 0 '
+    'ORDER BY added_at, id LIMIT ?'
+)
+SELECT_METHOD_PAGE_AFTER = (
+    'SELECT document FROM payment_methods WHERE user_id = ? AND kind = ? AND invalid = 0 '
+    'AND (added_at > ? OR (added_at = ? AND id > ?)) ORDER BY added_at, id LIMIT ?'
+)
+SELECT_METHOD = 'SELECT document FROM payment_methods WHERE id = ? AND user_id = ? AND kind = ? AND invalid = 0'
+SELECT_METHOD_BY_ID = 'SELECT document FROM payment_methods WHERE id = ? AND user_id = ?'
+INSERT_METHOD = (
+    'INSERT OR IGNORE INTO payment_methods (id, user_id, kind, added_at, invalid, document) VALUES (?, ?, ?, ?, ?, ?)'
+)
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {'$date': value.isoformat()}
+    raise TypeError(f'{type(value).__name__} cannot be stored')
+
+
+def _decode_object(value):
+    if len(value) == 1 and '$date' in value:
+        return datetime.fromisoformat(value['$date'])
+    return value
+
+
+def encode(value):
+    return json.dumps(value, default=_encode_value, separators=(',', ':'))
+
+
+def decode(text):
+    return json.loads(text, object_hook=_decode_object)
+
+
+def milliseconds(moment):
+    """A naive UTC datetime as milliseconds since the epoch, the way the time columns store it."""
+    return (moment - EPOCH) // MILLISECOND
+
+
+class SQLiteDatabase:
+    """One connection per thread to the same database file."""
+
+    def __init__(self, path=DEFAULT_SQLITE_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self.connection().executescript(SCHEMA)
+
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # Transactions are opened explicitly, as BEGIN IMMEDIATE where a read is followed by a write
+            connection = sqlite3.connect(
+                self.path, isolation_level=None, check_same_thread=False, cached_statements=CACHED_STATEMENTS
+            )
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT}')
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def execute(self, statement, parameters=()):
+        return self.connection().execute(statement, parameters)
+
+    def fetch_one(self, statement, parameters=()):
+        row = self.connection().execute(statement, parameters).fetchone()
+        return row[0] if row is not None else None
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Runs the block in a transaction that holds the write lock from its start."""
+        connection = self.connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def close(self):
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+        self._local = threading.local()
+
+
+class SQLiteUserStore(UserStore):
+    def __init__(self, db):
+        self.db = db
+
+    def get(self, user_id):
+        document = self.db.fetch_one(SELECT_USER, (user_id,))
+        return decode(document) if document is not None else None
+
+    def insert(self, document):
+        self.db.execute(INSERT_USER, (document['user_id'], encode(document)))
+
+    def _apply(self, user_id, update, upsert, condition):
+        """Applies an update in a transaction. Returns the stored document, or None if it did not apply."""
+        with self.db.transaction() as connection:
+            row = connection.execute(SELECT_USER, (user_id,)).fetchone()
+            if row is None:
+                if not upsert:
+                    return None
+                document = upserted_document(user_id, update, condition)
+            else:
+                document = decode(row[0])
+                if not matches_condition(document, condition):
+                    return None
+                apply_update(document, update)
+            connection.execute(UPSERT_USER, (user_id, encode(document)))
+        return document
+
+    def update(self, user_id, update, condition=None):
+        return self._apply(user_id, update, False, condition) is not None
+
+    def update_and_get(self, user_id, update, upsert=False, condition=None):
+        return self._apply(user_id, update, upsert, condition)
+
+    def update_many(self, requests):
+        # One transaction, so the batch costs a single commit
+        results, writes = [], []
+        with self.db.transaction() as connection:
+            for user_id, update, condition in requests:
+                row = connection.execute(SELECT_USER, (user_id,)).fetchone()
+                document = decode(row[0]) if row is not None else None
+                if document is None or not matches_condition(document, condition):
+                    results.append(None)
+                    continue
+                apply_update(document, update)
+                writes.append((user_id, encode(document)))
+                results.append(document)
+            connection.executemany(UPSERT_USER, writes)
+        return results
+
+    def clear_temp_data(self, user_ids):
+        with self.db.transaction() as connection:
+            for user_id in user_ids:
+                row = connection.execute(SELECT_USER, (user_id,)).fetchone()
+                if row is None:
+                    continue
+                document = decode(row[0])
+                if cleared_temp_data(document):
+                    connection.execute(UPSERT_USER, (user_id, encode(document)))
+
+
+class SQLiteSettingsStore(SettingsStore):
+    def __init__(self, db):
+        self.db = db
+
+    def get(self, key):
+        value = self.db.fetch_one(SELECT_SETTING, (key,))
+        return decode(value) if value is not None else None
+
+    def set(self, key, value):
+        self.db.execute(UPSERT_SETTING, (key, encode(value)))
+
+    def delete(self, key):
+        self.db.execute(DELETE_SETTING, (key,))
+
+
+class SQLiteSessionStore(SessionStore):
+    """Every write is one transaction."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def conversations(self, name):
+        return {tuple(decode(key)): decode(state) for key, state in self.db.execute(SELECT_CONVERSATIONS, (name,))}
+
+    def user_data(self):
+        return {user_id: decode(data) for user_id, data in self.db.execute(SELECT_USER_DATA)}
+
+    def write_conversations(self, changes):
+        upserts, deletes = [], []
+        for (name, key), (state, updated_at) in changes.items():
+            if state is None:
+                deletes.append((name, encode(list(key))))
+            else:
+                upserts.append((name, encode(list(key)), encode(state), milliseconds(updated_at)))
+        with self.db.transaction() as connection:
+            connection.executemany(UPSERT_CONVERSATION, upserts)
+            connection.executemany(DELETE_CONVERSATION, deletes)
+
+    def write_user_data(self, changes):
+        upserts = [(user_id, encode(data)) for user_id, data in changes.items() if data is not None]
+        deletes = [(user_id,) for user_id, data in changes.items() if data is None]
+        with self.db.transaction() as connection:
+            connection.executemany(UPSERT_USER_DATA, upserts)
+            connection.executemany(DELETE_USER_DATA, deletes)
+
+    def expired_conversations(self, name, before, batch_size):
+        # One query per batch, each starting after the last key of the previous one, so no cursor is held open
+        last_key = ''
+        while True:
+            rows = self.db.execute(SELECT_EXPIRED_CONVERSATIONS, (name, milliseconds(before), last_key, batch_size))
+            rows = rows.fetchall()
+            for key, state in rows:
+                yield tuple(decode(key)), decode(state)
+            if len(rows) < batch_size:
+                return
+            last_key = rows[-1][0]
+
+
+class SQLiteLedgerStore(LedgerStore):
+    def __init__(self, db):
+        self.db = db
+
+    def _insert(self, table, documents):
+        rows = [
+            (document['user_id'], document['seq'], milliseconds(document['ts']), encode(document))
+            for document in documents
+        ]
+        with self.db.transaction() as connection:
+            connection.executemany(INSERT_LEDGER.format(table=table), rows)
+
+    def insert_entries(self, entries):
+        self._insert('transactions', entries)
+
+    def insert_snapshots(self, snapshots):
+        self._insert('balance_snapshots', snapshots)
+
+    def history(self, user_id, before=None, limit=None):
+        limit = limit or -1
+        if before is None:
+            rows = self.db.execute(SELECT_HISTORY, (user_id, limit))
+        else:
+            rows = self.db.execute(SELECT_HISTORY_BEFORE, (user_id, milliseconds(before[0]), before[1], limit))
+        return [decode(document) for document, in rows]
+
+    def latest_snapshot(self, user_id):
+        document = self.db.fetch_one(SELECT_LATEST_SNAPSHOT, (user_id,))
+        return decode(document) if document is not None else None
+
+    def entries_after(self, user_id, ts, seq):
+        rows = self.db.execute(SELECT_ENTRIES_AFTER, (user_id, milliseconds(ts), seq))
+        return [{'seq': seq, 'amount': amount} for seq, amount in rows]
+
+
+class SQLiteMethodStore(MethodStore):
+    def __init__(self, db):
+        self.db = db
+
+    def page(self, user_id, kind, after=None, limit=None):
+        limit = limit or -1
+        if after is None:
+            rows = self.db.execute(SELECT_METHOD_PAGE, (user_id, kind, limit))
+        else:
+            added_at, last_id = milliseconds(after[0]), after[1]
+            rows = self.db.execute(SELECT_METHOD_PAGE_AFTER, (user_id, kind, added_at, added_at, last_id, limit))
+        return [decode(document) for document, in rows]
+
+    def get(self, user_id, kind, method_id):
+        document = self.db.fetch_one(SELECT_METHOD, (method_id, user_id, kind))
+        return decode(document) if document is not None else None
+
+    def add(self, document):
+        row = (
+            document['_id'], document['user_id'], document['kind'], milliseconds(document['added_at']),
+            int('invalid' in document), encode(document)
+        )
+        with self.db.transaction() as connection:
+            if connection.execute(INSERT_METHOD, row).rowcount:
+                return None
+            existing = connection.execute(SELECT_METHOD_BY_ID, (document['_id'], document['user_id'])).fetchone()
+        return decode(existing[0])
+
+
+class SQLiteStorage(Storage):
+    name = 'sqlite'
+
+    def __init__(self, path=DEFAULT_SQLITE_PATH):
+        self.db = SQLiteDatabase(path)
+        super().__init__(
+            users=SQLiteUserStore(self.db),
+            settings=SQLiteSettingsStore(self.db),
+            sessions=SQLiteSessionStore(self.db),
+            ledger=SQLiteLedgerStore(self.db),
+            methods=SQLiteMethodStore(self.db),
+        )
+
+    def bootstrap(self):
+        # Lets SQLite gather the statistics its query planner uses, cheap when nothing changed
+        self.db.execute('PRAGMA optimize')
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,76 @@
+"""Cold start of the bot process.
+
+Most of the time before the first update is taken goes to waiting on the
+network and importing python-telegram-bot. main.py therefore:
+
+- creates the MongoDB client and starts opening its connections (DNS, TLS,
+  authentication) in background threads before importing python-telegram-bot,
+  so connecting and importing overlap. The Bot API client is warmed by
+  Application.initialize, which calls getMe meanwhile;
+- runs only what must happen before updates are taken (indexes, schema
+  migration, a restart handoff) in post_init, and leaves the rest (restart
+  notice, query plan check) to post_start, once updates are being taken.
+
+This module only imports the standard library, so it can be used before
+anything heavy is loaded. With --measure-startup, main.py records every
+phase in a StartupTimer, prints the breakdown once updates are being taken
+and exits.
+"""
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+DEFAULT_PREWARM_CONNECTIONS = 4
+
+
+class StartupTimer:
+    """Start and end of each start-up phase, relative to the start of the process."""
+
+    def __init__(self, origin=None):
+        self.origin = time.perf_counter() if origin is None else origin
+        self.phases = []
+        self._last = self.origin
+
+    def mark(self, name):
+        """Records a phase that ran from the previous mark until now."""
+        now = time.perf_counter()
+        self.record(name, self._last, now)
+        self._last = now
+
+    def record(self, name, started, ended):
+        """Records a phase that ran alongside the others."""
+        self.phases.append((name, started - self.origin, ended - self.origin))
+
+    def report(self):
+        width = max([len(name) for name, _, _ in self.phases] + [len('ready to take updates after')])
+        lines = [f"{'phase':<{width}} {'start':>9} {'duration':>9}"]
+        for name, started, ended in sorted(self.phases, key=lambda phase: phase[1]):
+            lines.append(f"{name:<{width}} {started * 1000:>7.0f}ms {(ended - started) * 1000:>7.0f}ms")
+        lines.append(f"{'ready to take updates after':<{width}} {(self._last - self.origin) * 1000:>17.0f}ms")
+        return '\n'.join(lines)
+
+
+def prewarm_mongo(client, connections=DEFAULT_PREWARM_CONNECTIONS):
+    """Opens `connections` connections of the client's pool in a background thread.
+
+    Returns a concurrent.futures.Future set to the (start, end) perf_counter
+    times once they are open, or to the error that prevented it.
+    """
+    future = Future()
+
+    def warm():
+        started = time.perf_counter()
+        try:
+            # Commands running at the same time each check out their own connection
+            with ThreadPoolExecutor(connections, thread_name_prefix='mongo-prewarm') as pool:
+                pings = [pool.submit(client.admin.command, 'ping') for _ in range(connections)]
+                for ping in pings:
+                    ping.result()
+        except Exception as error:
+            future.set_exception(error)
+        else:
+            future.set_result((started, time.perf_counter()))
+
+    threading.Thread(target=warm, name='mongo-prewarm', daemon=True).start()
+    return future
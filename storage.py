@@ -0,0 +1,236 @@
+"""Storage interface of the bot, implemented by interchangeable backends.
+
+Handlers never talk to a database directly: they go through the async
+repositories (repository.py, cache.py, ledger.py, methods.py) and the
+persistence (persistence.py), which run the blocking calls of a Storage on
+their executor. A Storage groups five stores:
+
+- users: the user documents, changed with the updates UserSession stages;
+- settings: key/value settings shared by the whole bot;
+- sessions: conversation states and user_data, for the persistence and the
+  conversation sweeper;
+- ledger: the transactions and balance snapshots of ledger.py;
+- methods: the saved payment methods of methods.py.
+
+Three backends are available, chosen with STORAGE_BACKEND in main.py:
+
+- 'mongo' (mongo_storage.py): the bot_database of a MongoDB deployment;
+- 'sqlite' (sqlite_storage.py): a single SQLite file, for small deployments;
+- 'memory' (memory_storage.py): dicts in the process, for tests and trying
+  the bot out. Nothing survives a restart.
+
+Updates of user documents are the documents UserSession builds: the $set,
+$inc, $push, $unset and $setOnInsert operators on dotted paths, as applied
+by repository.apply_update. Conditions map dotted paths to the values the
+stored document must have for an update to apply, or to {'$gte': value}
+for a lower bound.
+
+Every store method may be called from several executor threads at once.
+"""
+import os
+import sys
+
+from repository import apply_update, resolve_path
+
+
+STORAGE_BACKENDS = ('mongo', 'sqlite', 'memory')
+
+# Fields every user document has; new documents are created with these values
+USER_DEFAULTS = {
+    'balance': 0,
+    'temp_data': {},
+}
+
+
+def script_mongo_uri(script):
+    """MONGO_URI for a maintenance script that works on MongoDB only.
+
+    Exits with an error when the bot keeps its data in another backend, rather
+    than reaching a MongoDB that does not hold it.
+    """
+    backend = os.getenv('STORAGE_BACKEND', 'mongo')
+    if backend != 'mongo':
+        sys.exit(f"{script} works on MongoDB only, and STORAGE_BACKEND is {backend!r}.")
+    mongo_uri = os.getenv('MONGO_URI')
+    if not mongo_uri:
+        sys.exit("Please set the environment variable MONGO_URI.")
+    return mongo_uri
+
+
+def _is_bound(value):
+    return isinstance(value, dict) and list(value) == ['$gte']
+
+
+def matches_condition(document, condition):
+    """Tells whether the document has the value, or at least the bound, of every dotted path of the condition."""
+    for path, value in (condition or {}).items():
+        parent, key = resolve_path(document, path)
+        if parent is None or key not in parent:
+            return False
+        if _is_bound(value):
+            if not isinstance(parent[key], (int, float)) or parent[key] < value['$gte']:
+                return False
+        elif parent[key] != value:
+            return False
+    return True
+
+
+def upserted_document(user_id, update, condition=None):
+    """The user document an upsert creates: the condition's values, then $setOnInsert, then the update."""
+    document = {'user_id': user_id}
+    values = {path: value for path, value in (condition or {}).items() if not _is_bound(value)}
+    apply_update(document, {'$set': values})
+    apply_update(document, {'$set': update.get('$setOnInsert', {})})
+    apply_update(document, update)
+    return document
+
+
+def cleared_temp_data(document):
+    """Empties temp_data, and drops the 'state' field of older versions. Returns whether anything changed."""
+    if document.get('temp_data') == {} and 'state' not in document:
+        return False
+    document['temp_data'] = {}
+    document.pop('state', None)
+    return True
+
+
+class UserStore:
+    """User documents, keyed by the Telegram user_id."""
+
+    def get(self, user_id):
+        """Returns the user document, or None."""
+        raise NotImplementedError
+
+    def insert(self, document):
+        raise NotImplementedError
+
+    def update(self, user_id, update, condition=None):
+        """Applies an update, only if the document also matches `condition`. Returns whether it did."""
+        raise NotImplementedError
+
+    def update_and_get(self, user_id, update, upsert=False, condition=None):
+        """Applies an update and returns the resulting document.
+
+        Returns None, without applying it, if the document does not exist (and
+        upsert is False) or does not match `condition`.
+        """
+        raise NotImplementedError
+
+    def update_many(self, requests):
+        """Applies a batch of (user_id, update, condition) requests, in order, and returns their results.
+
+        Each user appears at most once per batch. The result of a request is
+        the document as stored after it, None if it did not apply (like
+        update_and_get), or the exception that left it unapplied when the
+        batch failed part way. Backends override this to write the whole
+        batch in one round trip or transaction.
+        """
+        return [self.update_and_get(user_id, update, condition=condition) for user_id, update, condition in requests]
+
+    def clear_temp_data(self, user_ids):
+        """Empties temp_data, and drops the 'state' field of older versions, of the given users."""
+        raise NotImplementedError
+
+
+class SettingsStore:
+    """Key/value settings shared by the whole bot."""
+
+    def get(self, key):
+        """Returns the value of a setting, or None."""
+        raise NotImplementedError
+
+    def set(self, key, value):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+
+class SessionStore:
+    """ConversationHandler states and user_data, written by the persistence."""
+
+    def conversations(self, name):
+        """Returns {key: state} of the conversation `name`. Keys are tuples (chat_id, user_id)."""
+        raise NotImplementedError
+
+    def user_data(self):
+        """Returns {user_id: data} of every user."""
+        raise NotImplementedError
+
+    def write_conversations(self, changes):
+        """Stores {(name, key): (state, state_updated_at)}; a state of None deletes the conversation."""
+        raise NotImplementedError
+
+    def write_user_data(self, changes):
+        """Stores {user_id: data}; data of None deletes the user's data."""
+        raise NotImplementedError
+
+    def expired_conversations(self, name, before, batch_size):
+        """Iterates over the (key, state) of the conversations whose state was last written before `before`.
+
+        The iterator is read batch_size conversations at a time, possibly from
+        different threads, and closed when the caller is done with it.
+        """
+        raise NotImplementedError
+
+
+class LedgerStore:
+    """Transactions and balance snapshots, as documented in ledger.py."""
+
+    def insert_entries(self, entries):
+        """Stores transactions, ignoring those an earlier attempt already stored."""
+        raise NotImplementedError
+
+    def insert_snapshots(self, snapshots):
+        """Stores balance snapshots, ignoring those an earlier attempt already stored."""
+        raise NotImplementedError
+
+    def history(self, user_id, before=None, limit=None):
+        """Returns up to `limit` transactions of a user, newest first, older than the (ts, seq) `before`."""
+        raise NotImplementedError
+
+    def latest_snapshot(self, user_id):
+        """Returns the user's most recent balance snapshot, or None."""
+        raise NotImplementedError
+
+    def entries_after(self, user_id, ts, seq):
+        """Returns the {seq, amount} of the user's transactions after (ts, seq), oldest first."""
+        raise NotImplementedError
+
+
+class MethodStore:
+    """Saved payment methods, as documented in methods.py."""
+
+    def page(self, user_id, kind, after=None, limit=None):
+        """Returns up to `limit` valid methods of a user, oldest first, after the (added_at, _id) `after`."""
+        raise NotImplementedError
+
+    def get(self, user_id, kind, method_id):
+        """Returns a valid method of the user, or None."""
+        raise NotImplementedError
+
+    def add(self, document):
+        """Inserts a method unless one with its _id exists. Returns the existing method, or None if inserted."""
+        raise NotImplementedError
+
+
+class Storage:
+    """The stores of one backend, and what must be done with the database as a whole."""
+
+    name = None
+
+    def __init__(self, users, settings, sessions, ledger, methods):
+        self.users = users
+        self.settings = settings
+        self.sessions = sessions
+        self.ledger = ledger
+        self.methods = methods
+
+    def bootstrap(self):
+        """Prepares the database before updates are taken. Blocking, run once per bot."""
+
+    def check_query_plans(self):
+        """Logs how the database runs the queries of the hot path, where the backend can tell."""
+
+    def close(self):
+        pass
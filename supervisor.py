@@ -0,0 +1,257 @@
+"""Scale-out across worker processes partitioned by user_id.
+
+All bot state is keyed by user_id, so users can be split into shards that
+never share data. In supervisor mode this process only fetches updates (long
+polling or webhook) and routes each one to the worker owning its user, chosen
+by a jump consistent hash of the user id. Every worker is a separate process
+with its own Application, database connections and caches, and only ever sees the
+users of its shard, so the per-user ordering guarantees and the single-writer
+assumption of the user cache still hold.
+
+Updates are only routed once every worker has started, worker 0 having
+bootstrapped the database first. Workers that die are started again with
+the same shard.
+"""
+import asyncio
+import contextlib
+import logging
+import multiprocessing
+import queue
+import signal
+from urllib.parse import urlparse
+
+from telegram import Bot, Update
+from telegram.error import TelegramError
+
+from webhook import WebhookServer
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKER_QUEUE_SIZE = 1000
+POLL_TIMEOUT = 30
+MONITOR_INTERVAL = 1
+
+
+def shard_for(user_id, shards):
+    """Jump consistent hash: maps a user id to one of `shards` buckets.
+
+    Growing from n to n + 1 shards only moves 1/(n + 1) of the users.
+    """
+    key = user_id & 0xFFFFFFFFFFFFFFFF
+    bucket, candidate = -1, 0
+    while candidate < shards:
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def routing_user_id(data):
+    """Finds the user an update belongs to in its raw JSON, without decoding it into an Update."""
+    for key, value in data.items():
+        if key == 'update_id' or not isinstance(value, dict):
+            continue
+        for field in ('from', 'user'):
+            if isinstance(value.get(field), dict):
+                return value[field]['id']
+        if isinstance(value.get('chat'), dict):
+            return value['chat']['id']
+    return 0
+
+
+# ------------------ Worker side ------------------
+
+def worker_main(index, shards, updates, build_application, ready, post_start=None):
+    """Entry point of a worker process."""
+    # Ctrl+C reaches the whole process group; workers stop when the supervisor tells them to
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_serve_worker(index, shards, updates, build_application, ready, post_start))
+
+
+async def _serve_worker(index, shards, updates, build_application, ready, post_start=None):
+    application = build_application(index, shards)
+    loop = asyncio.get_running_loop()
+
+    async with application:
+        # post_init runs in every worker; work that must happen once per bot checks the shard itself
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        ready.set()
+        logger.info("Worker %s/%s started", index + 1, shards)
+        try:
+            if post_start:
+                await post_start(application)
+            while True:
+                data = await loop.run_in_executor(None, updates.get)
+                if data is None:
+                    break
+                await application.update_queue.put(Update.de_json(data, application.bot))
+            await application.update_queue.join()
+        finally:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+
+
+# ------------------ Supervisor side ------------------
+
+class Supervisor:
+    """Starts the worker processes and routes raw updates to them."""
+
+    def __init__(self, build_application, workers, queue_size=DEFAULT_WORKER_QUEUE_SIZE, post_start=None):
+        self.build_application = build_application
+        self.post_start = post_start
+        self.workers = workers
+        self.queue_size = queue_size
+        # Workers open their own database connections, which must not be inherited through fork
+        self.context = multiprocessing.get_context('spawn')
+        self.queues = [self.context.Queue(queue_size) for _ in range(workers)]
+        self.processes = [None] * workers
+        self.ready = [self.context.Event() for _ in range(workers)]
+
+    def start(self):
+        for index in range(self.workers):
+            self._spawn(index)
+
+    def _spawn(self, index):
+        self.ready[index].clear()
+        process = self.context.Process(
+            target=worker_main,
+            args=(index, self.workers, self.queues[index], self.build_application, self.ready[index], self.post_start),
+            name=f'bot-worker-{index}',
+            daemon=True
+        )
+        process.start()
+        self.processes[index] = process
+
+    def wait_ready(self, timeout=None):
+        """Blocks until every worker has started its Application. Returns False on timeout."""
+        return all(event.wait(timeout) for event in self.ready)
+
+    def restart_dead_workers(self):
+        for index, process in enumerate(self.processes):
+            if not process.is_alive():
+                logger.warning("Worker %s exited with code %s, starting it again", index, process.exitcode)
+                self._spawn(index)
+
+    def route(self, data, block=True):
+        """Sends a raw update to the worker owning its user. Returns False if that worker's queue is full."""
+        index = shard_for(routing_user_id(data), self.workers)
+        try:
+            self.queues[index].put(data, block=block)
+        except queue.Full:
+            return False
+        return True
+
+    def stop(self, timeout=30):
+        for updates in self.queues:
+            updates.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+
+
+class ShardedWebhookServer(WebhookServer):
+    """WebhookServer that hands updates to the supervisor instead of a local Application."""
+
+    def __init__(self, supervisor, *args, **kwargs):
+        super().__init__(None, *args, **kwargs)
+        self.supervisor = supervisor
+
+    def deliver(self, data):
+        return self.supervisor.route(data, block=False)
+
+
+async def _monitor(supervisor, stop_event):
+    while not stop_event.is_set():
+        supervisor.restart_dead_workers()
+        try:
+            await asyncio.wait_for(stop_event.wait(), MONITOR_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def _wait_ready(supervisor, stop_event):
+    """Waits until every worker started its Application, or until stop_event. Returns whether they all did.
+
+    Worker 0 bootstraps the database (indexes and migrations) before it is
+    ready, so no worker is handed updates for documents not migrated yet.
+    """
+    loop = asyncio.get_running_loop()
+    while not stop_event.is_set():
+        if await loop.run_in_executor(None, supervisor.wait_ready, MONITOR_INTERVAL):
+            return True
+    return False
+
+
+async def _poll(bot, supervisor, stop_event):
+    """Single long-polling loop feeding all workers."""
+    loop = asyncio.get_running_loop()
+    await bot.delete_webhook()
+    offset = None
+    try:
+        while not stop_event.is_set():
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=POLL_TIMEOUT, allowed_updates=Update.ALL_TYPES)
+            except TelegramError as error:
+                logger.warning("Fetching updates failed: %s", error)
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                # Blocks while the owning worker is saturated, which slows polling down for everyone
+                await loop.run_in_executor(None, supervisor.route, update.to_dict())
+                offset = update.update_id + 1
+    finally:
+        if offset is not None:
+            # Tells Telegram the updates routed so far were received, or it delivers them again on the next start
+            try:
+                await bot.get_updates(offset=offset, limit=1, timeout=0)
+            except TelegramError as error:
+                logger.warning("Confirming the last updates failed: %s", error)
+
+
+async def _serve(token, supervisor, mode, webhook_url, listen, port, secret_token):
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop_event.set)
+
+    supervisor.start()
+    monitor = asyncio.create_task(_monitor(supervisor, stop_event))
+    try:
+        if not await _wait_ready(supervisor, stop_event):
+            return
+        async with Bot(token) as bot:
+            if mode == 'webhook':
+                server = ShardedWebhookServer(supervisor, listen, port, urlparse(webhook_url).path, secret_token)
+                await bot.set_webhook(webhook_url, secret_token=secret_token, allowed_updates=Update.ALL_TYPES)
+                await server.start()
+                try:
+                    await stop_event.wait()
+                finally:
+                    await server.stop()
+            else:
+                polling = asyncio.create_task(_poll(bot, supervisor, stop_event))
+                await stop_event.wait()
+                polling.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await polling
+    finally:
+        stop_event.set()
+        await monitor
+        supervisor.stop()
+
+
+def run_supervisor(token, build_application, workers, mode='polling', webhook_url=None, listen='0.0.0.0',
+                   port=None, secret_token=None, queue_size=DEFAULT_WORKER_QUEUE_SIZE, post_start=None):
+    """Runs the front dispatcher and `workers` worker processes until SIGINT/SIGTERM.
+
+    build_application(index, shards) is called inside each worker and must be a
+    module-level function so it can be handed to a spawned process. So must
+    post_start(application), awaited in each worker once its Application started.
+    """
+    supervisor = Supervisor(build_application, workers, queue_size, post_start)
+    asyncio.run(_serve(token, supervisor, mode, webhook_url, listen, port, secret_token))
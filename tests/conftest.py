@@ -0,0 +1,69 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Update
+from telegram.ext import ApplicationBuilder
+
+from benchmarks.fakes import FakeBotRequest
+from handlers import setup_handlers
+from memory_storage import MemoryStorage
+from persistence import StoragePersistence
+from sqlite_storage import SQLiteStorage
+
+
+@pytest.fixture(params=['memory', 'sqlite', 'mongo'])
+def storage(request, tmp_path):
+    """Each storage backend, empty. 'mongo' runs on mongomock and is skipped without it."""
+    if request.param == 'memory':
+        storage = MemoryStorage()
+    elif request.param == 'sqlite':
+        storage = SQLiteStorage(str(tmp_path / 'bot.sqlite3'))
+    else:
+        mongomock = pytest.importorskip('mongomock')
+        from mongo_storage import MongoStorage
+        storage = MongoStorage(mongomock.MongoClient()['bot_database'])
+    yield storage
+    storage.close()
+
+
+@pytest.fixture
+def run_bot():
+    """Runs `await scenario(application, send)` on the bot, over a fake Bot API and MemoryStorage by default.
+
+    send(update) processes the JSON of an update and returns the texts the bot sent or edited for it.
+    """
+    def run(scenario, storage=None, **options):
+        storage = storage or MemoryStorage()
+        bot_request = FakeBotRequest()
+        application = (
+            ApplicationBuilder()
+            .token('123:test')
+            .request(bot_request)
+            .get_updates_request(FakeBotRequest())
+            .persistence(StoragePersistence(storage.sessions))
+            .build()
+        )
+        setup_handlers(application, storage, **options)
+
+        async def send(update):
+            sent = len(bot_request.calls)
+            await application.process_update(Update.de_json(update, application.bot))
+            return [parameters['text'] for endpoint, parameters in bot_request.calls[sent:]
+                    if endpoint in ('sendMessage', 'editMessageText')]
+
+        async def main():
+            async with application:
+                await application.start()
+                try:
+                    return await scenario(application, send)
+                finally:
+                    await application.stop()
+
+        return asyncio.run(main())
+
+    return run
@@ -0,0 +1,87 @@
+"""Repeated confirmations change the balance and write a ledger entry once."""
+import asyncio
+
+from benchmarks.fakes import callback_update, message_update
+from dedup import ConfirmationDeduplicator
+
+USER_ID = 7
+
+
+def deposit_updates(amount=30):
+    """The updates of a deposit, up to the confirmation screen."""
+    return [
+        message_update(USER_ID, '/start'),
+        callback_update(USER_ID, 'd:go'),
+        message_update(USER_ID, str(amount)),
+        callback_update(USER_ID, 'd:add'),
+        callback_update(USER_ID, 'd:t:bank'),
+        message_update(USER_ID, f'Bank {USER_ID}'),
+    ]
+
+
+async def balance_and_ledger(application):
+    await application.bot_data['ledger'].flush()
+    user = await application.bot_data['users'].get(USER_ID, fresh=True)
+    entries, _ = await application.bot_data['ledger'].history(USER_ID)
+    return user['balance'], [entry['amount'] for entry in entries]
+
+
+def test_callback_query_is_only_seen_once_handled():
+    confirmations = ConfirmationDeduplicator()
+    assert not confirmations.seen_callback_query('1')
+    assert not confirmations.seen_callback_query('1')
+    confirmations.handled_callback_query('1')
+    assert confirmations.seen_callback_query('1')
+    assert confirmations.suppressed['callback_query'] == 1
+
+
+def test_confirmation_delivered_twice_at_once(run_bot):
+    async def scenario(application, send):
+        for update in deposit_updates():
+            await send(update)
+        confirm = callback_update(USER_ID, 'd:ok')
+        await asyncio.gather(send(confirm), send(confirm))
+        return await balance_and_ledger(application), application.bot_data['confirmations']
+
+    (balance, amounts), confirmations = run_bot(scenario)
+    assert balance == 30 and amounts == [30]
+    assert confirmations.confirmed == 1
+    assert sum(confirmations.suppressed.values()) == 1
+
+
+def test_double_tapped_confirmation(run_bot):
+    async def scenario(application, send):
+        for update in deposit_updates():
+            await send(update)
+        await asyncio.gather(send(callback_update(USER_ID, 'd:ok')), send(callback_update(USER_ID, 'd:ok')))
+        # Delivered again once the deposit is done
+        replies = await send(callback_update(USER_ID, 'd:ok'))
+        return replies, await balance_and_ledger(application)
+
+    replies, (balance, amounts) = run_bot(scenario)
+    assert balance == 30 and amounts == [30]
+    assert not any('completed' in reply for reply in replies)
+
+
+def test_confirmation_retried_after_failed_commit(run_bot):
+    async def scenario(application, send):
+        for update in deposit_updates():
+            await send(update)
+        users = application.bot_data['storage'].users
+        update_many = users.update_many
+
+        def fail(requests):
+            raise ConnectionError('database unreachable')
+
+        users.update_many = fail
+        confirm = callback_update(USER_ID, 'd:ok')
+        await send(confirm)
+        users.update_many = update_many
+        # Telegram delivers the update again, as it was not acknowledged
+        replies = await send(confirm)
+        await send(confirm)
+        return replies, await balance_and_ledger(application)
+
+    replies, (balance, amounts) = run_bot(scenario)
+    assert any('Deposit of $30 completed successfully!' in reply for reply in replies)
+    assert balance == 30 and amounts == [30]
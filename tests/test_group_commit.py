@@ -0,0 +1,106 @@
+"""GroupCommitter batches conditional updates of many users, on every backend."""
+import asyncio
+
+import pytest
+
+from group_commit import GroupCommitter
+from repository import create_executor
+
+
+def confirmation(nonce, amount):
+    """The update confirming a transaction with this nonce, as handlers.confirm commits it."""
+    return {'$inc': {'balance': amount, 'ledger_seq': 1}, '$set': {'temp_data.nonce': nonce + 1}}
+
+
+def run_committer(store, scenario, window=0.01, batch_size=256):
+    async def main():
+        executor = create_executor(4)
+        committer = GroupCommitter(store, executor, window, batch_size)
+        try:
+            return await scenario(committer), committer.stats()
+        finally:
+            executor.shutdown()
+
+    return asyncio.run(main())
+
+
+def test_updates_of_many_users_share_batches(storage):
+    users = range(1, 21)
+    for user_id in users:
+        storage.users.insert({'user_id': user_id, 'balance': 0, 'ledger_seq': 0, 'temp_data': {'nonce': 0}})
+
+    async def confirm(committer, user_id):
+        results = []
+        for nonce in range(3):
+            update = confirmation(nonce, user_id)
+            results.append(await committer.update_and_get(user_id, update, {'temp_data.nonce': nonce}))
+        return results
+
+    async def scenario(committer):
+        return await asyncio.gather(*(confirm(committer, user_id) for user_id in users))
+
+    results, stats = run_committer(storage.users, scenario)
+    for user_id, user_results in zip(users, results):
+        assert [result['ledger_seq'] for result in user_results] == [1, 2, 3]
+        assert storage.users.get(user_id)['balance'] == user_id * 3
+    assert stats['updates'] == 60
+    assert stats['batches'] < stats['updates']
+
+
+def test_batch_returns_none_for_unmet_conditions(storage):
+    storage.users.insert({'user_id': 1, 'balance': 5, 'temp_data': {'nonce': 0}})
+    storage.users.insert({'user_id': 2, 'balance': 5, 'temp_data': {'nonce': 0}})
+
+    async def scenario(committer):
+        return await asyncio.gather(
+            committer.update_and_get(1, confirmation(0, 1), {'temp_data.nonce': 0}),
+            committer.update_and_get(2, confirmation(1, 1), {'temp_data.nonce': 1}),
+            committer.update_and_get(3, confirmation(0, 1), {'temp_data.nonce': 0}),
+            committer.update_and_get(2, {'$inc': {'balance': -6}}, {'balance': {'$gte': 6}}),
+        )
+
+    results, stats = run_committer(storage.users, scenario)
+    assert results[0]['balance'] == 6
+    assert results[1:] == [None, None, None]
+    assert storage.users.get(2)['balance'] == 5
+    assert storage.users.get(3) is None
+
+
+def test_failed_batch_raises_for_each_update(storage):
+    storage.users.insert({'user_id': 1, 'balance': 5})
+
+    def fail(requests):
+        raise ConnectionError('database unreachable')
+
+    storage.users.update_many = fail
+
+    async def scenario(committer):
+        return await asyncio.gather(
+            committer.update_and_get(1, {'$inc': {'balance': 1}}),
+            committer.update_and_get(2, {'$inc': {'balance': 1}}),
+            return_exceptions=True,
+        )
+
+    results, stats = run_committer(storage.users, scenario)
+    assert [type(result) for result in results] == [ConnectionError, ConnectionError]
+    assert storage.users.get(1)['balance'] == 5
+
+
+def test_batch_marker_is_removed():
+    mongomock = pytest.importorskip('mongomock')
+    from mongo_storage import GROUP_COMMIT_MARKER, MongoStorage
+    storage = MongoStorage(mongomock.MongoClient()['bot_database'])
+    for user_id in range(1, 6):
+        storage.users.insert({'user_id': user_id, 'balance': 0, 'temp_data': {'nonce': 0}})
+
+    async def scenario(committer):
+        return await asyncio.gather(*(
+            committer.update_and_get(user_id, confirmation(0, 1), {'temp_data.nonce': user_id % 2})
+            for user_id in range(1, 6)
+        ))
+
+    results, stats = run_committer(storage.users, scenario)
+    assert [result is not None for result in results] == [False, True, False, True, False]
+    assert all(GROUP_COMMIT_MARKER not in result for result in results if result is not None)
+    assert storage.db['users'].count_documents({GROUP_COMMIT_MARKER: {'$exists': True}}) == 0
+    assert stats['batches'] == 1
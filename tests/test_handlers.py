@@ -0,0 +1,32 @@
+"""Conversations with the bot, from updates to the documents they leave behind."""
+from benchmarks.fakes import callback_update, message_update
+
+
+def test_user_without_document_views_balance(run_bot):
+    async def scenario(application, send):
+        # Never sent /start: the main menu still answers, from a document created on the way
+        await send(message_update(7, 'hello'))
+        return await send(callback_update(7, 'bal')), await application.bot_data['users'].get(7)
+
+    replies, user = run_bot(scenario)
+    assert 'Your current balance is: $0' in replies[0]
+    assert user['balance'] == 0
+
+
+def test_user_without_document_deposits(run_bot):
+    async def scenario(application, send):
+        for update in [
+            message_update(7, 'hello'),
+            callback_update(7, 'd:go'),
+            message_update(7, '30'),
+            callback_update(7, 'd:add'),
+            callback_update(7, 'd:t:bank'),
+            message_update(7, 'Bank 7'),
+        ]:
+            await send(update)
+        replies = await send(callback_update(7, 'd:ok'))
+        return replies, await application.bot_data['users'].get(7)
+
+    replies, user = run_bot(scenario)
+    assert any('Deposit of $30 completed successfully!' in reply for reply in replies)
+    assert user['balance'] == 30 and user['temp_data'] == {}
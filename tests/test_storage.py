@@ -0,0 +1,204 @@
+"""The store contract of storage.py, run against every backend."""
+import itertools
+from datetime import timedelta
+
+from ledger import MILLISECOND, ledger_now
+from methods import method_document
+
+
+def without_id(document):
+    """The document without the _id MongoDB gives user documents."""
+    if document is None:
+        return None
+    return {key: value for key, value in document.items() if key != '_id'}
+
+
+def user(user_id, balance=10, nonce='a'):
+    return {'user_id': user_id, 'balance': balance, 'temp_data': {'nonce': nonce}}
+
+
+# ------------------ Users ------------------
+
+def test_update_applies_only_when_condition_matches(storage):
+    users = storage.users
+    users.insert(user(1))
+
+    assert users.update(1, {'$inc': {'balance': 5}}, {'temp_data.nonce': 'b'}) is False
+    assert users.get(1)['balance'] == 10
+    assert users.update(1, {'$inc': {'balance': 5}}, {'temp_data.nonce': 'a'}) is True
+    assert users.get(1)['balance'] == 15
+    assert users.update(2, {'$inc': {'balance': 5}}) is False
+    assert users.get(2) is None
+
+
+def test_update_and_get_with_lower_bound(storage):
+    users = storage.users
+    users.insert(user(1))
+
+    assert users.update_and_get(1, {'$inc': {'balance': -11}}, condition={'balance': {'$gte': 11}}) is None
+    stored = users.update_and_get(1, {'$inc': {'balance': -10}}, condition={'balance': {'$gte': 10}})
+    assert without_id(stored) == user(1, balance=0)
+    assert without_id(users.get(1)) == user(1, balance=0)
+
+
+def test_update_and_get_returns_none_for_missing_user(storage):
+    assert storage.users.update_and_get(1, {'$set': {'balance': 1}}) is None
+    assert storage.users.get(1) is None
+
+
+def test_upsert_creates_document(storage):
+    users = storage.users
+    update = {'$setOnInsert': {'balance': 0, 'temp_data': {}}, '$set': {'temp_data.nonce': 'a'}}
+
+    created = users.update_and_get(1, update, upsert=True)
+    assert without_id(created) == user(1, balance=0)
+    again = users.update_and_get(1, {'$setOnInsert': {'balance': 99}, '$inc': {'balance': 3}}, upsert=True)
+    assert again['balance'] == 3
+
+
+def test_update_operators(storage):
+    users = storage.users
+    users.insert(user(1))
+
+    users.update(1, {'$push': {'history': {'$each': [1, 2]}}, '$unset': {'temp_data.nonce': ''}})
+    users.update(1, {'$push': {'history': 3}, '$set': {'temp_data.step': 2}})
+    assert without_id(users.get(1)) == {'user_id': 1, 'balance': 10, 'temp_data': {'step': 2}, 'history': [1, 2, 3]}
+
+
+def test_update_many_returns_results_in_order(storage):
+    users = storage.users
+    for user_id in (1, 2, 3):
+        users.insert(user(user_id))
+    requests = [
+        (3, {'$inc': {'balance': 1}, '$set': {'temp_data.nonce': 'b'}}, {'temp_data.nonce': 'a'}),
+        (1, {'$inc': {'balance': 1}}, {'temp_data.nonce': 'stale'}),
+        (4, {'$inc': {'balance': 1}}, None),
+        (2, {'$inc': {'balance': -10}}, {'balance': {'$gte': 10}}),
+    ]
+
+    results = users.update_many(requests)
+    assert [without_id(result) for result in results] == [user(3, 11, 'b'), None, None, user(2, 0)]
+    assert [without_id(users.get(user_id)) for user_id in (1, 2, 3, 4)] == [user(1), user(2, 0), user(3, 11, 'b'), None]
+
+
+def test_clear_temp_data(storage):
+    users = storage.users
+    users.insert(dict(user(1), state=3))
+    users.insert(user(2))
+
+    users.clear_temp_data([1, 99])
+    assert without_id(users.get(1)) == {'user_id': 1, 'balance': 10, 'temp_data': {}}
+    assert without_id(users.get(2)) == user(2)
+    assert users.get(99) is None
+
+
+# ------------------ Settings and sessions ------------------
+
+def test_settings(storage):
+    settings = storage.settings
+    assert settings.get('key') is None
+    settings.set('key', {'a': [1]})
+    assert settings.get('key') == {'a': [1]}
+    settings.set('key', 7)
+    assert settings.get('key') == 7
+    settings.delete('key')
+    assert settings.get('key') is None
+
+
+def test_conversations_and_user_data(storage):
+    sessions = storage.sessions
+    now = ledger_now()
+    sessions.write_conversations({('main', (1, 1)): (1, now), ('main', (2, 2)): (2, now), ('other', (1, 1)): (3, now)})
+    sessions.write_conversations({('main', (2, 2)): (None, now)})
+    sessions.write_user_data({1: {'a': 1}, 2: {'b': 2}})
+    sessions.write_user_data({2: None})
+
+    assert sessions.conversations('main') == {(1, 1): 1}
+    assert sessions.conversations('other') == {(1, 1): 3}
+    assert sessions.user_data() == {1: {'a': 1}}
+
+
+def test_expired_conversations_in_batches(storage):
+    sessions = storage.sessions
+    now = ledger_now()
+    old = now - timedelta(days=2)
+    sessions.write_conversations({('main', (i, i)): (i % 3, old if i % 2 else now) for i in range(1, 10)})
+    sessions.write_conversations({('other', (1, 1)): (1, old)})
+
+    expired = sessions.expired_conversations('main', now - timedelta(days=1), 2)
+    found = list(itertools.islice(expired, 2)) + list(itertools.islice(expired, 2)) + list(expired)
+    expired.close()
+    assert sorted(found) == [((i, i), i % 3) for i in (1, 3, 5, 7, 9)]
+
+
+# ------------------ Ledger and methods ------------------
+
+def ledger_entries(user_id, count, start):
+    return [{'_id': f'{user_id}:{seq}', 'user_id': user_id, 'seq': seq, 'ts': start + seq * MILLISECOND,
+             'type': 'deposit', 'amount': seq, 'balance': seq * (seq + 1) // 2, 'method': None}
+            for seq in range(1, count + 1)]
+
+
+def test_ledger_history_pages(storage):
+    ledger = storage.ledger
+    entries = ledger_entries(5, 25, ledger_now())
+    ledger.insert_entries(entries[:10])
+    # A retried insert skips the entries already stored
+    ledger.insert_entries(entries)
+
+    first = ledger.history(5, None, 10)
+    assert [entry['seq'] for entry in first] == list(range(25, 15, -1))
+    second = ledger.history(5, (first[-1]['ts'], first[-1]['seq']), 10)
+    assert [entry['seq'] for entry in second] == list(range(15, 5, -1))
+    last = ledger.history(5, (second[-1]['ts'], second[-1]['seq']), 10)
+    assert [entry['seq'] for entry in last] == list(range(5, 0, -1))
+    assert ledger.history(6, None, 10) == []
+
+
+def test_ledger_snapshots_and_entries_after(storage):
+    ledger = storage.ledger
+    start = ledger_now()
+    entries = ledger_entries(5, 25, start)
+    ledger.insert_entries(entries)
+    snapshots = [{'_id': f'5:{seq}', 'user_id': 5, 'seq': seq, 'ts': start + seq * MILLISECOND, 'balance': balance}
+                 for seq, balance in ((0, 0), (20, 210))]
+    ledger.insert_snapshots(snapshots)
+    ledger.insert_snapshots(snapshots)
+
+    assert without_id(ledger.latest_snapshot(5)) == without_id(snapshots[1])
+    assert ledger.latest_snapshot(6) is None
+    after = ledger.entries_after(5, snapshots[1]['ts'], 20)
+    assert [(entry['seq'], entry['amount']) for entry in after] == [(seq, seq) for seq in range(21, 26)]
+
+
+def test_methods_pages(storage):
+    methods = storage.methods
+    start = ledger_now()
+    # Pairs of methods added in the same millisecond, ordered by _id
+    documents = [method_document(7, 'deposit', 'Bank', f'account {i}', start + i // 2 * MILLISECOND) for i in range(7)]
+    for document in documents:
+        assert methods.add(document) is None
+    invalid = method_document(7, 'deposit', 'Bank', 'invalid', start)
+    invalid['invalid'] = 'Unknown account'
+    methods.add(invalid)
+    methods.add(method_document(7, 'withdrawal', 'Bank', 'account 0', start))
+
+    ordered = sorted(documents, key=lambda document: (document['added_at'], document['_id']))
+    first = methods.page(7, 'deposit', None, 4)
+    assert [document['_id'] for document in first] == [document['_id'] for document in ordered[:4]]
+    rest = methods.page(7, 'deposit', (first[-1]['added_at'], first[-1]['_id']), 4)
+    assert [document['_id'] for document in rest] == [document['_id'] for document in ordered[4:]]
+
+
+def test_methods_add_and_get(storage):
+    methods = storage.methods
+    document = method_document(7, 'deposit', 'Bank', 'account 1')
+    invalid = dict(method_document(7, 'deposit', 'Bank', 'invalid'), invalid='Unknown account')
+    methods.add(document)
+    methods.add(invalid)
+
+    assert methods.add(method_document(7, 'deposit', 'Bank', 'account 1')) == document
+    assert methods.get(7, 'deposit', document['_id']) == document
+    assert methods.get(7, 'withdrawal', document['_id']) is None
+    assert methods.get(8, 'deposit', document['_id']) is None
+    assert methods.get(7, 'deposit', invalid['_id']) is None
@@ -0,0 +1,160 @@
+"""Address checksums against the reference vectors of BIP-173, BIP-350 and EIP-55."""
+import pytest
+
+import validation
+from validation import (
+    base58check_decode, eip55_checksum, keccak_256, segwit_decode, validate_bitcoin_address, validate_detail,
+    validate_ethereum_address, validate_tron_address, validate_usdt_address
+)
+
+P2WPKH_PROGRAM = '751e76e8199196d454941c45d1b3a323f1433bd6'
+
+
+@pytest.fixture(params=['fast', 'pure'])
+def keccak(request, monkeypatch):
+    """Runs a test with pycryptodome's Keccak-256, when it is installed, and with the pure Python one."""
+    if request.param == 'fast':
+        if validation.fast_keccak is None:
+            pytest.skip('pycryptodome is not installed')
+    else:
+        monkeypatch.setattr(validation, 'fast_keccak', None)
+    validate_detail.cache_clear()
+    yield request.param
+    validate_detail.cache_clear()
+
+
+# ------------------ Bech32 and Bech32m ------------------
+
+@pytest.mark.parametrize('address, version, program', [
+    # BIP-173
+    ('BC1QW508D6QEJXTDG4Y5R3ZARVARY0C5XW7KV8F3T4', 0, P2WPKH_PROGRAM),
+    ('bc1qrp33g0q5c5txsp9arysrx4k6zdkfs4nce4xj0gdcccefvpysxf3qccfmv3', 0,
+     '1863143c14c5166804bd19203356da136c985678cd4d27a1b8c6329604903262'),
+    # BIP-350
+    ('bc1pw508d6qejxtdg4y5r3zarvary0c5xw7kw508d6qejxtdg4y5r3zarvary0c5xw7kt5nd6y', 1, P2WPKH_PROGRAM * 2),
+    ('BC1SW50QGDZ25J', 16, '751e'),
+    ('bc1zw508d6qejxtdg4y5r3zarvaryvaxxpcs', 2, '751e76e8199196d454941c45d1b3a323'),
+    ('bc1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vqzk5jj0', 1,
+     '79be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798'),
+])
+def test_valid_segwit_addresses(address, version, program):
+    assert segwit_decode(address, 'bc') == (version, bytes.fromhex(program))
+    assert validate_bitcoin_address(address) == (address.lower(), None)
+
+
+@pytest.mark.parametrize('address', [
+    # BIP-173: invalid checksum
+    'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t5',
+    # BIP-350: Bech32 checksum on a version 1 or 16 address, Bech32m on a version 0 one
+    'bc1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vqh2y7hd',
+    'BC1S0XLXVLHEMJA6C4DQV22UAPCTQUPFHLXM9H8Z3K2E72Q4K9HCZ7VQ54WELL',
+    'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kemeawh',
+    # BIP-350: invalid character in the checksum, witness version 17
+    'bc1p38j9r5y49hruaue7wxjce0updqjuyyx0kh56v8s25huc6995vvpql3jow4',
+    'BC130XLXVLHEMJA6C4DQV22UAPCTQUPFHLXM9H8Z3K2E72Q4K9HCZ7VQ7ZWS8R',
+    # BIP-350: programs of 1 and 41 bytes, and of 16 bytes for version 0
+    'bc1pw5dgrnzv',
+    'bc1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7v8n0nx0muaewav253zgeav',
+    'BC1QR508D6QEJXTDG4Y5R3ZARVARYV98GJ9P',
+    # BIP-350: mixed case, padding of more than 4 bits, non-zero padding, empty data
+    'bc1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vq47Zagq',
+    'bc1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7v07qwwzcrf',
+    'bc1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vpggkg4j',
+    'bc1gmk9yu',
+    # A testnet address
+    'tb1qw508d6qejxtdg4y5r3zarvary0c5xw7kxpjzsx',
+])
+def test_invalid_segwit_addresses(address):
+    assert segwit_decode(address, 'bc') is None
+    detail, error = validate_bitcoin_address(address)
+    assert detail is None and 'BTC' in error
+
+
+# ------------------ Base58Check ------------------
+
+@pytest.mark.parametrize('address, payload', [
+    # P2PKH of the genesis block, P2SH
+    ('1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa', '0062e907b15cbf27d5425399ebf6f0fb50ebb88f18'),
+    ('3J98t1WpEZ73CNmQviecrnyiWrnqRhWNLy', None),
+    ('1BvBMSEYstWetqTFn5Au4m4GFg7xJaNVN2', None),
+])
+def test_valid_base58check_addresses(address, payload):
+    decoded = base58check_decode(address)
+    assert decoded is not None and len(decoded) == 21
+    if payload is not None:
+        assert decoded == bytes.fromhex(payload)
+    assert validate_bitcoin_address(address) == (address, None)
+
+
+@pytest.mark.parametrize('address', [
+    # Last character changed: wrong checksum
+    '1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNb',
+    '3J98t1WpEZ73CNmQviecrnyiWrnqRhWNLz',
+    # Valid checksum, but a testnet version byte
+    'mipcBbFg9gMiCh81Kj8tqqdgoZub1ZJRfn',
+    # Characters outside the Base58 alphabet
+    '1A1zP1eP5QGefi2DMPTfTL5SLmv7Divf0a',
+])
+def test_invalid_base58check_addresses(address):
+    detail, error = validate_bitcoin_address(address)
+    assert detail is None and 'BTC' in error
+
+
+def test_tron_addresses():
+    assert validate_tron_address('TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t') == ('TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t', None)
+    assert validate_tron_address('TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6u')[0] is None
+    # A Bitcoin address has a valid checksum, not the Tron version byte
+    assert validate_tron_address('1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa')[0] is None
+
+
+# ------------------ Keccak-256 and EIP-55 ------------------
+
+EIP55_ADDRESSES = [
+    # All caps
+    '0x52908400098527886E0F7030069857D2E4169EE7',
+    '0x8617E340B3D01FA5F11F306F4090FD50E238070D',
+    # All lower
+    '0xde709f2102306220921060314715629080e2fb77',
+    '0x27b1fdb04752bbc536007a920d24acb045561c26',
+    # Normal
+    '0x5aAeb6053F3E94C9b9A09f33669435E7Ef1BeAed',
+    '0xfB6916095ca1df60bB79Ce92cE3Ea74c37c5d359',
+    '0xdbF03B407c01E7cD3CBea99509d93f8DDDC8C6FB',
+    '0xD1220A0cf47c7B9Be7A2E6BA89F429762e7b9aDb',
+]
+
+
+@pytest.mark.parametrize('data, digest', [
+    (b'', 'c5d2460186f7233c927e7db2dcc703c0e500b653ca82273b7bfad8045d85a470'),
+    (b'abc', '4e03657aea45a94fc7d47ba826c8d667c0d1e6e33a64a036ec44f58fa12d6c45'),
+])
+def test_keccak_256(keccak, data, digest):
+    assert keccak_256(data).hex() == digest
+
+
+@pytest.mark.parametrize('address', EIP55_ADDRESSES)
+def test_eip55_checksum(keccak, address):
+    # The all-caps and all-lower vectors are only valid as such, they carry no checksum
+    if address[2:] in (address[2:].lower(), address[2:].upper()):
+        assert validate_ethereum_address(address) == (eip55_checksum(address), None)
+    else:
+        assert eip55_checksum(address.lower()) == address
+        assert validate_ethereum_address(address) == (address, None)
+        assert validate_usdt_address(address) == (address, None)
+
+
+@pytest.mark.parametrize('address', [
+    # One letter of an EIP-55 vector changed case
+    '0x5aAeb6053F3E94C9b9A09f33669435E7Ef1BeAeD',
+    '0xfb6916095ca1df60bB79Ce92cE3Ea74c37c5d359',
+    '0xdbF03B407c01E7cD3CBea99509d93f8DDDc8C6FB',
+])
+def test_wrong_eip55_checksum(keccak, address):
+    detail, error = validate_ethereum_address(address)
+    assert detail is None and 'checksum' in error
+
+
+def test_malformed_ethereum_addresses():
+    for address in ('5aAeb6053F3E94C9b9A09f33669435E7Ef1BeAed', '0x5aAeb6053F3E94C9b9A09f33669435E7Ef1BeAe',
+                    '0x5aAeb6053F3E94C9b9A09f33669435E7Ef1BeAeg'):
+        assert validate_ethereum_address(address)[0] is None
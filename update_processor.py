@@ -0,0 +1,74 @@
+"""Concurrent update processing that keeps each user's updates in order.
+
+The conversation state kept by the ConversationHandler and the read-modify-write
+of temp_data in the handlers are only correct if a user's updates are handled
+one after the other. Different users have nothing in common, so their updates
+can run in parallel.
+"""
+import asyncio
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+DEFAULT_MAX_CONCURRENT_UPDATES = 64
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Runs updates of different users concurrently and updates of the same user in arrival order.
+
+    Up to `max_concurrent_updates` handlers run at the same time. Updates that
+    wait for an earlier update of the same user do not take one of those
+    slots, so a user flooding the bot cannot starve the others. At most
+    `max_pending_updates` updates are accepted before the Application stops
+    taking new ones from its queue.
+    """
+
+    def __init__(self, max_concurrent_updates=DEFAULT_MAX_CONCURRENT_UPDATES, max_pending_updates=None):
+        # Set before the base class validates max_concurrent_updates
+        self._max_running_updates = max_concurrent_updates
+        super().__init__(max_pending_updates or max_concurrent_updates * 8)
+        self._running = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # ordering key -> [lock, number of updates holding or waiting for it]
+        self._users = {}
+
+    @property
+    def max_concurrent_updates(self):
+        return self._max_running_updates
+
+    @staticmethod
+    def ordering_key(update):
+        """Returns the key whose updates must not overlap, or None if the update can run freely."""
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self.ordering_key(update)
+        if key is None:
+            async with self._running:
+                await coroutine
+            return
+
+        entry = self._users.get(key)
+        if entry is None:
+            entry = self._users[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            # asyncio.Lock wakes its waiters first in, first out, which preserves arrival order
+            async with entry[0]:
+                async with self._running:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._users[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
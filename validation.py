@@ -0,0 +1,435 @@
+"""Validation of the details of deposit and withdrawal methods.
+
+Each method type has a validator that checks a detail as typed by the user
+and returns it in the form it is stored:
+
+- Paypal: email syntax, lowercased;
+- Crypto (BTC): a Base58Check address (P2PKH or P2SH) or a Bech32/Bech32m
+  segwit address, with its checksum verified. Segwit addresses are
+  lowercased, Base58 ones are case-sensitive and kept as typed;
+- Crypto (ETH): 0x and 40 hex digits. A mixed-case address must carry a
+  valid EIP-55 checksum; every address is stored checksummed;
+- Crypto (USDT): the address format of the network the token is held on,
+  an ETH address for ERC-20 or a Tron Base58Check address for TRC-20;
+- Bank: a bank name, lowercased with its whitespace collapsed.
+
+The patterns are compiled once at import, and validate_detail() is
+memoized, so a detail checked before costs a dictionary lookup. The
+checksums are computed in pure Python: Base58Check and Bech32 take about ten
+microseconds, the Keccak-256 hash EIP-55 relies on a few hundred, or a few
+when the optional pycryptodome package is installed (see
+benchmarks/bench_validation.py).
+
+validate_details() checks many details at once, and revalidate_methods()
+checks every stored method in one pass over the payment_methods collection.
+Run `python validation.py` to report the stored methods that fail, and
+`python validation.py --apply` to also store the normalized details and
+flag the invalid methods, which the method picker then leaves out. The bot
+keeps recently shown pickers cached for up to USER_CACHE_TTL seconds, so
+--apply is best run while the bot is stopped.
+"""
+import argparse
+import functools
+import hashlib
+import operator
+import re
+
+from methods import hash_method
+
+try:
+    # Optional, computes Keccak-256 in C
+    from Crypto.Hash import keccak as fast_keccak
+except ImportError:
+    fast_keccak = None
+
+
+MEMO_SIZE = 65536
+DEFAULT_BATCH_SIZE = 1000
+
+EMAIL = re.compile(
+    r"[a-z0-9!#$%&'*+/=?^_`{|}~-]+(?:\.[a-z0-9!#$%&'*+/=?^_`{|}~-]+)*"
+    r"@(?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\.)+[a-z]{2,63}"
+)
+HEX_ADDRESS = re.compile(r'0x[0-9a-fA-F]{40}')
+BASE58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+BASE58_ADDRESS = re.compile(f'[{BASE58_ALPHABET}]{{25,35}}')
+BASE58_VALUES = {char: value for value, char in enumerate(BASE58_ALPHABET)}
+BANK_NAME = re.compile(r'[^\W\d_][\w .,&\'()-]{1,63}')
+WHITESPACE = re.compile(r'\s+')
+
+# Version byte of the Base58Check addresses accepted, by network
+BITCOIN_VERSIONS = (0x00, 0x05)  # P2PKH, P2SH
+TRON_VERSION = 0x41
+
+BECH32_CHARSET = 'qpzry9x8gf2tvdw0s3jn54khce6mua7l'
+BECH32_VALUES = {char: value for value, char in enumerate(BECH32_CHARSET)}
+BECH32_TO_BASE32 = str.maketrans(BECH32_CHARSET, '0123456789abcdefghijklmnopqrstuv')
+BECH32_GENERATOR = (0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3)
+# XOR of the generators selected by the 5 bits shifted out of the checksum, for each value of those bits
+BECH32_GENERATOR_TABLE = [
+    functools.reduce(operator.xor, (generator for bit, generator in enumerate(BECH32_GENERATOR) if top >> bit & 1), 0)
+    for top in range(32)
+]
+BECH32_CONSTANT = 1
+BECH32M_CONSTANT = 0x2bc830a3
+BITCOIN_HRP = 'bc'
+
+
+# ------------------ Checksums ------------------
+
+def _keccak_round_constants():
+    """The round constants of Keccak-f[1600], generated by its linear feedback shift register."""
+    constants = []
+    state = 1
+    for _ in range(24):
+        constant = 0
+        for bit in range(7):
+            if state & 1:
+                constant |= 1 << ((1 << bit) - 1)
+            state = ((state << 1) ^ 0x71) & 0xff if state & 0x80 else state << 1
+        constants.append(constant)
+    return constants
+
+
+KECCAK_ROUND_CONSTANTS = _keccak_round_constants()
+LANE_MASK = (1 << 64) - 1
+KECCAK_256_RATE = 136
+
+
+def keccak_256(data):
+    """Keccak-256 as used by Ethereum, which pads differently from hashlib's sha3_256."""
+    if fast_keccak is not None:
+        return fast_keccak.new(digest_bits=256, data=data).digest()
+    padded = bytearray(data)
+    padded.append(0x01)
+    padded.extend(bytes(-len(padded) % KECCAK_256_RATE))
+    padded[-1] |= 0x80
+    lanes = [0] * 25
+    for start in range(0, len(padded), KECCAK_256_RATE):
+        block = padded[start:start + KECCAK_256_RATE]
+        for index in range(KECCAK_256_RATE // 8):
+            lanes[index] ^= int.from_bytes(block[index * 8:index * 8 + 8], 'little')
+        lanes = _keccak_f(lanes)
+    return b''.join(lane.to_bytes(8, 'little') for lane in lanes[:4])
+
+
+def _keccak_f(lanes):
+    # Unrolled over the 25 lanes, which makes it about twice as fast as loops over them
+    (a00, a01, a02, a03, a04, a05, a06, a07, a08, a09, a10, a11, a12,
+     a13, a14, a15, a16, a17, a18, a19, a20, a21, a22, a23, a24) = lanes
+    for round_constant in KECCAK_ROUND_CONSTANTS:
+        # theta
+        c0 = a00 ^ a05 ^ a10 ^ a15 ^ a20
+        c1 = a01 ^ a06 ^ a11 ^ a16 ^ a21
+        c2 = a02 ^ a07 ^ a12 ^ a17 ^ a22
+        c3 = a03 ^ a08 ^ a13 ^ a18 ^ a23
+        c4 = a04 ^ a09 ^ a14 ^ a19 ^ a24
+        d0 = c4 ^ ((c1 << 1 | c1 >> 63) & LANE_MASK)
+        d1 = c0 ^ ((c2 << 1 | c2 >> 63) & LANE_MASK)
+        d2 = c1 ^ ((c3 << 1 | c3 >> 63) & LANE_MASK)
+        d3 = c2 ^ ((c4 << 1 | c4 >> 63) & LANE_MASK)
+        d4 = c3 ^ ((c0 << 1 | c0 >> 63) & LANE_MASK)
+        # rho and pi
+        b00 = a00 ^ d0
+        lane = a01 ^ d1
+        b10 = (lane << 1 | lane >> 63) & LANE_MASK
+        lane = a02 ^ d2
+        b20 = (lane << 62 | lane >> 2) & LANE_MASK
+        lane = a03 ^ d3
+        b05 = (lane << 28 | lane >> 36) & LANE_MASK
+        lane = a04 ^ d4
+        b15 = (lane << 27 | lane >> 37) & LANE_MASK
+        lane = a05 ^ d0
+        b16 = (lane << 36 | lane >> 28) & LANE_MASK
+        lane = a06 ^ d1
+        b01 = (lane << 44 | lane >> 20) & LANE_MASK
+        lane = a07 ^ d2
+        b11 = (lane << 6 | lane >> 58) & LANE_MASK
+        lane = a08 ^ d3
+        b21 = (lane << 55 | lane >> 9) & LANE_MASK
+        lane = a09 ^ d4
+        b06 = (lane << 20 | lane >> 44) & LANE_MASK
+        lane = a10 ^ d0
+        b07 = (lane << 3 | lane >> 61) & LANE_MASK
+        lane = a11 ^ d1
+        b17 = (lane << 10 | lane >> 54) & LANE_MASK
+        lane = a12 ^ d2
+        b02 = (lane << 43 | lane >> 21) & LANE_MASK
+        lane = a13 ^ d3
+        b12 = (lane << 25 | lane >> 39) & LANE_MASK
+        lane = a14 ^ d4
+        b22 = (lane << 39 | lane >> 25) & LANE_MASK
+        lane = a15 ^ d0
+        b23 = (lane << 41 | lane >> 23) & LANE_MASK
+        lane = a16 ^ d1
+        b08 = (lane << 45 | lane >> 19) & LANE_MASK
+        lane = a17 ^ d2
+        b18 = (lane << 15 | lane >> 49) & LANE_MASK
+        lane = a18 ^ d3
+        b03 = (lane << 21 | lane >> 43) & LANE_MASK
+        lane = a19 ^ d4
+        b13 = (lane << 8 | lane >> 56) & LANE_MASK
+        lane = a20 ^ d0
+        b14 = (lane << 18 | lane >> 46) & LANE_MASK
+        lane = a21 ^ d1
+        b24 = (lane << 2 | lane >> 62) & LANE_MASK
+        lane = a22 ^ d2
+        b09 = (lane << 61 | lane >> 3) & LANE_MASK
+        lane = a23 ^ d3
+        b19 = (lane << 56 | lane >> 8) & LANE_MASK
+        lane = a24 ^ d4
+        b04 = (lane << 14 | lane >> 50) & LANE_MASK
+        # chi and iota
+        a00 = b00 ^ (~b01 & b02) ^ round_constant
+        a01 = b01 ^ (~b02 & b03)
+        a02 = b02 ^ (~b03 & b04)
+        a03 = b03 ^ (~b04 & b00)
+        a04 = b04 ^ (~b00 & b01)
+        a05 = b05 ^ (~b06 & b07)
+        a06 = b06 ^ (~b07 & b08)
+        a07 = b07 ^ (~b08 & b09)
+        a08 = b08 ^ (~b09 & b05)
+        a09 = b09 ^ (~b05 & b06)
+        a10 = b10 ^ (~b11 & b12)
+        a11 = b11 ^ (~b12 & b13)
+        a12 = b12 ^ (~b13 & b14)
+        a13 = b13 ^ (~b14 & b10)
+        a14 = b14 ^ (~b10 & b11)
+        a15 = b15 ^ (~b16 & b17)
+        a16 = b16 ^ (~b17 & b18)
+        a17 = b17 ^ (~b18 & b19)
+        a18 = b18 ^ (~b19 & b15)
+        a19 = b19 ^ (~b15 & b16)
+        a20 = b20 ^ (~b21 & b22)
+        a21 = b21 ^ (~b22 & b23)
+        a22 = b22 ^ (~b23 & b24)
+        a23 = b23 ^ (~b24 & b20)
+        a24 = b24 ^ (~b20 & b21)
+    return [a00, a01, a02, a03, a04, a05, a06, a07, a08, a09, a10, a11, a12,
+            a13, a14, a15, a16, a17, a18, a19, a20, a21, a22, a23, a24]
+
+
+def eip55_checksum(address):
+    """The EIP-55 mixed-case form of a 0x-prefixed hex address."""
+    digits = address[2:].lower()
+    digest = keccak_256(digits.encode('ascii')).hex()
+    return '0x' + ''.join(char.upper() if nibble in '89abcdef' else char for char, nibble in zip(digits, digest))
+
+
+def base58check_decode(text):
+    """The payload of a Base58Check string, without its checksum, or None if the checksum is wrong."""
+    number = 0
+    for char in text:
+        number = number * 58 + BASE58_VALUES[char]
+    leading_zeros = len(text) - len(text.lstrip('1'))
+    raw = bytes(leading_zeros) + number.to_bytes((number.bit_length() + 7) // 8, 'big')
+    payload, checksum = raw[:-4], raw[-4:]
+    if len(raw) < 5 or hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4] != checksum:
+        return None
+    return payload
+
+
+def _bech32_polymod(values):
+    checksum = 1
+    for value in values:
+        checksum = ((checksum & 0x1ffffff) << 5 ^ value) ^ BECH32_GENERATOR_TABLE[checksum >> 25]
+    return checksum
+
+
+def _five_bit_groups_to_bytes(text):
+    """The bytes encoded by Bech32 characters, 5 bits each, or None if the leftover bits are not zero padding."""
+    bits = 5 * len(text)
+    padding = bits % 8
+    # int() reads the groups as base 32 digits in C, much faster than shifting them in one by one
+    number = int(text.translate(BECH32_TO_BASE32), 32)
+    if padding >= 5 or number & ((1 << padding) - 1):
+        return None
+    return (number >> padding).to_bytes(bits // 8, 'big')
+
+
+def segwit_decode(address, hrp):
+    """(witness version, program) of a Bech32 (v0) or Bech32m (v1+) address, or None if it is not valid."""
+    if address.lower() != address and address.upper() != address or len(address) > 90:
+        return None
+    address = address.lower()
+    prefix, separator, data_part = address.rpartition('1')
+    if prefix != hrp or not separator or len(data_part) < 11:
+        return None
+    try:
+        data = [BECH32_VALUES[char] for char in data_part]
+    except KeyError:
+        return None
+    expanded = [ord(char) >> 5 for char in hrp] + [0] + [ord(char) & 31 for char in hrp]
+    constant = _bech32_polymod(expanded + data)
+    version = data[0]
+    program = _five_bit_groups_to_bytes(data_part[1:-6])
+    if program is None or version > 16 or not 2 <= len(program) <= 40:
+        return None
+    if version == 0 and (constant != BECH32_CONSTANT or len(program) not in (20, 32)):
+        return None
+    if version > 0 and constant != BECH32M_CONSTANT:
+        return None
+    return version, program
+
+
+# ------------------ Validators ------------------
+# Each returns (stored detail, None) or (None, error message).
+
+def validate_email(text):
+    email = text.strip().lower()
+    local, _, domain = email.partition('@')
+    if len(email) > 254 or len(local) > 64 or not EMAIL.fullmatch(email):
+        return None, 'This is not a valid email address.'
+    return email, None
+
+
+def validate_bitcoin_address(text):
+    address = text.strip()
+    if address.lower().startswith(BITCOIN_HRP + '1'):
+        if segwit_decode(address, BITCOIN_HRP) is None:
+            return None, 'This is not a valid BTC address (wrong format or checksum).'
+        return address.lower(), None
+    if BASE58_ADDRESS.fullmatch(address):
+        payload = base58check_decode(address)
+        if payload is not None and len(payload) == 21 and payload[0] in BITCOIN_VERSIONS:
+            return address, None
+    return None, 'This is not a valid BTC address (wrong format or checksum).'
+
+
+def validate_ethereum_address(text):
+    address = text.strip()
+    if not HEX_ADDRESS.fullmatch(address):
+        return None, 'This is not a valid ETH address (0x followed by 40 hexadecimal digits).'
+    checksummed = eip55_checksum(address)
+    digits = address[2:]
+    # All-lowercase and all-uppercase addresses carry no checksum
+    if digits != digits.lower() and digits != digits.upper() and address != checksummed:
+        return None, 'This ETH address has a wrong checksum, please check it for typos.'
+    return checksummed, None
+
+
+def validate_tron_address(text):
+    address = text.strip()
+    if address.startswith('T') and BASE58_ADDRESS.fullmatch(address):
+        payload = base58check_decode(address)
+        if payload is not None and len(payload) == 21 and payload[0] == TRON_VERSION:
+            return address, None
+    return None, 'This is not a valid TRC-20 address (wrong format or checksum).'
+
+
+def validate_usdt_address(text):
+    address = text.strip()
+    if address.startswith('0x'):
+        return validate_ethereum_address(address)
+    if address.startswith('T'):
+        return validate_tron_address(address)
+    return None, 'This is not a valid USDT address: an ERC-20 (0x...) or TRC-20 (T...) address is expected.'
+
+
+def validate_bank_name(text):
+    name = WHITESPACE.sub(' ', text.strip()).lower()
+    if not BANK_NAME.fullmatch(name):
+        return None, 'Please enter the name of the bank (2 to 64 characters, starting with a letter).'
+    return name, None
+
+
+# Stored method type -> validator
+VALIDATORS = {
+    'Bank': validate_bank_name,
+    'Paypal': validate_email,
+    'Crypto (BTC)': validate_bitcoin_address,
+    'Crypto (ETH)': validate_ethereum_address,
+    'Crypto (USDT)': validate_usdt_address,
+}
+
+
+@functools.lru_cache(maxsize=MEMO_SIZE)
+def validate_detail(method_type, text):
+    """Checks the detail of a method. Returns (detail as stored, None), or (None, error message) if it is invalid."""
+    validator = VALIDATORS.get(method_type)
+    if validator is None:
+        return None, f'Unknown method type {method_type}.'
+    return validator(text)
+
+
+def validate_details(methods):
+    """Checks many (method type, detail) pairs at once. Returns their (detail as stored, error) in the same order."""
+    return [validate_detail(method_type, detail) for method_type, detail in methods]
+
+
+# ------------------ Stored methods ------------------
+
+def revalidate_methods(collection, apply=False, batch_size=DEFAULT_BATCH_SIZE):
+    """Checks every stored method, in batches of batch_size.
+
+    With `apply`, a method whose detail is stored differently now (an ETH
+    address without its checksum, for example) is replaced by one with the
+    normalized detail, which merges it with an identical method the user
+    already had, and an invalid method is flagged with the error. Returns
+    the counts of valid, normalized and invalid methods, and up to ten
+    examples of invalid ones.
+    """
+    query = {'invalid': {'$exists': False}}
+    report = {'checked': 0, 'valid': 0, 'normalized': 0, 'invalid': 0, 'examples': []}
+    batch = []
+    for method in collection.find(query, batch_size=batch_size):
+        batch.append(method)
+        if len(batch) >= batch_size:
+            _revalidate_batch(collection, batch, apply, report)
+            batch = []
+    if batch:
+        _revalidate_batch(collection, batch, apply, report)
+    return report
+
+
+def _revalidate_batch(collection, methods, apply, report):
+    from pymongo import DeleteOne, UpdateOne
+
+    replacements = []
+    removals = []
+    flags = []
+    results = validate_details((method['type'], method['detail']) for method in methods)
+    for method, (detail, error) in zip(methods, results):
+        report['checked'] += 1
+        if error is not None:
+            report['invalid'] += 1
+            if len(report['examples']) < 10:
+                report['examples'].append(f"user {method['user_id']}, {method['description']}: {error}")
+            flags.append(UpdateOne({'_id': method['_id']}, {'$set': {'invalid': error}}))
+        elif detail != method['detail']:
+            report['normalized'] += 1
+            replacement = {key: value for key, value in method.items() if key not in ('_id', 'user_id')}
+            replacement.update(detail=detail, description=f"{method['type']}: {detail}")
+            method_id = hash_method(method['user_id'], method['kind'], method['type'], detail)
+            replacements.append(UpdateOne(
+                {'_id': method_id, 'user_id': method['user_id']}, {'$setOnInsert': replacement}, upsert=True
+            ))
+            removals.append(DeleteOne({'_id': method['_id']}))
+        else:
+            report['valid'] += 1
+    if apply:
+        # Replacements are stored before the methods they replace are deleted, so none is lost
+        for requests in (replacements + flags, removals):
+            if requests:
+                collection.bulk_write(requests, ordered=False)
+
+
+if __name__ == '__main__':
+    import pymongo
+    from dotenv import load_dotenv
+
+    from storage import script_mongo_uri
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--apply', action='store_true', help='store the normalized details and flag invalid methods')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    load_dotenv()
+    methods = pymongo.MongoClient(script_mongo_uri('validation.py'))['bot_database']['payment_methods']
+    result = revalidate_methods(methods, apply=args.apply, batch_size=args.batch_size)
+    for example in result['examples']:
+        print(f"Invalid: {example}")
+    print(f"{result['checked']} methods checked: {result['valid']} valid, {result['normalized']} "
+          f"{'normalized' if args.apply else 'to normalize'}, {result['invalid']} invalid"
+          f"{'' if args.apply else ' (run with --apply to store the changes)'}")
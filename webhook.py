@@ -0,0 +1,237 @@
+"""Webhook serving mode.
+
+Telegram POSTs each update to a public HTTPS URL, usually terminated by a
+reverse proxy or load balancer in front of this process. WebhookServer is a
+small asyncio HTTP/1.1 server that validates those requests and hands the
+updates to the Application through its update queue:
+
+- only POST requests to the webhook path are accepted;
+- the X-Telegram-Bot-Api-Secret-Token header must match the secret given to
+  setWebhook;
+- bodies must be JSON, announce their Content-Length and stay under a size limit;
+- connections are kept alive between requests, as Telegram reuses them;
+- when the bounded update queue is full the request is refused with 503, and
+  Telegram delivers the update again later instead of it piling up here.
+"""
+import asyncio
+import hmac
+import json
+import logging
+import signal
+from urllib.parse import urlparse
+
+from telegram import Update
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 8443
+DEFAULT_QUEUE_SIZE = 1000
+MAX_BODY_SIZE = 1024 * 1024
+MAX_HEADERS = 100
+KEEP_ALIVE_TIMEOUT = 75
+SECRET_TOKEN_HEADER = 'x-telegram-bot-api-secret-token'
+
+REASONS = {
+    200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed',
+    411: 'Length Required', 413: 'Payload Too Large', 415: 'Unsupported Media Type',
+    431: 'Request Header Fields Too Large', 503: 'Service Unavailable',
+}
+
+
+class BadRequest(Exception):
+    """Raised when a request cannot be parsed; the connection is answered and closed."""
+
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+
+class WebhookServer:
+    """Accepts Telegram webhook requests and queues the updates for the Application."""
+
+    def __init__(self, application, listen, port, url_path, secret_token=None,
+                 max_body_size=MAX_BODY_SIZE, keep_alive_timeout=KEEP_ALIVE_TIMEOUT, sock=None, metrics=None):
+        self.application = application
+        self.listen = listen
+        self.port = port
+        self.url_path = '/' + url_path.strip('/')
+        self.secret_token = secret_token
+        self.max_body_size = max_body_size
+        self.keep_alive_timeout = keep_alive_timeout
+        # Already listening socket to serve instead of binding listen:port, e.g. inherited on restart
+        self.sock = sock
+        self.metrics = metrics
+        self._server = None
+        self._connections = set()
+
+    async def start(self):
+        if self.sock is not None:
+            self._server = await asyncio.start_server(self._handle_connection, sock=self.sock)
+        else:
+            self._server = await asyncio.start_server(self._handle_connection, self.listen, self.port)
+        # Port 0 asks the OS for a free port, report the one actually bound
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info("Webhook server listening on %s:%s%s", self.listen, self.port, self.url_path)
+
+    def fileno(self):
+        """File descriptor of the listening socket."""
+        return self._server.sockets[0].fileno()
+
+    async def stop(self):
+        if self._server is None:
+            return
+        self._server.close()
+        for writer in list(self._connections):
+            writer.close()
+        await self._server.wait_closed()
+        self._server = None
+
+    async def _handle_connection(self, reader, writer):
+        self._connections.add(writer)
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), self.keep_alive_timeout)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line:
+                    break
+
+                try:
+                    method, target, version, headers, body = await self._read_request(request_line, reader)
+                except BadRequest as error:
+                    self._write_response(writer, error.status, keep_alive=False)
+                    await writer.drain()
+                    break
+
+                status = self._accept(method, target, headers, body)
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                self._write_response(writer, status, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    async def _read_request(self, request_line, reader):
+        try:
+            method, target, version = request_line.decode('latin-1').split()
+        except ValueError:
+            raise BadRequest(400)
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            if len(headers) >= MAX_HEADERS:
+                raise BadRequest(431)
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if 'content-length' not in headers:
+            raise BadRequest(411) if method == 'POST' else BadRequest(405)
+        try:
+            length = int(headers['content-length'])
+        except ValueError:
+            raise BadRequest(400)
+        if length < 0:
+            raise BadRequest(400)
+        if length > self.max_body_size:
+            raise BadRequest(413)
+        body = await reader.readexactly(length)
+        return method, target, version, headers, body
+
+    def _accept(self, method, target, headers, body):
+        """Validates a request and queues its update. Returns the HTTP status to answer with."""
+        if method != 'POST':
+            return self._answer(405)
+        if urlparse(target).path.rstrip('/') != self.url_path.rstrip('/'):
+            return self._answer(404)
+        if self.secret_token is not None:
+            received = headers.get(SECRET_TOKEN_HEADER, '')
+            if not hmac.compare_digest(received.encode(), self.secret_token.encode()):
+                return self._answer(403)
+        if not headers.get('content-type', '').lower().startswith('application/json'):
+            return self._answer(415)
+
+        try:
+            data = json.loads(body)
+            if not isinstance(data, dict) or 'update_id' not in data:
+                return self._answer(400)
+            accepted = self.deliver(data)
+        except (ValueError, TypeError, KeyError):
+            return self._answer(400)
+        if not accepted:
+            return self._answer(503)
+        return self._answer(200)
+
+    def deliver(self, data):
+        """Queues a decoded update for processing. Returns False when there is no room for it."""
+        try:
+            self.application.update_queue.put_nowait(Update.de_json(data, self.application.bot))
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    def _answer(self, status):
+        if self.metrics is not None:
+            self.metrics.webhook_requests.inc(status)
+        return status
+
+    @staticmethod
+    def _write_response(writer, status, keep_alive):
+        connection = 'keep-alive' if keep_alive else 'close'
+        writer.write(
+            f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+            f"Content-Length: 0\r\n"
+            f"Connection: {connection}\r\n\r\n".encode('latin-1')
+        )
+
+
+async def serve_webhook(application, webhook_url, listen='0.0.0.0', port=DEFAULT_PORT, secret_token=None,
+                        stop_event=None, sock=None, post_start=None):
+    """Runs the application behind a WebhookServer until stop_event is set."""
+    stop_event = stop_event or asyncio.Event()
+    server = WebhookServer(
+        application, listen, port, urlparse(webhook_url).path, secret_token, sock=sock,
+        metrics=application.bot_data.get('metrics')
+    )
+    # For restart.Restart, which hands the listening socket over and stops serving
+    application.bot_data['webhook_server'] = server
+    application.bot_data['stop_serving'] = stop_event.set
+
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        await application.bot.set_webhook(webhook_url, secret_token=secret_token, allowed_updates=Update.ALL_TYPES)
+        await application.start()
+        await server.start()
+        try:
+            if post_start:
+                await post_start(application)
+            await stop_event.wait()
+        finally:
+            await server.stop()
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+
+def run_webhook(application, webhook_url, listen='0.0.0.0', port=DEFAULT_PORT, secret_token=None, sock=None,
+                post_start=None):
+    """Blocking counterpart of Application.run_polling for webhook mode."""
+    async def main():
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop_event.set)
+        await serve_webhook(application, webhook_url, listen, port, secret_token, stop_event, sock, post_start)
+
+    asyncio.run(main())